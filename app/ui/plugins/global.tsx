@@ -304,6 +304,44 @@ const Global: React.FC = () => {
                         padding: 0,
                     }}
                 />
+                <Form.InputNumber
+                    field="upload_bandwidth"
+                    extraText={
+                        <div style={{ fontSize: "14px" }}>
+                            上传与录制共用的总带宽，扣除录制占用后按权重分配给正在上传的主播，同一主播的分段上传与最终上传共用一份带宽。保存后立即生效
+                            <br />
+                            单位：Mbps，0 或留空为不限速
+                        </div>
+                    }
+                    placeholder={0}
+                    min={0}
+                    label="上传带宽上限（upload_bandwidth）"
+                    suffix="Mbps"
+                    style={{ width: "100%" }}
+                    fieldStyle={{
+                        alignSelf: "stretch",
+                        padding: 0,
+                    }}
+                />
+                <Form.InputNumber
+                    field="record_bandwidth_reserve"
+                    extraText={
+                        <div style={{ fontSize: "14px" }}>
+                            为录制预留的带宽，录制实际占用高于此值时按实际占用扣除
+                            <br />
+                            单位：Mbps
+                        </div>
+                    }
+                    placeholder={0}
+                    min={0}
+                    label="录制预留带宽（record_bandwidth_reserve）"
+                    suffix="Mbps"
+                    style={{ width: "100%" }}
+                    fieldStyle={{
+                        alignSelf: "stretch",
+                        padding: 0,
+                    }}
+                />
                 <Form.Switch
                     field="use_live_cover"
                     extraText={
@@ -0,0 +1,158 @@
+"""
+哔哩哔哩弹幕解码基准测试
+按直播间常见的消息构成生成 zlib 与 brotli 压缩的数据包，比较旧的递归解码与当前解码每秒处理的消息数
+
+用法:
+    python benchmarks/bilibili_danmaku.py --frames 2000 --batch 20
+"""
+import argparse
+import json
+import random
+import time
+import zlib
+from struct import pack, unpack
+
+import brotli
+
+from biliup.Danmaku.bilibili import Bilibili
+
+# (cmd, 占比)，礼物与进场消息远多于弹幕
+MESSAGE_MIX = (
+    ('DANMU_MSG', 0.3),
+    ('INTERACT_WORD', 0.35),
+    ('SEND_GIFT', 0.15),
+    ('ONLINE_RANK_COUNT', 0.1),
+    ('LIKE_INFO_V3_CLICK', 0.1),
+)
+
+
+def make_body(cmd: str, i: int) -> bytes:
+    """生成与线上结构相近的消息正文"""
+    if cmd == 'DANMU_MSG':
+        j = {'cmd': 'DANMU_MSG', 'info': [
+            [0, 1, 25, 16777215, 1700000000000 + i, 0, 0, 'abcdef', 0, 0, 0, '', 0, '{}', '{}',
+             {'mode': 0, 'show_player_type': 0, 'extra': json.dumps({'content': f'弹幕{i}'})}],
+            f'弹幕内容{i}', [i, f'用户{i}', 0, 0, 0, 10000, 1, ''],
+            [21, '粉丝牌', '主播', 1000, 1725515, '', 0], [12, 0, 6406234, '>50000'], ['', ''], 0, 0, None,
+            {'ts': 1700000000, 'ct': 'ABCDEF'}, 0, 0, None, None, 0, 105]}
+    elif cmd == 'SEND_GIFT':
+        j = {'cmd': 'SEND_GIFT', 'data': {
+            'uname': f'用户{i}', 'uid': i, 'giftName': '辣条', 'giftId': 1, 'num': 1, 'price': 100,
+            'coin_type': 'silver', 'action': '投喂', 'timestamp': 1700000000, 'face': 'https://i0.hdslb.com/x.jpg',
+            'medal_info': {'medal_name': '粉丝牌', 'medal_level': 21}, 'batch_combo_send': None}}
+    elif cmd == 'INTERACT_WORD':
+        j = {'cmd': 'INTERACT_WORD', 'data': {
+            'uname': f'用户{i}', 'uid': i, 'msg_type': 1, 'roomid': 1, 'timestamp': 1700000000,
+            'fans_medal': {'medal_name': '粉丝牌', 'medal_level': 3}, 'uname_color': ''}}
+    else:
+        j = {'cmd': cmd, 'data': {'count': i, 'online_count': i * 3}}
+    return json.dumps(j, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def make_packet(body: bytes, ver: int, op: int = 5) -> bytes:
+    return pack('!IHHII', 16 + len(body), 16, ver, op, 1) + body
+
+
+def make_frames(count: int, batch: int, compression: str) -> list:
+    """生成 count 个数据帧，每帧包含 batch 条消息"""
+    rng = random.Random(0)
+    cmds = [c for c, _ in MESSAGE_MIX]
+    weights = [w for _, w in MESSAGE_MIX]
+    frames = []
+    for n in range(count):
+        inner = b''.join(make_packet(make_body(rng.choices(cmds, weights)[0], n * batch + i), 0)
+                         for i in range(batch))
+        if compression == 'zlib':
+            frames.append(make_packet(zlib.compress(inner), 2))
+        else:
+            frames.append(make_packet(brotli.compress(inner), 3))
+    return frames
+
+
+def legacy_decode_msg(data):
+    """改写前的解码：递归切片并解析所有消息"""
+    msgs = []
+
+    def decode_packet(packet_data):
+        dm_list = []
+        while True:
+            try:
+                packet_len, header_len, ver, op, seq = unpack('!IHHII', packet_data[0:16])
+            except Exception:
+                break
+            if len(packet_data) < packet_len:
+                break
+
+            if ver == 2:
+                dm_list.extend(decode_packet(zlib.decompress(packet_data[16:packet_len])))
+            elif ver == 3:
+                dm_list.extend(decode_packet(brotli.decompress(packet_data[16:packet_len])))
+            elif ver == 0 or ver == 1:
+                dm_list.append({
+                    'type': op,
+                    'body': packet_data[16:packet_len]
+                })
+            else:
+                break
+
+            if len(packet_data) == packet_len:
+                break
+            else:
+                packet_data = packet_data[packet_len:]
+        return dm_list
+
+    for dm in decode_packet(data):
+        msg = {}
+        if dm.get('type') == 5:
+            j = json.loads(dm.get('body'))
+            msg['msg_type'] = {
+                'SEND_GIFT': 'gift',
+                'DANMU_MSG': 'danmaku',
+                'WELCOME': 'enter',
+                'NOTICE_MSG': 'broadcast',
+                'LIVE_INTERACTIVE_GAME': 'interactive_danmaku'
+            }.get(j.get('cmd'), 'other')
+            if msg['msg_type'] == 'danmaku':
+                msg['name'] = (j.get('info', ['', '', ['', '']])[2][1] or
+                               j.get('data', {}).get('uname', ''))
+                msg['content'] = j.get('info', ['', ''])[1]
+                msg["color"] = f"{j.get('info', '16777215')[0][3]}"
+            else:
+                msg['content'] = j
+        else:
+            msg = {'name': '', 'content': dm.get('body'), 'msg_type': 'other'}
+        msgs.append(msg)
+    return msgs
+
+
+def bench(decode, frames: list, batch: int, repeat: int) -> float:
+    """返回每秒处理的消息数，取多次中最快的一次"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in frames:
+            decode(frame)
+        best = min(best, time.perf_counter() - start)
+    return len(frames) * batch / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='哔哩哔哩弹幕解码基准测试')
+    parser.add_argument('--frames', type=int, default=2000, help='数据帧数')
+    parser.add_argument('--batch', type=int, default=20, help='每帧的消息数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数')
+    args = parser.parse_args()
+
+    for compression in ('zlib', 'brotli'):
+        frames = make_frames(args.frames, args.batch, compression)
+        # 两种解码得到的弹幕须一致
+        legacy = [m['content'] for f in frames for m in legacy_decode_msg(f) if m['msg_type'] == 'danmaku']
+        current = [m['content'] for f in frames for m in Bilibili.decode_msg(f) if m['msg_type'] == 'danmaku']
+        assert legacy == current, '解码结果不一致'
+        before = bench(legacy_decode_msg, frames, args.batch, args.repeat)
+        after = bench(Bilibili.decode_msg, frames, args.batch, args.repeat)
+        print(f'{compression:<7} before {before:>10.0f} msg/s  after {after:>10.0f} msg/s  x{after / before:.2f}')
+
+
+if __name__ == '__main__':
+    main()
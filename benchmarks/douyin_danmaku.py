@@ -0,0 +1,150 @@
+"""
+抖音弹幕解码基准测试
+按直播间常见的消息构成生成 PushFrame 数据帧，比较旧的 MessageToDict 解码与当前直接读取字段的解码每秒处理的消息数
+
+用法:
+    python benchmarks/douyin_danmaku.py --frames 2000 --batch 20
+"""
+import argparse
+import gzip
+import random
+import time
+
+from google.protobuf import json_format
+
+from biliup.Danmaku.douyin import Douyin
+from biliup.Danmaku.douyin_util.dy_pb2 import (ChatMessage, GiftMessage, LikeMessage, MemberMessage, PushFrame,
+                                               Response)
+
+# (消息方法, 占比)，入场、点赞与礼物消息远多于弹幕
+MESSAGE_MIX = (
+    ('WebcastChatMessage', 0.25),
+    ('WebcastMemberMessage', 0.3),
+    ('WebcastLikeMessage', 0.25),
+    ('WebcastGiftMessage', 0.2),
+)
+
+
+def fill_user(user, i: int):
+    user.id = 10000 + i
+    user.nickName = f'用户{i}'
+    user.gender = i % 2
+    user.Level = i % 50
+    user.city = '上海'
+    user.AvatarThumb.urlListList.extend([f'https://p3.douyinpic.com/avatar/{i}.jpeg'] * 3)
+
+
+def make_payload(method: str, i: int) -> bytes:
+    """生成与线上结构相近的消息正文"""
+    if method == 'WebcastChatMessage':
+        msg = ChatMessage()
+        msg.content = f'弹幕内容{i}'
+        msg.eventTime = 1700000000 + i
+    elif method == 'WebcastMemberMessage':
+        msg = MemberMessage()
+        msg.memberCount = i
+        msg.action = 1
+    elif method == 'WebcastLikeMessage':
+        msg = LikeMessage()
+        msg.count = 1
+        msg.total = i
+    else:
+        msg = GiftMessage()
+        msg.giftId = 685
+        msg.repeatCount = i % 10
+        msg.comboCount = i % 10
+        msg.traceId = f'{i:032x}'
+    msg.common.method = method
+    msg.common.msgId = i
+    msg.common.roomId = 7300000000000000000
+    msg.common.createTime = 1700000000000 + i
+    fill_user(msg.user, i)
+    return msg.SerializeToString()
+
+
+def make_frames(count: int, batch: int) -> list:
+    """生成 count 个数据帧，每帧包含 batch 条消息"""
+    rng = random.Random(0)
+    methods = [m for m, _ in MESSAGE_MIX]
+    weights = [w for _, w in MESSAGE_MIX]
+    frames = []
+    for n in range(count):
+        response = Response()
+        response.cursor = f't-{n}'
+        response.needAck = True
+        response.internalExt = f'internal_src:dim|wss_push_room_id:1|fetch_time:{n}'
+        for i in range(batch):
+            method = rng.choices(methods, weights)[0]
+            msg = response.messagesList.add()
+            msg.method = method
+            msg.payload = make_payload(method, n * batch + i)
+            msg.msgId = n * batch + i
+        frame = PushFrame()
+        frame.logId = n
+        frame.payloadEncoding = 'gzip'
+        frame.payloadType = 'msg'
+        frame.payload = gzip.compress(response.SerializeToString())
+        frames.append(frame.SerializeToString())
+    return frames
+
+
+def legacy_decode_msg(data):
+    """改写前的解码：每帧使用 gzip 模块解压，每条弹幕转换为 dict"""
+    wss_package = PushFrame()
+    wss_package.ParseFromString(data)
+    log_id = wss_package.logId
+    decompressed = gzip.decompress(wss_package.payload)
+    payload_package = Response()
+    payload_package.ParseFromString(decompressed)
+
+    ack = None
+    if payload_package.needAck:
+        obj = PushFrame()
+        obj.payloadType = 'ack'
+        obj.logId = log_id
+        obj.payloadType = payload_package.internalExt
+        ack = obj.SerializeToString()
+
+    msgs = []
+    for msg in payload_package.messagesList:
+        if msg.method == 'WebcastChatMessage':
+            chat_message = ChatMessage()
+            chat_message.ParseFromString(msg.payload)
+            data = json_format.MessageToDict(chat_message, preserving_proto_field_name=True)
+            msgs.append({"content": data['content'], "msg_type": "danmaku"})
+
+    return msgs, ack
+
+
+def bench(decode, frames: list, batch: int, repeat: int) -> float:
+    """返回每秒处理的消息数，取多次中最快的一次"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in frames:
+            decode(frame)
+        best = min(best, time.perf_counter() - start)
+    return len(frames) * batch / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='抖音弹幕解码基准测试')
+    parser.add_argument('--frames', type=int, default=2000, help='数据帧数')
+    parser.add_argument('--batch', type=int, default=20, help='每帧的消息数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数')
+    args = parser.parse_args()
+
+    frames = make_frames(args.frames, args.batch)
+    # 两种解码得到的弹幕与 ack 须一致
+    for frame in frames:
+        legacy_msgs, legacy_ack = legacy_decode_msg(frame)
+        msgs, ack = Douyin.decode_msg(frame)
+        assert [m['content'] for m in legacy_msgs] == [m['content'] for m in msgs], '解码结果不一致'
+        assert legacy_ack == ack, 'ack 不一致'
+    before = bench(legacy_decode_msg, frames, args.batch, args.repeat)
+    after = bench(Douyin.decode_msg, frames, args.batch, args.repeat)
+    print(f'before {before:>10.0f} msg/s  after {after:>10.0f} msg/s  x{after / before:.2f}')
+
+
+if __name__ == '__main__':
+    main()
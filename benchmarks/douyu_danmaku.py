@@ -0,0 +1,140 @@
+"""
+斗鱼弹幕解码基准测试
+按直播间常见的消息构成生成 STT 数据帧，比较旧的正则加递归解析与当前单次扫描解析每秒处理的消息数
+
+用法:
+    python benchmarks/douyu_danmaku.py --frames 5000 --batch 10
+"""
+import argparse
+import random
+import re
+import time
+from struct import pack
+
+from biliup.Danmaku.douyu import Douyu
+
+# (消息类型, 占比)，礼物与进场消息远多于弹幕
+MESSAGE_MIX = (
+    ('chatmsg', 0.25),
+    ('dgb', 0.3),
+    ('uenter', 0.3),
+    ('frank', 0.1),
+    ('noble_num_info', 0.05),
+)
+
+
+def stt_escape(value: str) -> str:
+    return value.replace('@', '@A').replace('/', '@S')
+
+
+def stt_dumps(fields: dict) -> str:
+    """序列化为 STT，嵌套结构序列化后整体转义"""
+    return ''.join(f'{k}@={stt_escape(v if isinstance(v, str) else stt_dumps(v))}/' for k, v in fields.items())
+
+
+def make_message(msg_type: str, i: int) -> dict:
+    """生成与线上结构相近的消息"""
+    common = {'type': msg_type, 'rid': '9999', 'uid': str(10000 + i), 'nn': f'用户{i}', 'level': '30',
+              'ic': 'avatar_v3@S202301@S1234567890abcdef', 'nl': '0', 'sahf': '0'}
+    if msg_type == 'chatmsg':
+        return {**common, 'txt': f'弹幕内容/{i}@', 'cid': f'{i:032x}', 'col': str(i % 7), 'ct': '14',
+                'bnn': '粉丝牌', 'bl': '12', 'brid': '9999', 'hc': 'abcdef', 'el': {'eid': '1', 'etp': '1'},
+                'dms': '5', 'pdg': '45', 'pdk': '83', 'ext': ''}
+    if msg_type == 'dgb':
+        return {**common, 'gfid': '824', 'gs': '0', 'gfcnt': '1', 'hits': str(i % 100), 'bcnt': '1',
+                'bst': '2', 'ct': '0', 'el': {'eid': '1500000005', 'etp': '1', 'sc': '1'}, 'fc': '0',
+                'bnn': '粉丝牌', 'bl': '12', 'brid': '9999', 'hc': 'abcdef'}
+    if msg_type == 'uenter':
+        return {**common, 'str': '0', 'rni': '0', 'el': {'eid': '1', 'etp': '1'}, 'wgei': '0', 'crw': '0',
+                'fl': '3', 'ceid': '0', 'cid': ''}
+    return {'type': msg_type, 'rid': '9999', 'list': {f'uid{n}': str(n) for n in range(10)}, 'ts': str(i)}
+
+
+def make_frames(count: int, batch: int) -> list:
+    """生成 count 个数据帧，每帧包含 batch 条消息"""
+    rng = random.Random(0)
+    types = [t for t, _ in MESSAGE_MIX]
+    weights = [w for _, w in MESSAGE_MIX]
+    frames = []
+    for n in range(count):
+        frame = b''
+        for i in range(batch):
+            body = stt_dumps(make_message(rng.choices(types, weights)[0], n * batch + i)).encode('utf-8') + b'\x00'
+            frame += pack('<iiHBB', len(body) + 8, len(body) + 8, 690, 0, 0) + body
+        frames.append(frame)
+    return frames
+
+
+def legacy_decode_msg(data):
+    """改写前的解码：正则切分后递归解析所有消息"""
+    def stt_loads(stt_str):
+        if '/' in stt_str:
+            stt_items = stt_str.split('/')
+            stt_list = []
+            stt_dict = {}
+            for stt_item in stt_items:
+                if stt_item == '':
+                    continue
+                stt_item_decode = stt_loads(stt_item)
+                if type(stt_item_decode) is dict:
+                    stt_dict.update(stt_item_decode)
+                else:
+                    stt_list.append(stt_item_decode)
+            if len(stt_list) > 0:
+                return stt_list
+            else:
+                return stt_dict
+        elif '@=' in stt_str:
+            key, value = stt_str.split('@=')
+            return {stt_loads(key): stt_loads(value)}
+        else:
+            return stt_str.replace("@A", "@").replace('@S', '/')
+
+    msgs = []
+    for msg in re.findall(b'(type@=.*?)\x00', data):
+        msg = stt_loads(msg.decode('utf-8'))
+        if type(msg) is dict:
+            msgs.append({
+                'name': msg.get('nn', ''),
+                'content': msg.get('txt', ''),
+                'msg_type': {
+                    'dgb': 'gift',
+                    'chatmsg': 'danmaku',
+                    'uenter': 'enter'
+                }.get(msg['type'], 'other'),
+                'color': Douyu.msg_col.get(msg.get('col')),
+            })
+    return msgs
+
+
+def bench(decode, frames: list, batch: int, repeat: int) -> float:
+    """返回每秒处理的消息数，取多次中最快的一次"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in frames:
+            decode(frame)
+        best = min(best, time.perf_counter() - start)
+    return len(frames) * batch / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='斗鱼弹幕解码基准测试')
+    parser.add_argument('--frames', type=int, default=5000, help='数据帧数')
+    parser.add_argument('--batch', type=int, default=10, help='每帧的消息数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数')
+    args = parser.parse_args()
+
+    frames = make_frames(args.frames, args.batch)
+    # 两种解码得到的弹幕须一致
+    fields = ('name', 'content', 'color')
+    legacy = [tuple(m[k] for k in fields) for f in frames for m in legacy_decode_msg(f) if m['msg_type'] == 'danmaku']
+    current = [tuple(m[k] for k in fields) for f in frames for m in Douyu.decode_msg(f)]
+    assert legacy == current, '解码结果不一致'
+    before = bench(legacy_decode_msg, frames, args.batch, args.repeat)
+    after = bench(Douyu.decode_msg, frames, args.batch, args.repeat)
+    print(f'before {before:>10.0f} msg/s  after {after:>10.0f} msg/s  x{after / before:.2f}')
+
+
+if __name__ == '__main__':
+    main()
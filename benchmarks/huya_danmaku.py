@@ -0,0 +1,166 @@
+"""
+虎牙弹幕解码基准测试
+按直播间常见的消息构成生成 TARS 数据帧，比较旧的 tarscore 整体解码与当前只读取所需字段的解码每秒处理的消息数
+
+用法:
+    python benchmarks/huya_danmaku.py --frames 20000
+"""
+import argparse
+import random
+import time
+
+from biliup.Danmaku.huya import Huya
+from biliup.Danmaku.tars import tarscore
+
+# (推送消息类型, 占比)，礼物与贵宾进场广播多于弹幕，其余为非推送的命令回复
+MESSAGE_MIX = (
+    (1400, 0.35),
+    (6501, 0.3),
+    (6210, 0.15),
+    (None, 0.2),
+)
+
+STRINGS = tarscore.vctclass(tarscore.string)
+COUNTS = tarscore.mapclass(tarscore.string, tarscore.int32)
+
+
+class SenderInfo(tarscore.struct):
+    def __init__(self, uid: int, name: str):
+        self.uid = uid
+        self.name = name
+
+    @staticmethod
+    def writeTo(oos, value):
+        oos.write(tarscore.int64, 0, value.uid)
+        oos.write(tarscore.int64, 1, value.uid % 1000)
+        oos.write(tarscore.string, 2, value.name)
+        oos.write(tarscore.int32, 3, value.uid % 2)
+        oos.write(tarscore.string, 4, f'https://huyaimg.msstatic.com/avatar/{value.uid}.jpg')
+        badges = STRINGS()
+        badges.extend(['fans', 'noble'])
+        oos.write(STRINGS, 5, badges)
+
+
+class BulletFormat(tarscore.struct):
+    def __init__(self, color: int):
+        self.color = color
+
+    @staticmethod
+    def writeTo(oos, value):
+        oos.write(tarscore.int32, 0, value.color)
+        oos.write(tarscore.int32, 1, 4)
+        oos.write(tarscore.int32, 2, 0)
+        oos.write(tarscore.int32, 3, 1)
+
+
+# 虎牙消息中的字符串均按 utf-8 编码，tarscore 写入非 ASCII 字符串时长度有误，这里只使用 ASCII
+def make_payload(cmd: int, i: int) -> bytes:
+    """生成与线上结构相近的消息正文"""
+    oos = tarscore.TarsOutputStream()
+    if cmd == 1400:
+        oos.write(SenderInfo, 0, SenderInfo(10000 + i, f'user{i}'))
+        oos.write(tarscore.int64, 1, 1199000000 + i)
+        oos.write(tarscore.int64, 2, 1199000000 + i)
+        oos.write(tarscore.string, 3, f'danmaku content {i}')
+        oos.write(tarscore.int32, 4, 0)
+        oos.write(tarscore.int32, 5, 0)
+        oos.write(BulletFormat, 6, BulletFormat(-1 if i % 3 else 0xFF00FF))
+    else:
+        oos.write(tarscore.int64, 0, 10000 + i)
+        oos.write(tarscore.string, 1, f'user{i}')
+        oos.write(tarscore.int32, 2, 20 + i % 10)
+        oos.write(tarscore.int32, 3, i % 99)
+        counts = COUNTS()
+        counts.update({'combo': i % 10, 'level': i % 50, 'price': 100})
+        oos.write(COUNTS, 4, counts)
+        oos.write(tarscore.string, 5, f'https://huyaimg.msstatic.com/gift/{i}.png')
+    return oos.getBuffer()
+
+
+def make_frames(count: int) -> list:
+    """生成 count 个数据帧，虎牙每帧只有一条消息"""
+    rng = random.Random(0)
+    cmds = [c for c, _ in MESSAGE_MIX]
+    weights = [w for _, w in MESSAGE_MIX]
+    frames = []
+    for i in range(count):
+        cmd = rng.choices(cmds, weights)[0]
+        command = tarscore.TarsOutputStream()
+        if cmd is None:
+            # 非推送消息，例如心跳回复
+            command.write(tarscore.int32, 0, 6)
+            command.write(tarscore.bytes, 1, make_payload(0, i))
+        else:
+            push = tarscore.TarsOutputStream()
+            push.write(tarscore.int64, 0, 0)
+            push.write(tarscore.int64, 1, cmd)
+            push.write(tarscore.bytes, 2, make_payload(cmd, i))
+            push.write(tarscore.int32, 3, 0)
+            command.write(tarscore.int32, 0, 7)
+            command.write(tarscore.bytes, 1, push.getBuffer())
+        frames.append(command.getBuffer())
+    return frames
+
+
+def legacy_decode_msg(data):
+    """改写前的解码：使用 tarscore 逐层解码"""
+    class User(tarscore.struct):
+        @staticmethod
+        def readFrom(ios):
+            return ios.read(tarscore.string, 2, False).decode("utf8")
+
+    class DColor(tarscore.struct):
+        @staticmethod
+        def readFrom(ios):
+            return ios.read(tarscore.int32, 0, False)
+
+    name = ""
+    content = ""
+    color = 16777215
+    msgs = []
+    ios = tarscore.TarsInputStream(data)
+    if ios.read(tarscore.int32, 0, False) == 7:
+        ios = tarscore.TarsInputStream(ios.read(tarscore.bytes, 1, False))
+        if ios.read(tarscore.int64, 1, False) == 1400:
+            ios = tarscore.TarsInputStream(ios.read(tarscore.bytes, 2, False))
+            name = ios.read(User, 0, False)  # username
+            content = ios.read(tarscore.string, 3, False).decode("utf8")  # content
+            color = ios.read(DColor, 6, False)  # danmaku color
+            if color == -1:
+                color = 16777215
+    if name != "":
+        msg = {"name": name, "color": f"{color}", "content": content, "msg_type": "danmaku"}
+        msgs.append(msg)
+    return msgs
+
+
+def bench(decode, frames: list, repeat: int) -> float:
+    """返回每秒处理的消息数，取多次中最快的一次"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in frames:
+            decode(frame)
+        best = min(best, time.perf_counter() - start)
+    return len(frames) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='虎牙弹幕解码基准测试')
+    parser.add_argument('--frames', type=int, default=20000, help='数据帧数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数')
+    args = parser.parse_args()
+
+    frames = make_frames(args.frames)
+    # 两种解码得到的弹幕须一致
+    legacy = [m for f in frames for m in legacy_decode_msg(f)]
+    current = [m for f in frames for m in Huya.decode_msg(f)]
+    assert legacy, '没有生成弹幕'
+    assert legacy == current, '解码结果不一致'
+    before = bench(legacy_decode_msg, frames, args.repeat)
+    after = bench(Huya.decode_msg, frames, args.repeat)
+    print(f'before {before:>10.0f} msg/s  after {after:>10.0f} msg/s  x{after / before:.2f}')
+
+
+if __name__ == '__main__':
+    main()
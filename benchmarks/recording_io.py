@@ -0,0 +1,139 @@
+"""
+录制写入策略基准测试
+模拟多个录制同时按直播码率小块写入，比较不同写入策略下单次写入的延迟与系统脏页峰值
+
+用法:
+    python benchmarks/recording_io.py --dir /mnt/disk1/bench --recorders 30 --bitrate 6 --duration 60
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from biliup.common.timer import Timer
+from biliup.config import config
+from biliup.engine.iopolicy import IOPolicy
+from biliup.engine.metrics import RecordingMetrics, recording_metrics
+
+# (名称, 写入缓冲区大小, 落盘间隔, 是否释放页缓存)
+# 缓冲区为 0 时每个数据包直接写入，与 ffmpeg 默认逐包刷新相同
+POLICIES = (
+    ('default', 0, 0, False),
+    ('buffered', 64 * 1024, 0, False),
+    ('sync', 64 * 1024, 5, False),
+    ('sync+drop', 64 * 1024, 5, True),
+)
+# 写入超过此时间视为卡顿，单位：秒
+SLOW_WRITE = 0.1
+
+
+def dirty_bytes() -> int:
+    """系统中尚未落盘的脏页大小，仅 Linux 可用"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('Dirty:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def record(path: str, bitrate: float, packet: int, buffering: int, stop: threading.Event, latencies: list):
+    """按码率写入数据包，记录每次写入的耗时"""
+    data = os.urandom(packet)
+    written = 0
+    start = time.monotonic()
+    with open(path, 'wb', buffering=buffering) as f:
+        while not stop.is_set():
+            # 补齐按码率应写入的数据，之后短暂等待
+            due = bitrate / 8 * (time.monotonic() - start)
+            while written < due and not stop.is_set():
+                t = time.perf_counter()
+                f.write(data)
+                latencies.append(time.perf_counter() - t)
+                written += packet
+            stop.wait(0.01)
+
+
+def run(directory: str, recorders: int, bitrate: float, packet: int, duration: float, policy: tuple) -> dict:
+    name, buffering, sync_interval, drop_cache = policy
+    config.data['io_sync_interval'] = sync_interval
+    config.data['io_drop_cache'] = drop_cache
+    io_policy = IOPolicy()
+    stop = threading.Event()
+    latencies = [[] for _ in range(recorders)]
+    paths = [os.path.join(directory, f'{name}_{i}.ts') for i in range(recorders)]
+    metrics = []
+    threads = []
+    for i, path in enumerate(paths):
+        # 与录制相同，由录制指标提供正在写入的文件
+        open(path, 'wb').close()
+        m = RecordingMetrics(f'bench{i}', f'bench://{name}/{i}')
+        m.writing(path)
+        recording_metrics.register(m)
+        metrics.append(m)
+        threads.append(threading.Thread(target=record, args=(path, bitrate, packet, buffering, stop, latencies[i]),
+                                        daemon=True))
+    syncer = Timer(func=io_policy.sync_all, interval=sync_interval) if sync_interval else None
+    for t in threads:
+        t.start()
+    if syncer:
+        syncer.start()
+    peak_dirty = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        peak_dirty = max(peak_dirty, dirty_bytes())
+        time.sleep(0.5)
+    stop.set()
+    for t in threads:
+        t.join()
+    if syncer:
+        syncer.stop()
+    for m in metrics:
+        recording_metrics.unregister(m)
+    for path in paths:
+        io_policy.finish(path)
+        os.remove(path)
+    samples = sorted(x for lat in latencies for x in lat)
+    return {
+        'policy': name,
+        'writes': len(samples),
+        'p50_ms': statistics.median(samples) * 1000,
+        'p99_ms': samples[int(len(samples) * 0.99)] * 1000,
+        'max_ms': samples[-1] * 1000,
+        'slow_writes': sum(1 for x in samples if x > SLOW_WRITE),
+        'peak_dirty_mb': peak_dirty / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='录制写入策略基准测试')
+    parser.add_argument('--dir', help='写入目录，应位于待测磁盘上，默认为临时目录')
+    parser.add_argument('--recorders', type=int, default=30, help='同时录制数')
+    parser.add_argument('--bitrate', type=float, default=6, help='每个录制的码率，单位：Mbps')
+    parser.add_argument('--packet', type=int, default=188 * 7, help='每次写入的大小，单位：Byte')
+    parser.add_argument('--duration', type=float, default=60, help='每种策略的测试时间，单位：秒')
+    parser.add_argument('--policy', action='append', choices=[p[0] for p in POLICIES], help='只测试指定策略')
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix='biliup-io-')
+    os.makedirs(directory, exist_ok=True)
+    policies = [p for p in POLICIES if not args.policy or p[0] in args.policy]
+    print(f'{args.recorders} 个录制 x {args.bitrate}Mbps，每次写入 {args.packet}B，目录 {directory}')
+    print(f'{"policy":<10} {"writes":>9} {"p50(ms)":>8} {"p99(ms)":>8} {"max(ms)":>8} {"slow":>6} {"dirty(MB)":>10}')
+    try:
+        for policy in policies:
+            r = run(directory, args.recorders, args.bitrate * 1000 * 1000, args.packet, args.duration, policy)
+            print(f'{r["policy"]:<10} {r["writes"]:>9} {r["p50_ms"]:>8.3f} {r["p99_ms"]:>8.3f} '
+                  f'{r["max_ms"]:>8.1f} {r["slow_writes"]:>6} {r["peak_dirty_mb"]:>10.1f}')
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
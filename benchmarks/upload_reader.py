@@ -0,0 +1,146 @@
+"""
+分块上传读取基准测试
+在本地启动模拟上传节点的 HTTP 服务，比较旧的在上传协程中直接读取文件与当前 ChunkReader 预读的上传吞吐量，
+以及上传期间事件循环的最大延迟
+
+用法:
+    python benchmarks/upload_reader.py --size 512 --chunk 10 --tasks 3 8 16
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from biliup.plugins.bili_webup import BiliBili
+
+
+async def start_server(latency: float) -> web.AppRunner:
+    """模拟上传节点，读取完整请求体，每个请求额外等待 latency 秒模拟网络往返"""
+    async def put(request):
+        await request.read()
+        await asyncio.sleep(latency)
+        return web.Response(text='MULTIPART_PUT_SUCCESS')
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_put('/upload', put)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    return runner
+
+
+def server_url(runner: web.AppRunner) -> str:
+    host, port = runner.addresses[0][:2]
+    return f'http://{host}:{port}/upload'
+
+
+def drop_cache(path: str):
+    """使文件不在页缓存中，读取时需读盘，仅 Linux 可用"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    with open(path, 'rb') as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+async def legacy_upload(params, file, chunk_size, afunc, tasks, session):
+    """改写前的上传：每个上传协程在事件循环中直接读取下一个分块"""
+    params['chunk'] = -1
+
+    async def upload_chunk():
+        while True:
+            chunks_data = file.read(chunk_size)
+            if not chunks_data:
+                return
+            params['chunk'] += 1
+            params['size'] = len(chunks_data)
+            params['partNumber'] = params['chunk'] + 1
+            params['start'] = params['chunk'] * chunk_size
+            params['end'] = params['start'] + params['size']
+            await afunc(session, chunks_data, params.copy())
+
+    await asyncio.gather(*[upload_chunk() for _ in range(tasks)])
+
+
+async def current_upload(params, file, chunk_size, afunc, tasks, session):
+    await BiliBili._upload(params, file, chunk_size, afunc, tasks=tasks, session=session)
+
+
+async def monitor_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """事件循环的最大延迟，即计划唤醒与实际唤醒的最大差值"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def run(upload, path: str, chunk_size: int, tasks: int, url: str) -> tuple:
+    """返回 (吞吐量 MB/s, 事件循环最大延迟 ms)"""
+    total_size = os.path.getsize(path)
+
+    async def afunc(session, chunks_data, params):
+        async with session.put(url, params={'partNumber': params['partNumber']}, data=chunks_data,
+                               raise_for_status=True):
+            pass
+
+    drop_cache(path)
+    stop = asyncio.Event()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        lag = asyncio.create_task(monitor_lag(stop))
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            await upload({'uploadId': 'bench', 'total': total_size}, f, chunk_size, afunc, tasks, session)
+        cost = time.perf_counter() - start
+        stop.set()
+        worst = await lag
+    return total_size / 1000 / 1000 / cost, worst * 1000
+
+
+async def bench(args):
+    runner = await start_server(args.latency / 1000)
+    url = server_url(runner)
+    directory = args.dir or tempfile.gettempdir()
+    path = os.path.join(directory, 'biliup-upload-bench.bin')
+    chunk_size = int(args.chunk * 1024 * 1024)
+    try:
+        with open(path, 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 * 1024))
+            f.flush()
+            os.fsync(f.fileno())
+        print(f'文件 {args.size}MB，分块 {args.chunk}MB，模拟往返 {args.latency}ms')
+        print(f'{"tasks":>5} {"before(MB/s)":>13} {"lag(ms)":>8} {"after(MB/s)":>12} {"lag(ms)":>8}')
+        for tasks in args.tasks:
+            results = []
+            for upload in (legacy_upload, current_upload):
+                best = (0.0, 0.0)
+                for _ in range(args.repeat):
+                    best = max(best, await run(upload, path, chunk_size, tasks, url))
+                results.append(best)
+            (before, before_lag), (after, after_lag) = results
+            print(f'{tasks:>5} {before:>13.1f} {before_lag:>8.1f} {after:>12.1f} {after_lag:>8.1f}')
+    finally:
+        await runner.cleanup()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分块上传读取基准测试')
+    parser.add_argument('--dir', help='测试文件目录，应位于待测磁盘上，默认为临时目录')
+    parser.add_argument('--size', type=int, default=512, help='测试文件大小，单位：MB')
+    parser.add_argument('--chunk', type=float, default=10, help='分块大小，单位：MB')
+    parser.add_argument('--latency', type=float, default=20, help='每个请求模拟的网络往返，单位：毫秒')
+    parser.add_argument('--tasks', type=int, nargs='+', default=[3, 8, 16], help='同时上传的分块数')
+    parser.add_argument('--repeat', type=int, default=3, help='重复次数')
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,31 +4,43 @@
 # 仅抓取用户弹幕，不包括入场提醒、礼物赠送等。
 
 import asyncio
+import functools
+import inspect
 import logging
 import os
 import re
-import ssl
 import threading
 import time
 from abc import ABC, abstractmethod
-from typing import Optional
+from concurrent.futures import Future
+from typing import Callable, Optional
 
 import aiohttp
-import lxml.etree as etree
 
+from biliup.common.backoff import Backoff
+from biliup.config import config
+from biliup.Danmaku.archive import BinaryDanmakuWriter, to_xml
 from biliup.Danmaku.bilibili import Bilibili
+from biliup.Danmaku.buffer import DanmakuBuffer
 from biliup.Danmaku.douyin import Douyin
 from biliup.Danmaku.douyu import Douyu
+from biliup.Danmaku.highlight import HighlightDetector
+from biliup.Danmaku.hub import danmaku_hub
 from biliup.Danmaku.huya import Huya
+from biliup.Danmaku.runtime import danmaku_runtime
 from biliup.Danmaku.twitcasting import Twitcasting
 from biliup.Danmaku.twitch import Twitch
+from biliup.Danmaku.writer import XmlDanmakuWriter
 
 logger = logging.getLogger('biliup')
 
+# 弹幕暂缓写入的时间，单位：秒，需大于录制分段到保存请求到达弹幕事件循环的延迟
+SAVE_DELAY = 1
+
 
 class IDanmakuClient(ABC):
     @abstractmethod
-    def start(self):
+    def start(self, start_time: Optional[float] = None):
         pass
 
     @abstractmethod
@@ -36,7 +48,7 @@ class IDanmakuClient(ABC):
         pass
 
     @abstractmethod
-    def save(self, file_name: Optional[str] = None):
+    def save(self, file_name: Optional[str] = None, start_time: Optional[float] = None) -> Optional[Future]:
         pass
 
 
@@ -51,11 +63,18 @@ class DanmakuClient(IDanmakuClient):
         self.__fmt_file_name = None
         self.__url = ''
         self.__site = None
-        self.__hs = None
         self.__ws = None
-        self.__dm_queue: Optional[asyncio.Queue] = None
+        self.__dm_buffer: Optional[DanmakuBuffer] = None
+        # 已提示过的丢弃弹幕数
+        self.__reported_dropped = 0
         self.__record_task: Optional[asyncio.Task] = None
         self.__print_task: Optional[asyncio.Task] = None
+        # 当前分段的开始时间，由录制提供
+        self.__start_time: Optional[float] = None
+        # 弹幕连接中断的开始时间
+        self.__gap_start: Optional[float] = None
+        # 弹幕连接中断结束时的回调，参数为中断的开始与结束时间
+        self.on_gap: Optional[Callable[[float, float], None]] = None
 
         if 'http://' == url[:7] or 'https://' == url[:8]:
             self.__url = url
@@ -77,12 +96,20 @@ class DanmakuClient(IDanmakuClient):
             # 抛出异常由外部处理 exit()会导致进程退出
             raise Exception(f"{DanmakuClient.__name__}:{self.__url}: 不支持录制弹幕")
 
+        # 二进制弹幕日志，分段保存时再转换为 xml
+        self.__binary_log = config.get('danmaku_binary_log', False)
+        # 高能片段检测，检测结果实时发布给订阅者
+        self.__highlight = config.get('highlight')
+        self.__decode_msg = self.__site.decode_msg
+        if self.__binary_log and 'record_gifts' in inspect.signature(self.__site.decode_msg).parameters:
+            # 按客户端开启礼物解析，不影响同一站点的其他录制
+            self.__decode_msg = functools.partial(self.__site.decode_msg, record_gifts=True)
+
     async def __init_ws(self):
         try:
             ws_url, reg_datas = await self.__site.get_ws_info(self.__url, self.__content)
-            ctx = ssl.create_default_context()
-            ctx.set_ciphers('DEFAULT')
-            self.__ws = await self.__hs.ws_connect(ws_url, ssl_context=ctx, headers=getattr(self.__site, 'headers', {}))
+            self.__ws = await danmaku_runtime.session.ws_connect(ws_url, ssl_context=danmaku_runtime.ssl_context,
+                                                                 headers=getattr(self.__site, 'headers', {}))
             for reg_data in reg_datas:
                 if type(reg_data) == str:
                     await self.__ws.send_str(reg_data)
@@ -115,7 +142,7 @@ class DanmakuClient(IDanmakuClient):
                 raise self.WebsocketErrorException()
 
             try:
-                result = self.__site.decode_msg(msg.data)
+                result = self.__decode_msg(msg.data)
 
                 if isinstance(result, tuple):
                     ms, ack = result
@@ -128,8 +155,10 @@ class DanmakuClient(IDanmakuClient):
                 else:
                     ms = result
 
-                for m in ms:
-                    await self.__dm_queue.put(m)
+                # 整批放入缓冲区，由写入任务批量取出
+                self.__dm_buffer.put_danmaku(ms)
+                # 发布给实时订阅者
+                danmaku_hub.publish(self.__url, ms)
             except asyncio.CancelledError:
                 raise
             except:
@@ -139,136 +168,288 @@ class DanmakuClient(IDanmakuClient):
                 # 这里出现异常只会是 decode_msg 的问题
 
     async def __print_danmaku(self):
-        def write_file(filename):
+        def close_writer():
             try:
-                if filename and msg_i > 0:
-                    tree.write(filename, encoding="UTF-8", xml_declaration=True, pretty_print=True)
+                writer.close()
+                if archive is not None:
+                    archive.close()
             except:
                 logger.warning(f"{DanmakuClient.__name__}:{self.__url}: 弹幕写入异常", exc_info=True)
 
+        def write_gap(gap_start: float, gap_end: float):
+            # 只记录落在当前分段内的部分
+            gap_start = max(gap_start, start_time)
+            if gap_end <= gap_start:
+                return
+            try:
+                if archive is not None:
+                    archive.add_gap(gap_start - start_time, gap_end - start_time)
+                else:
+                    writer.add_gap(format(gap_start - start_time, '.3f'), format(gap_end - start_time, '.3f'))
+            except:
+                logger.warning(f"{DanmakuClient.__name__}:{self.__url}: 弹幕写入异常", exc_info=True)
+
+        def write(danmaku: list):
+            for recv_time, dm in danmaku:
+                if archive is not None:
+                    try:
+                        archive.append(recv_time - start_time, dm)
+                    except:
+                        logger.warning(f"{DanmakuClient.__name__}:{self.__url}:弹幕处理异常", exc_info=True)
+                    continue
+                if dm.get('msg_type') != 'danmaku':
+                    continue
+                try:
+                    if dm.get('color'):
+                        color = dm["color"]
+                    else:
+                        color = '16777215'
+                    msg_time = format(max(recv_time - start_time, 0), '.3f')
+                    # 缓存达到条数时追加写入文件
+                    # 可能会写入失败 会在下次写入或者任务被取消时重新尝试写入
+                    writer.append(msg_time, color, dm["content"])
+                except:
+                    logger.warning(f"{DanmakuClient.__name__}:{self.__url}:弹幕处理异常", exc_info=True)
+                    # 异常后略过本次弹幕
+                    continue
+
+            # 按间隔写入缓存的弹幕
+            try:
+                writer.tick()
+                if archive is not None:
+                    archive.tick()
+            except:
+                logger.warning(f"{DanmakuClient.__name__}:{self.__url}: 弹幕写入异常", exc_info=True)
+
+        def save(file_name: Optional[str]) -> str:
+            # 更名前写入剩余弹幕并关闭文件
+            close_writer()
+            if archive is not None and archive.count:
+                # 由弹幕日志生成 xml
+                try:
+                    to_xml(archive.file_name, fmt_file_name)
+                except:
+                    logger.exception(f"{DanmakuClient.__name__}:{self.__url}: 弹幕日志转换 xml 失败")
+            if file_name is None or fmt_file_name == file_name:
+                return fmt_file_name
+            if archive is not None and archive.count:
+                self.__rename(archive.file_name, os.path.splitext(file_name)[0] + '.dm')
+            try:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+                if os.path.exists(fmt_file_name):
+                    os.rename(fmt_file_name, file_name)
+                    logger.info(f"{DanmakuClient.__name__}:{self.__url}: 更名 {fmt_file_name} 为 {file_name}")
+            except:
+                logger.exception(f"{DanmakuClient.__name__}:{self.__url}: 更名 {fmt_file_name} 为 {file_name}失败")
+            return file_name
+
+        def discard():
+            close_writer()
+            for file_name in (fmt_file_name, archive and archive.file_name):
+                try:
+                    if file_name and os.path.exists(file_name):
+                        os.remove(file_name)
+                except:
+                    pass
+
+        # 所有房间共用弹幕事件循环，文件读写在线程池中执行，避免磁盘慢时阻塞其他房间的弹幕接收
+        loop = asyncio.get_running_loop()
+        # 进行中的文件操作，任务被取消时需等待其完成后才能关闭文件
+        io: Optional[asyncio.Future] = None
+
+        async def run_io(func, *args):
+            nonlocal io
+            io = loop.run_in_executor(None, func, *args)
+            return await asyncio.shield(io)
+
+        start_time = self.__start_time or time.time()
+        # 暂缓写入的弹幕，保存请求晚于分段时间到达，期间接收的弹幕需按分段时间划分
+        pending = []
         while True:
-            root = etree.Element("i")
-            etree.indent(root, "\t")
-            tree = etree.ElementTree(root, parser=etree.XMLParser(recover=True))
-            start_time = time.time()
             fmt_file_name = time.strftime(self.__file_name.encode("unicode-escape").decode()).encode().decode(
                 "unicode-escape") + '.xml'
-            msg_i = 0
+            writer = XmlDanmakuWriter(fmt_file_name)
+            archive = BinaryDanmakuWriter(fmt_file_name[:-4] + '.dm', start_time) if self.__binary_log else None
+            detector = HighlightDetector.from_config(self.__highlight) if self.__highlight is not None else None
             try:
                 while True:
-                    try:
-                        # 无弹幕时更快分段结束
-                        m = await asyncio.wait_for(self.__dm_queue.get(), timeout=1)
-                    except asyncio.TimeoutError:
+                    # 无弹幕时更快分段结束
+                    danmaku, m = await self.__dm_buffer.get(timeout=1)
+                    pending.extend(danmaku)
+                    if m is not None and m.get('msg_type') == 'save' and m.get('start_time'):
+                        # 按录制提供的分段时间划分弹幕，分段后接收的弹幕写入下一分段
+                        boundary = m['start_time']
+                    elif m is not None:
+                        boundary = float('inf')
+                    else:
+                        boundary = time.time() - SAVE_DELAY
+                    danmaku = [d for d in pending if d[0] < boundary]
+                    pending = [d for d in pending if d[0] >= boundary]
+
+                    if detector is not None:
+                        for recv_time, dm in danmaku:
+                            if dm.get('msg_type') == 'danmaku':
+                                self.__detect(detector, max(recv_time - start_time, 0), fmt_file_name)
+                    await run_io(write, danmaku)
+
+                    if m is None:
                         continue
 
                     logger.debug(f"{DanmakuClient.__name__}:{self.__url}: 弹幕queue-{m.get('msg_type')}")
-                    if m.get('msg_type') == "save":
-                        if 'file_name' in m and fmt_file_name != m['file_name']:
-                            try:
-                                if os.path.exists(m['file_name']):
-                                    os.remove(m['file_name'])
-                                if os.path.exists(fmt_file_name):
-                                    os.rename(fmt_file_name, m.get('file_name'))
-                                    logger.info(
-                                        f"{DanmakuClient.__name__}:{self.__url}: 更名 {fmt_file_name} 为 {m['file_name']}")
-                            except:
-                                logger.exception(
-                                    f"{DanmakuClient.__name__}:{self.__url}: 更名 {fmt_file_name} 为 {m['file_name']}失败")
-                            fmt_file_name = m['file_name']
-
-                        if callable(m.get('callback')):
-                            m['callback']()
+                    if m.get('msg_type') == "gap":
+                        await run_io(write_gap, m['start'], m['end'])
+                    elif m.get('msg_type') == "save":
+                        self.__report_dropped()
+                        if self.__gap_start is not None:
+                            # 中断仍在继续，当前分段记录到分段结束
+                            await run_io(write_gap, self.__gap_start, m.get('start_time') or time.time())
+                        fmt_file_name = await run_io(save, m.get('file_name'))
+
+                        start_time = m.get('start_time') or time.time()
+                        m['future'].set_result(fmt_file_name)
                         break
                     elif m.get('msg_type') == "stop":
-                        try:
-                            os.remove(fmt_file_name)
-                        except:
-                            pass
+                        self.__report_dropped()
+                        await run_io(discard)
                         fmt_file_name = None
                         self.__record_task.cancel()
                         return
-                    elif m.get('msg_type') == 'danmaku':
-                        try:
-                            if m.get('color'):
-                                color = m["color"]
-                            else:
-                                color = '16777215'
-                            msg_time = format(time.time() - start_time, '.3f')
-                            d = etree.SubElement(root, 'd')
-                            d.set('p', f"{msg_time},1,25,{color},0,0,0,0")
-                            d.text = m["content"]
-                        except:
-                            logger.warning(f"{DanmakuClient.__name__}:{self.__url}:弹幕处理异常", exc_info=True)
-                            # 异常后略过本次弹幕
-                            continue
-
-                        msg_i += 1
-                        if msg_i % 5 == 0:
-                            # 每收到五条弹幕后写入 减少io
-                            # 可能会写入失败 会在下次五条或者任务被取消时重新尝试写入
-                            write_file(fmt_file_name)
             finally:
                 # 发生异常(被取消)时写入 避免丢失未写入
-                write_file(fmt_file_name)
-
-    def start(self):
+                if io is not None and not io.done():
+                    await asyncio.wait([io])
+                await run_io(close_writer)
+
+    def __detect(self, detector: HighlightDetector, msg_time: float, file_name: str):
+        interval = detector.feed(msg_time)
+        if interval is not None:
+            logger.info(f"{DanmakuClient.__name__}:{self.__url}: 高能片段 {interval[0]:.0f}s - {interval[1]:.0f}s")
+            danmaku_hub.publish(self.__url, [{
+                'msg_type': 'highlight',
+                'file_name': file_name,
+                'start': interval[0],
+                'end': interval[1],
+            }])
+
+    def __rename(self, old_file_name: str, file_name: str):
+        try:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            os.rename(old_file_name, file_name)
+            logger.info(f"{DanmakuClient.__name__}:{self.__url}: 更名 {old_file_name} 为 {file_name}")
+        except:
+            logger.exception(f"{DanmakuClient.__name__}:{self.__url}: 更名 {old_file_name} 为 {file_name}失败")
+
+    def __report_dropped(self):
+        dropped = self.__dm_buffer.dropped - self.__reported_dropped
+        if dropped > 0:
+            logger.warning(f"{DanmakuClient.__name__}:{self.__url}: 弹幕写入不及时，已丢弃 {dropped} 条弹幕")
+            self.__reported_dropped = self.__dm_buffer.dropped
+
+    @property
+    def dropped(self) -> int:
+        """因写入不及时丢弃的弹幕数"""
+        return self.__dm_buffer.dropped if self.__dm_buffer else 0
+
+    def start(self, start_time: Optional[float] = None):
+        """
+        :param start_time: 第一个分段的开始时间，弹幕时间相对此时间计算，为空时使用当前时间
+        """
+        self.__start_time = start_time
         init_event = threading.Event()
 
         async def __init():
             logger.info(f'开始弹幕录制: {self.__url}')
+            # 在启动完成前创建缓冲区，save 与 stop 可能在录制任务运行前调用
+            self.__dm_buffer = DanmakuBuffer(config.get('danmaku_queue_size', 10000))
             self.__record_task = asyncio.create_task(self.__run())
             init_event.set()
+            danmaku_hub.add_room(self.__url)
             try:
                 await self.__record_task
             except asyncio.CancelledError:
                 pass
+            finally:
+                danmaku_hub.remove_room(self.__url)
+                # 录制结束后未处理的保存请求不再等待
+                for m in self.__dm_buffer.drain_control():
+                    if 'future' in m and not m['future'].done():
+                        m['future'].set_result(None)
             self.__record_task = None
             logger.info(f'结束弹幕录制: {self.__url}')
 
-        threading.Thread(target=asyncio.run, args=(__init(),)).start()
+        # 所有弹幕客户端运行在同一个事件循环中
+        danmaku_runtime.submit(__init())
         # 等待初始化完成避免未初始化完成的时候就停止任务
         init_event.wait()
 
-    def save(self, file_name: Optional[str] = None):
+    def save(self, file_name: Optional[str] = None, start_time: Optional[float] = None) -> Optional[Future]:
+        """
+        保存当前分段的弹幕，不等待写入完成
+        :param file_name: 弹幕文件名
+        :param start_time: 下一分段的开始时间，此时间之前接收的弹幕写入当前分段，为空时以处理保存请求的时间分段
+        :return: 弹幕文件写入并更名完成后返回文件名的 Future
+        """
         if self.__record_task:
             logger.debug(f"{DanmakuClient.__name__}:{self.__url}: 弹幕save")
-            init_event = threading.Event()
-            self.__dm_queue.put_nowait({
+            future = Future()
+            danmaku_runtime.call_soon(self.__dm_buffer.put_control, {
                 "msg_type": "save",
                 "file_name": file_name,
-                "callback": lambda: init_event.set()
+                "start_time": start_time,
+                "future": future,
             })
-            init_event.wait()
+            return future
+        return None
 
     def stop(self):
         if self.__record_task:
             logger.debug(f"{DanmakuClient.__name__}:{self.__url}: 弹幕stop")
-            self.__dm_queue.put_nowait({
+            danmaku_runtime.call_soon(self.__dm_buffer.put_control, {
                 "msg_type": "stop",
             })
 
+    def __gap_end(self):
+        """弹幕连接恢复，记录中断区间"""
+        if self.__gap_start is None:
+            return
+        gap_start, self.__gap_start = self.__gap_start, None
+        gap_end = time.time()
+        logger.info(f"{DanmakuClient.__name__}:{self.__url}: 弹幕连接已恢复，中断 {gap_end - gap_start:.1f} 秒")
+        self.__dm_buffer.put_control({
+            "msg_type": "gap",
+            "start": gap_start,
+            "end": gap_end,
+        })
+        if self.on_gap is not None:
+            try:
+                self.on_gap(gap_start, gap_end)
+            except:
+                logger.exception(f"{DanmakuClient.__name__}:{self.__url}: 弹幕中断回调异常")
+
     async def __run(self):
+        # 第一次立即重连，之后指数退避，在关闭之前一直重试
+        backoff = Backoff(cap=config.get('danmaku_reconnect_max', 30))
         try:
-            self.__dm_queue = asyncio.Queue()
-            self.__hs = aiohttp.ClientSession()
             self.__print_task = asyncio.create_task(self.__print_danmaku())
             while True:
                 danmaku_tasks = []
+                connected_at = None
                 try:
                     await self.__init_ws()
+                    connected_at = time.monotonic()
+                    self.__gap_end()
                     danmaku_tasks = [asyncio.create_task(self.__heartbeats()),
                                      asyncio.create_task(self.__fetch_danmaku())]
                     await asyncio.gather(*danmaku_tasks)
                 except asyncio.CancelledError:
                     raise
                 except self.WebsocketErrorException:
-                    # 连接断开等30秒重连
-                    # 在关闭之前一直重试
-                    logger.warning(f"{DanmakuClient.__name__}:{self.__url}: 弹幕连接异常,将在 30 秒后重试")
+                    logger.warning(f"{DanmakuClient.__name__}:{self.__url}: 弹幕连接异常")
                 except:
                     # 记录异常不到外部处理
-                    logger.exception(f"{DanmakuClient.__name__}:{self.__url}: 弹幕异常,将在 30 秒后重试")
+                    logger.exception(f"{DanmakuClient.__name__}:{self.__url}: 弹幕异常")
                 finally:
                     if danmaku_tasks:
                         for danmaku_task in danmaku_tasks:
@@ -276,13 +457,19 @@ class DanmakuClient(IDanmakuClient):
                         await asyncio.wait(danmaku_tasks)
                     if self.__ws is not None and not self.__ws.closed:
                         await self.__ws.close()
-                await asyncio.sleep(30)
+                if self.__gap_start is None:
+                    self.__gap_start = time.time()
+                # 连接保持时间超过退避上限时视为已恢复正常
+                if connected_at is not None and time.monotonic() - connected_at > backoff.cap:
+                    backoff.reset()
+                delay = backoff.next()
+                logger.info(f"{DanmakuClient.__name__}:{self.__url}: 将在 {delay:.1f} 秒后重连弹幕")
+                await asyncio.sleep(delay)
         finally:
+            self.__gap_end()
             if self.__print_task:
                 self.__print_task.cancel()
                 await asyncio.wait([self.__print_task])
-            if self.__hs:
-                await self.__hs.close()
 
 # 虎牙直播：https://www.huya.com/lpl
 # 斗鱼直播：https://www.douyu.com/9999
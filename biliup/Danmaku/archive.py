@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import time
+from struct import Struct
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from biliup.Danmaku.writer import XmlDanmakuWriter
+
+logger = logging.getLogger('biliup')
+
+# 二进制弹幕日志
+# 文件头: 魔数 版本 分段开始时间
+# 记录:   时间(ms) 类型 颜色 用户名长度 内容长度 附加信息长度 用户名 内容 附加信息(json)
+# 文件尾: 时间索引 [(时间(ms), 偏移)...] 索引偏移 索引条数 魔数，正常关闭时写入
+MAGIC = b'BDMK'
+INDEX_MAGIC = b'BDMI'
+VERSION = 1
+FILE_HEADER = Struct('<4sBd')
+RECORD_HEADER = Struct('<IBIHII')
+INDEX_ENTRY = Struct('<IQ')
+FILE_FOOTER = Struct('<QI4s')
+# 时间索引间隔，单位：毫秒
+INDEX_INTERVAL = 10 * 1000
+
+# gap 为弹幕连接中断，记录时间为中断的结束时间，附加信息中记录中断的开始时间，保证记录按时间顺序写入
+MSG_TYPES = ('danmaku', 'interactive_danmaku', 'gift', 'superchat', 'other', 'gap')
+_MSG_TYPE_CODES = {t: i for i, t in enumerate(MSG_TYPES)}
+
+
+class DanmakuRecord(NamedTuple):
+    # 相对分段开始的时间，单位：秒
+    time: float
+    msg_type: str
+    color: int
+    name: str
+    content: str
+    extra: Optional[dict]
+
+
+class BinaryDanmakuWriter:
+    """
+    追加写入的二进制弹幕日志
+    每条消息一条定长头加变长数据的记录，保留礼物、醒目留言等 xml 中没有的消息，
+    关闭时在文件末尾写入时间索引，用于按时间范围读取
+    """
+
+    def __init__(self, file_name: str, start_time: float, flush_interval: float = 5):
+        self.file_name = file_name
+        self.start_time = start_time
+        self.flush_interval = flush_interval
+        self.count = 0
+        self._file = None
+        self._index: List[Tuple[int, int]] = []
+        self._last_flush = time.monotonic()
+
+    def _open(self):
+        self._file = open(self.file_name, 'wb', buffering=64 * 1024)
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION, self.start_time))
+
+    def append(self, msg_time: float, msg: dict):
+        """添加一条消息，msg_time 为相对分段开始的时间，单位：秒"""
+        if self._file is None:
+            # 无消息时不创建文件
+            self._open()
+        ms = max(int(msg_time * 1000), 0)
+        if not self._index or ms - self._index[-1][0] >= INDEX_INTERVAL:
+            self._index.append((ms, self._file.tell()))
+        try:
+            color = int(msg.get('color') or 16777215)
+        except (TypeError, ValueError):
+            color = 16777215
+        name = str(msg.get('name') or '').encode('utf-8')[:0xFFFF]
+        content = msg.get('content', '')
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)
+        content = content.encode('utf-8')
+        extra = msg.get('extra')
+        extra = json.dumps(extra, ensure_ascii=False, separators=(',', ':')).encode('utf-8') if extra else b''
+        msg_type = _MSG_TYPE_CODES.get(msg.get('msg_type'), _MSG_TYPE_CODES['other'])
+        self._file.write(RECORD_HEADER.pack(ms, msg_type, color & 0xFFFFFFFF, len(name), len(content), len(extra)))
+        self._file.write(name)
+        self._file.write(content)
+        self._file.write(extra)
+        self.count += 1
+
+    def add_gap(self, start: float, end: float):
+        """记录弹幕连接中断的时间范围，单位：秒"""
+        # 中断结束时才能写入，记录在结束时间处以保持记录有序
+        self.append(end, {'msg_type': 'gap', 'extra': {'start': round(start, 3)}})
+
+    def tick(self):
+        """按时间间隔写入文件"""
+        if self._file is not None and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        """写入时间索引并关闭文件"""
+        if self._file is None:
+            return
+        try:
+            index_offset = self._file.tell()
+            for entry in self._index:
+                self._file.write(INDEX_ENTRY.pack(*entry))
+            self._file.write(FILE_FOOTER.pack(index_offset, len(self._index), INDEX_MAGIC))
+        finally:
+            self._file.close()
+            self._file = None
+
+
+def _read_index(f, size: int) -> Tuple[Optional[List[Tuple[int, int]]], int]:
+    """读取时间索引，返回 (索引, 记录结束位置)，文件未正常关闭时索引为 None"""
+    if size >= FILE_HEADER.size + FILE_FOOTER.size:
+        f.seek(size - FILE_FOOTER.size)
+        index_offset, count, magic = FILE_FOOTER.unpack(f.read(FILE_FOOTER.size))
+        if magic == INDEX_MAGIC and index_offset + count * INDEX_ENTRY.size + FILE_FOOTER.size == size:
+            f.seek(index_offset)
+            data = f.read(count * INDEX_ENTRY.size)
+            return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(count)], index_offset
+    return None, size
+
+
+def read_window(file_name: str, start: float = 0, end: Optional[float] = None) -> Iterator[DanmakuRecord]:
+    """
+    读取时间范围内的消息
+    :param start: 开始时间，相对分段开始，单位：秒
+    :param end: 结束时间，为空时读取到文件末尾
+    """
+    start_ms = int(start * 1000)
+    end_ms = None if end is None else int(end * 1000)
+    with open(file_name, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        magic, version, _ = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{file_name} 不是弹幕日志')
+        index, records_end = _read_index(f, size)
+        offset = FILE_HEADER.size
+        if index:
+            # 从开始时间之前最近的索引处读取
+            for ms, pos in index:
+                if ms > start_ms:
+                    break
+                offset = pos
+        f.seek(offset)
+        while offset + RECORD_HEADER.size <= records_end:
+            header = f.read(RECORD_HEADER.size)
+            ms, msg_type, color, name_len, content_len, extra_len = RECORD_HEADER.unpack(header)
+            length = name_len + content_len + extra_len
+            offset += RECORD_HEADER.size + length
+            # 未正常关闭时最后一条记录可能不完整
+            if offset > records_end:
+                break
+            if end_ms is not None and ms > end_ms:
+                break
+            if ms < start_ms:
+                f.seek(length, os.SEEK_CUR)
+                continue
+            data = f.read(length)
+            extra = data[name_len + content_len:]
+            yield DanmakuRecord(
+                time=ms / 1000,
+                msg_type=MSG_TYPES[msg_type] if msg_type < len(MSG_TYPES) else 'other',
+                color=color,
+                name=data[:name_len].decode('utf-8', errors='replace'),
+                content=data[name_len:name_len + content_len].decode('utf-8', errors='replace'),
+                extra=json.loads(extra) if extra else None,
+            )
+
+
+def start_time_of(file_name: str) -> float:
+    """弹幕日志对应分段的开始时间"""
+    with open(file_name, 'rb') as f:
+        magic, version, start_time = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f'{file_name} 不是弹幕日志')
+    return start_time
+
+
+def merge_archive(dst: str, src: str, offset: float):
+    """
+    将 src 中的消息时间平移 offset 秒后追加到 dst，dst 不存在时平移后写入 dst，成功后删除 src
+    日志末尾为时间索引，不能直接追加，写入临时文件后替换 dst
+    """
+    def shift(record: DanmakuRecord) -> DanmakuRecord:
+        extra = record.extra
+        if record.msg_type == 'gap' and extra and 'start' in extra:
+            extra = {**extra, 'start': round(extra['start'] + offset, 3)}
+        return record._replace(time=record.time + offset, extra=extra)
+
+    if os.path.exists(dst):
+        start_time = start_time_of(dst)
+        records = list(read_window(dst))
+    else:
+        start_time = start_time_of(src) - offset
+        records = []
+    records.extend(shift(r) for r in read_window(src))
+    tmp = dst + '.tmp'
+    writer = BinaryDanmakuWriter(tmp, start_time)
+    try:
+        try:
+            for record in records:
+                writer.append(record.time, {'msg_type': record.msg_type, 'color': record.color, 'name': record.name,
+                                            'content': record.content, 'extra': record.extra})
+        finally:
+            writer.close()
+        os.replace(tmp, dst)
+    except:
+        # 失败时保留原日志
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.remove(src)
+
+
+def to_xml(file_name: str, xml_file_name: str) -> int:
+    """将弹幕日志中的弹幕转换为 xml，返回弹幕条数"""
+    writer = XmlDanmakuWriter(xml_file_name, flush_count=1000)
+    try:
+        for record in read_window(file_name):
+            if record.msg_type == 'danmaku':
+                writer.append(format(record.time, '.3f'), record.color, record.content)
+            elif record.msg_type == 'gap' and record.extra:
+                writer.add_gap(format(record.extra['start'], '.3f'), format(record.time, '.3f'))
+    finally:
+        writer.close()
+    return writer.count
@@ -1,7 +1,9 @@
 import json
 import logging
+import re
 import zlib
-from struct import pack, unpack
+from struct import Struct, pack
+from typing import Iterator, Optional, Tuple
 
 import aiohttp
 import brotli
@@ -11,6 +13,14 @@ from biliup.plugins import random_user_agent
 
 logger = logging.getLogger('biliup')
 
+# 数据包头：包长度、头部长度、协议版本、操作码、序列号
+PACKET_HEADER = Struct('!IHHII')
+# 读取 cmd 时查找的正文长度，cmd 位于正文开头
+CMD_SNIFF_SIZE = 64
+CMD_PATTERN = re.compile(rb'"cmd"\s*:\s*"([^"]*)"')
+# 礼物与醒目留言
+GIFT_CMDS = (b'SEND_GIFT', b'SUPER_CHAT_MESSAGE')
+
 
 class Bilibili:
     heartbeat = b'\x00\x00\x00\x1f\x00\x10\x00\x01\x00\x00\x00\x02\x00\x00\x00\x01\x5b\x6f\x62\x6a\x65\x63\x74\x20' \
@@ -57,76 +67,94 @@ class Bilibili:
         return danmu_wss_url, reg_datas
 
     @staticmethod
-    def decode_msg(data):
-        msgs = []
-
-        def decode_packet(packet_data):
-            dm_list = []
-            while True:
-                try:
-                    packet_len, header_len, ver, op, seq = unpack('!IHHII', packet_data[0:16])
-                except Exception:
-                    break
-                if len(packet_data) < packet_len:
+    def iter_packets(data) -> Iterator[Tuple[int, memoryview]]:
+        """
+        迭代解析数据包，返回 (操作码, 正文)
+        正文为 memoryview，不复制数据；压缩包解压后按原顺序继续解析
+        """
+        # 待解析的 (数据, 偏移)
+        stack = [(memoryview(data), 0)]
+        while stack:
+            buf, offset = stack.pop()
+            size = len(buf)
+            while offset + PACKET_HEADER.size <= size:
+                packet_len, header_len, ver, op, _ = PACKET_HEADER.unpack_from(buf, offset)
+                end = offset + packet_len
+                if packet_len < header_len or end > size:
                     break
-
+                body = buf[offset + header_len:end]
+                offset = end
                 if ver == 2:
-                    dm_list.extend(decode_packet(zlib.decompress(packet_data[16:packet_len])))
+                    stack.append((buf, offset))
+                    stack.append((memoryview(zlib.decompress(body)), 0))
+                    break
                 elif ver == 3:
-                    dm_list.extend(decode_packet(brotli.decompress(packet_data[16:packet_len])))
+                    stack.append((buf, offset))
+                    stack.append((memoryview(brotli.decompress(bytes(body))), 0))
+                    break
                 elif ver == 0 or ver == 1:
-                    dm_list.append({
-                        'type': op,
-                        'body': packet_data[16:packet_len]
-                    })
+                    yield op, body
                 else:
                     break
 
-                if len(packet_data) == packet_len:
-                    break
-                else:
-                    packet_data = packet_data[packet_len:]
-            return dm_list
-
-        dm_list = decode_packet(data)
+    @staticmethod
+    def sniff_cmd(body: memoryview) -> Optional[bytes]:
+        """从正文开头读取 cmd，无需解析整个 json"""
+        match = CMD_PATTERN.search(bytes(body[:CMD_SNIFF_SIZE]))
+        return match.group(1) if match else None
 
-        for dm in dm_list:
+    @staticmethod
+    def decode_msg(data, record_gifts=False):
+        """
+        :param record_gifts: 是否解析礼物与醒目留言，写入二进制弹幕日志时开启
+        """
+        msgs = []
+        for op, body in Bilibili.iter_packets(data):
+            # 只处理通知消息，心跳回复等直接略过
+            if op != 5:
+                continue
             try:
-                msg = {}
-                if dm.get('type') == 5:
-                    j = json.loads(dm.get('body'))
-                    msg['msg_type'] = {
-                        'SEND_GIFT': 'gift',
-                        'DANMU_MSG': 'danmaku',
-                        'WELCOME': 'enter',
-                        'NOTICE_MSG': 'broadcast',
-                        'LIVE_INTERACTIVE_GAME': 'interactive_danmaku'  # 新增互动弹幕，经测试与弹幕内容一致
-                    }.get(j.get('cmd'), 'other')
-                    # 2021-06-03 bilibili 字段更新, 形如 DANMU_MSG:4:0:2:2:2:0
-                    if msg.get('msg_type', 'UNKNOWN').startswith('DANMU_MSG'):
-                        msg['msg_type'] = 'danmaku'
-
-                    if msg['msg_type'] == 'danmaku':
-                        msg['name'] = (j.get('info', ['', '', ['', '']])[2][1] or
-                                       j.get('data', {}).get('uname', ''))
-                        msg['content'] = j.get('info', ['', ''])[1]
-                        msg["color"] = f"{j.get('info', '16777215')[0][3]}"
-
-                    elif msg['msg_type'] == 'interactive_danmaku':
-                        msg['name'] = j.get('data', {}).get('uname', '')
-                        msg['content'] = j.get('data', {}).get('msg', '')
-                        msg["color"] = '16777215'
-
-                    elif msg['msg_type'] == 'broadcast':
-                        msg['type'] = j.get('msg_type', 0)
-                        msg['roomid'] = j.get('real_roomid', 0)
-                        msg['content'] = j.get('msg_common', '')
-                        msg['raw'] = j
-                    else:
-                        msg['content'] = j
-                else:
-                    msg = {'name': '', 'content': dm.get('body'), 'msg_type': 'other'}
-                msgs.append(msg)
+                cmd = Bilibili.sniff_cmd(body)
+                # 2021-06-03 bilibili 字段更新, 形如 DANMU_MSG:4:0:2:2:2:0
+                if cmd is not None and not cmd.startswith(b'DANMU_MSG') and cmd != b'LIVE_INTERACTIVE_GAME' \
+                        and not (record_gifts and cmd in GIFT_CMDS):
+                    continue
+                j = json.loads(bytes(body))
+                cmd = j.get('cmd', '')
+                # 未能从开头读取 cmd 时，解析后再按同样的条件过滤
+                if cmd.startswith('DANMU_MSG'):
+                    info = j.get('info', ['', '', ['', '']])
+                    msgs.append({
+                        'msg_type': 'danmaku',
+                        'name': info[2][1] or j.get('data', {}).get('uname', ''),
+                        'content': info[1],
+                        'color': f"{info[0][3]}",
+                    })
+                elif cmd == 'LIVE_INTERACTIVE_GAME':
+                    # 新增互动弹幕，经测试与弹幕内容一致
+                    msgs.append({
+                        'msg_type': 'interactive_danmaku',
+                        'name': j.get('data', {}).get('uname', ''),
+                        'content': j.get('data', {}).get('msg', ''),
+                        'color': '16777215',
+                    })
+                elif cmd == 'SEND_GIFT' and record_gifts:
+                    data = j.get('data', {})
+                    msgs.append({
+                        'msg_type': 'gift',
+                        'name': data.get('uname', ''),
+                        'content': data.get('giftName', ''),
+                        'extra': {'num': data.get('num'), 'price': data.get('price'),
+                                  'coin_type': data.get('coin_type')},
+                    })
+                elif cmd == 'SUPER_CHAT_MESSAGE' and record_gifts:
+                    data = j.get('data', {})
+                    msgs.append({
+                        'msg_type': 'superchat',
+                        'name': data.get('user_info', {}).get('uname', ''),
+                        'content': data.get('message', ''),
+                        'extra': {'price': data.get('price'), 'duration': data.get('time')},
+                    })
             except Exception as Error:
                 logger.warning(f"{Bilibili.__name__}: 弹幕接收异常 - {Error}")
         return msgs
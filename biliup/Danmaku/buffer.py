@@ -0,0 +1,54 @@
+import asyncio
+import time
+from collections import deque
+from typing import List, Optional, Tuple
+
+
+class DanmakuBuffer:
+    """
+    弹幕接收与写入之间的缓冲区，只在弹幕事件循环中使用
+    弹幕按批取出，缓冲区已满时丢弃最旧的弹幕并计数；save、stop 等控制消息不会被丢弃
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        # (接收时间, 弹幕)
+        self._danmaku = deque(maxlen=maxsize)
+        self._control = deque()
+        self._event = asyncio.Event()
+        # 因写入不及时丢弃的弹幕数
+        self.dropped = 0
+
+    def put_danmaku(self, msgs: List[dict]):
+        if not msgs:
+            return
+        now = time.time()
+        for m in msgs:
+            if len(self._danmaku) == self._danmaku.maxlen:
+                self.dropped += 1
+            self._danmaku.append((now, m))
+        self._event.set()
+
+    def put_control(self, msg: dict):
+        self._control.append(msg)
+        self._event.set()
+
+    async def get(self, timeout: float) -> Tuple[List[Tuple[float, dict]], Optional[dict]]:
+        """
+        取出所有已接收的弹幕及一条控制消息，缓冲区为空时最多等待 timeout 秒
+        """
+        if not self._danmaku and not self._control:
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        danmaku = list(self._danmaku)
+        self._danmaku.clear()
+        control = self._control.popleft() if self._control else None
+        return danmaku, control
+
+    def drain_control(self) -> List[dict]:
+        """取出所有未处理的控制消息"""
+        control = list(self._control)
+        self._control.clear()
+        return control
@@ -2,7 +2,8 @@
 # 2023.07.14：KNaiFen：这部分代码参考了https://github.com/SmallPeaches/DanmakuRender
 # 2024.06.22: 添加来自 https://github.com/hua0512/stream-rec 修改后的 webmssdk.js，以计算 signature
 
-import gzip
+import asyncio
+import zlib
 
 import aiohttp
 import json
@@ -10,11 +11,13 @@ from urllib.parse import unquote
 from biliup.config import config
 from .douyin_util.dy_pb2 import ChatMessage, PushFrame, Response
 from biliup.plugins import match1
-from google.protobuf import json_format
 import logging
 
 logger = logging.getLogger('biliup')
 
+# zlib 解压 gzip 格式数据时使用的 wbits
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 class Douyin:
     headers = {
         # 'user-agent': random_user_agent(),
@@ -30,9 +33,12 @@ class Douyin:
             from biliup.plugins.douyin import DouyinUtils
             from .douyin_util import DouyinDanmakuUtils
             Douyin.headers['user-agent'] = DouyinUtils.DOUYIN_USER_AGENT
+            # 获取 ttwid 与计算 signature 均为阻塞操作，在线程池中执行，避免阻塞所有房间共用的弹幕事件循环
+            loop = asyncio.get_running_loop()
 
             if "ttwid" not in Douyin.headers['Cookie']:
-                Douyin.headers['Cookie'] = f'ttwid={DouyinUtils.get_ttwid()};{Douyin.headers["Cookie"]}'
+                ttwid = await loop.run_in_executor(None, DouyinUtils.get_ttwid)
+                Douyin.headers['Cookie'] = f'ttwid={ttwid};{Douyin.headers["Cookie"]}'
 
             USER_UNIQUE_ID = DouyinDanmakuUtils.get_user_unique_id()
             VERSION_CODE = 180800 # https://lf-cdn-tos.bytescm.com/obj/static/webcast/douyin_live/7697.782665f8.js -> a.ry
@@ -53,7 +59,8 @@ class Douyin:
                 "ac": "",
                 "identity": "audience"
             }
-            signature = DouyinDanmakuUtils.get_signature(DouyinDanmakuUtils.get_x_ms_stub(sig_params))
+            signature = await loop.run_in_executor(
+                None, DouyinDanmakuUtils.get_signature, DouyinDanmakuUtils.get_x_ms_stub(sig_params))
             # logger.info(f"signature: {signature}")
             webcast5_params = {
                 "room_id": context['room_id'],
@@ -91,8 +98,12 @@ class Douyin:
     def decode_msg(data):
         wss_package = PushFrame()
         wss_package.ParseFromString(data)
+        # 心跳回复等没有消息内容
+        if not wss_package.payload:
+            return [], None
         log_id = wss_package.logId
-        decompressed = gzip.decompress(wss_package.payload)
+        # 直接以 gzip 格式解压，避免每条消息创建 GzipFile
+        decompressed = zlib.decompress(wss_package.payload, GZIP_WBITS)
         payload_package = Response()
         payload_package.ParseFromString(decompressed)
 
@@ -105,16 +116,16 @@ class Douyin:
             ack = obj.SerializeToString()
 
         msgs = []
+        chat_message = ChatMessage()
         for msg in payload_package.messagesList:
-            if msg.method == 'WebcastChatMessage':
-                chat_message = ChatMessage()
-                chat_message.ParseFromString(msg.payload)
-                data = json_format.MessageToDict(chat_message, preserving_proto_field_name=True)
-                # name = data['user']['nickName']
-                content = data['content']
-                # print(content)
-                # msg_dict = {"time": now, "name": name, "content": content, "msg_type": "danmaku", "color": "ffffff"}
-                msg_dict = {"content": content, "msg_type": "danmaku"}
-                msgs.append(msg_dict)
+            # 只解析弹幕消息，礼物、入场等消息不解析
+            if msg.method != 'WebcastChatMessage':
+                continue
+            chat_message.ParseFromString(msg.payload)
+            msgs.append({
+                "name": chat_message.user.nickName,
+                "content": chat_message.content,
+                "msg_type": "danmaku",
+            })
 
         return msgs, ack
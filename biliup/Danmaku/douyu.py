@@ -1,6 +1,6 @@
 import logging
-import re
 from struct import pack
+from typing import Dict
 
 import aiohttp
 
@@ -8,6 +8,9 @@ from biliup.plugins import match1
 
 logger = logging.getLogger('biliup')
 
+# 弹幕需要的 STT 字段
+STT_KEYS = frozenset((b'type', b'nn', b'txt', b'col'))
+
 
 class Douyu:
     wss_url = 'wss://danmuproxy.douyu.com:8506/'
@@ -34,45 +37,50 @@ class Douyu:
         return Douyu.wss_url, reg_datas
 
     @staticmethod
-    def decode_msg(data):
-        def stt_loads(stt_str):
-            if '/' in stt_str:
-                stt_items = stt_str.split('/')
-                stt_list = []
-                stt_dict = {}
-                for stt_item in stt_items:
-                    if stt_item == '':
-                        continue
-                    stt_item_decode = stt_loads(stt_item)
-                    if type(stt_item_decode) is dict:
-                        stt_dict.update(stt_item_decode)
-                    else:
-                        stt_list.append(stt_item_decode)
-                if len(stt_list) > 0:
-                    return stt_list
-                else:
-                    return stt_dict
-            elif '@=' in stt_str:
-                key, value = stt_str.split('@=')
-                return {stt_loads(key): stt_loads(value)}
-            else:
-                return stt_str.replace("@A", "@").replace('@S', '/')
+    def stt_fields(data: bytes, start: int, end: int, keys=STT_KEYS) -> Dict[bytes, str]:
+        """
+        单次扫描解析 data[start:end] 中的 STT 键值对，只解码 keys 中的键
+        嵌套结构在值中经过转义，不含 '/'，因此顶层可以直接按 '/' 分隔
+        """
+        fields = {}
+        i = start
+        while i < end:
+            sep = data.find(b'@=', i, end)
+            if sep < 0:
+                break
+            value_end = data.find(b'/', sep + 2, end)
+            if value_end < 0:
+                value_end = end
+            key = data[i:sep]
+            if key in keys:
+                value = data[sep + 2:value_end]
+                if b'@' in value:
+                    value = value.replace(b'@S', b'/').replace(b'@A', b'@')
+                fields[key] = value.decode('utf-8', errors='replace')
+            i = value_end + 1
+        return fields
 
+    @staticmethod
+    def decode_msg(data):
         msgs = []
-        for msg in re.findall(b'(type@=.*?)\x00', data):
+        # 每条消息以 type@= 开头，以 \x00 结尾
+        start = data.find(b'type@=')
+        while start >= 0:
+            end = data.find(b'\x00', start)
+            if end < 0:
+                break
             try:
-                msg = stt_loads(msg.decode('utf-8'))
-                if type(msg) is dict:
+                # 先读取消息类型，只解析弹幕消息
+                type_end = data.find(b'/', start + 6, end)
+                if data[start + 6:type_end if type_end >= 0 else end] == b'chatmsg':
+                    msg = Douyu.stt_fields(data, start, end)
                     msgs.append({
-                        'name': msg.get('nn', ''),
-                        'content': msg.get('txt', ''),
-                        'msg_type': {
-                            'dgb': 'gift',
-                            'chatmsg': 'danmaku',
-                            'uenter': 'enter'
-                        }.get(msg['type'], 'other'),
-                        'color': Douyu.msg_col.get(msg.get('col')),
+                        'name': msg.get(b'nn', ''),
+                        'content': msg.get(b'txt', ''),
+                        'msg_type': 'danmaku',
+                        'color': Douyu.msg_col.get(msg.get(b'col')),
                     })
             except:
                 logger.warning(f"{Douyu.__name__}: 弹幕接收异常", exc_info=True)
+            start = data.find(b'type@=', end)
         return msgs
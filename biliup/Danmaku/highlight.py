@@ -0,0 +1,207 @@
+import inspect
+import logging
+import math
+import os
+import subprocess
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger('biliup')
+
+# 默认的高能片段目录，位于视频所在目录下
+HIGHLIGHT_DIR = 'highlights'
+# 高能片段文件名为 视频文件名 + CLIP_INFIX + 序号
+CLIP_INFIX = '_highlight_'
+
+
+class HighlightDetector:
+    """
+    根据弹幕密度检测高能片段
+    按秒统计弹幕数，用指数滑动平均计算短时弹幕速率，再对短时速率计算长期基线（均值与方差），
+    每个窗口只保存常数个状态；短时速率高于基线 threshold 个标准差时视为高能
+    """
+
+    def __init__(self, window: float = 10, baseline: float = 300, threshold: float = 3.0, min_rate: float = 1.0,
+                 warmup: float = 60, pre_roll: float = 20, post_roll: float = 10, merge_gap: float = 30,
+                 min_duration: float = 15):
+        """
+        :param window: 短时速率的时间常数，单位：秒
+        :param baseline: 基线的时间常数，单位：秒
+        :param threshold: 高于基线的标准差倍数
+        :param min_rate: 视为高能的最低弹幕速率，条/秒
+        :param warmup: 开始检测前用于建立基线的时间，单位：秒
+        :param pre_roll: 片段向前扩展的时间，单位：秒
+        :param post_roll: 片段向后扩展的时间，单位：秒
+        :param merge_gap: 间隔小于此时间的片段合并，单位：秒
+        :param min_duration: 高能持续时间小于此时间的片段丢弃，单位：秒
+        """
+        self.threshold = threshold
+        self.min_rate = min_rate
+        self.warmup = warmup
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        self.merge_gap = merge_gap
+        self.min_duration = min_duration
+        self._alpha_short = 1 - math.exp(-1 / window)
+        self._alpha_long = 1 - math.exp(-1 / baseline)
+        # 短时速率
+        self.rate = 0.0
+        # 基线均值与方差
+        self.mean = 0.0
+        self.var = 0.0
+        # 当前统计的秒及其弹幕数
+        self._second: Optional[int] = None
+        self._count = 0
+        self._elapsed = 0
+        # 正在进行的高能片段开始时间
+        self._start: Optional[int] = None
+        self.intervals: List[Tuple[float, float]] = []
+
+    @classmethod
+    def from_config(cls, options: Optional[dict]) -> 'HighlightDetector':
+        """由配置创建，忽略无关的配置项"""
+        params = inspect.signature(cls).parameters
+        return cls(**{k: v for k, v in (options or {}).items() if k in params})
+
+    def feed(self, t: float, count: int = 1) -> Optional[Tuple[float, float]]:
+        """
+        输入一条弹幕的时间（相对分段开始，单位：秒），时间需递增
+        :param count: 该时间的弹幕条数，用于输入已按秒统计的弹幕数
+        :return: 本次结束的高能片段
+        """
+        second = int(t)
+        emitted = None
+        if self._second is None:
+            self._second = second
+        elif second > self._second:
+            emitted = self._advance(second)
+        self._count += count
+        return emitted
+
+    def _advance(self, second: int) -> Optional[Tuple[float, float]]:
+        emitted = self._step(self._count, self._second)
+        # 没有弹幕的秒数，超过基线时间常数后状态已基本衰减，不再逐秒计算
+        gap = second - self._second - 1
+        for i in range(min(gap, int(5 / self._alpha_long))):
+            emitted = self._step(0, self._second + 1 + i) or emitted
+        self._second = second
+        self._count = 0
+        return emitted
+
+    def _step(self, count: int, second: int) -> Optional[Tuple[float, float]]:
+        self._elapsed += 1
+        self.rate += self._alpha_short * (count - self.rate)
+        spike = (self._elapsed > self.warmup and self.rate >= self.min_rate
+                 and self.rate > self.mean + self.threshold * math.sqrt(self.var))
+        if not spike:
+            # 高能期间不更新基线，避免基线被拉高
+            diff = self.rate - self.mean
+            self.mean += self._alpha_long * diff
+            self.var = (1 - self._alpha_long) * (self.var + self._alpha_long * diff * diff)
+        if spike and self._start is None:
+            self._start = second
+        elif not spike and self._start is not None:
+            start, self._start = self._start, None
+            return self._emit(start, second)
+        return None
+
+    def _emit(self, start: int, end: int) -> Optional[Tuple[float, float]]:
+        if end - start < self.min_duration:
+            return None
+        interval = (max(start - self.pre_roll, 0), end + self.post_roll)
+        if self.intervals and interval[0] - self.intervals[-1][1] <= self.merge_gap:
+            interval = (self.intervals[-1][0], interval[1])
+            self.intervals[-1] = interval
+        else:
+            self.intervals.append(interval)
+        return interval
+
+    def close(self) -> List[Tuple[float, float]]:
+        """输入结束，返回所有高能片段"""
+        if self._second is not None:
+            self._step(self._count, self._second)
+            if self._start is not None:
+                self._emit(self._start, self._second + 1)
+                self._start = None
+            self._second = None
+            self._count = 0
+        return self.intervals
+
+
+def iter_xml_times(file_name: str) -> Iterable[float]:
+    """逐条读取弹幕 xml 中的时间"""
+    for _, elem in ElementTree.iterparse(file_name):
+        if elem.tag == 'd':
+            try:
+                yield float(elem.get('p', '').split(',')[0])
+            except ValueError:
+                pass
+            elem.clear()
+
+
+def detect_file(file_name: str, options: Optional[dict] = None) -> List[Tuple[float, float]]:
+    """回放弹幕 xml 检测高能片段"""
+    detector = HighlightDetector.from_config(options)
+    # xml 中的弹幕不保证按时间排列，按秒统计后再按时间输入，内存只与分段时长有关
+    buckets = Counter(int(t) for t in iter_xml_times(file_name))
+    for second in sorted(buckets):
+        detector.feed(second, buckets[second])
+    return detector.close()
+
+
+def highlight_dir(video: str) -> str:
+    """视频对应的默认高能片段目录"""
+    return os.path.join(os.path.dirname(video), HIGHLIGHT_DIR)
+
+
+def find_clips(video: str) -> List[str]:
+    """查找视频在默认目录中剪出的高能片段，按片段序号排列"""
+    directory = highlight_dir(video)
+    prefix = os.path.splitext(os.path.basename(video))[0] + CLIP_INFIX
+    clips = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                index = os.path.splitext(entry.name)[0][len(prefix):]
+                if entry.is_file() and entry.name.startswith(prefix) and index.isdigit():
+                    clips.append((int(index), entry.path))
+    except FileNotFoundError:
+        return []
+    return [path for _, path in sorted(clips)]
+
+
+def clip(video: str, intervals: List[Tuple[float, float]], output_dir: Optional[str] = None) -> List[str]:
+    """
+    使用 ffmpeg 流复制剪出高能片段
+    默认输出到视频所在目录下的 highlights 目录，不与录播分段混在一起，上传时作为额外分P追加在分段之后
+    """
+    if output_dir is None:
+        output_dir = highlight_dir(video)
+    os.makedirs(output_dir, exist_ok=True)
+    name, ext = os.path.splitext(os.path.basename(video))
+    clips = []
+    for i, (start, end) in enumerate(intervals):
+        output = os.path.join(output_dir, f'{name}{CLIP_INFIX}{i + 1}{ext}')
+        # 先写入临时文件，剪辑完成后再更名，避免上传时读到未完成的片段
+        temp = os.path.join(output_dir, f'{name}{CLIP_INFIX}{i + 1}.tmp{ext}')
+        args = ['ffmpeg', '-y', '-loglevel', 'error', '-ss', f'{start:.3f}', '-to', f'{end:.3f}', '-i', video,
+                '-c', 'copy', '-avoid_negative_ts', 'make_zero', temp]
+        try:
+            subprocess.run(args, stdin=subprocess.DEVNULL, check=True)
+            os.replace(temp, output)
+        except (subprocess.CalledProcessError, OSError):
+            logger.exception(f'剪辑高能片段失败: {output}')
+            continue
+        logger.info(f'剪辑高能片段 {start:.0f}s - {end:.0f}s: {output}')
+        clips.append(output)
+    return clips
+
+
+if __name__ == '__main__':
+    # 回放录制的弹幕文件，输出检测到的高能片段
+    import sys
+
+    for path in sys.argv[1:]:
+        for s, e in detect_file(path):
+            print(f'{path}\t{s:.0f}\t{e:.0f}')
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import List, Optional, Set
+
+logger = logging.getLogger('biliup')
+
+
+class Subscription:
+    """
+    一个订阅者，消息在订阅者自己的事件循环中放入有界缓冲区
+    缓冲区已满时丢弃最旧的消息，订阅者处理不及时不会影响弹幕录制
+    """
+
+    def __init__(self, url: Optional[str], maxsize: int, loop: asyncio.AbstractEventLoop):
+        self.url = url
+        self.loop = loop
+        self._messages = deque(maxlen=maxsize)
+        self._event = asyncio.Event()
+        # 因处理不及时丢弃的消息数
+        self.dropped = 0
+
+    def _push(self, msgs: List[dict]):
+        for m in msgs:
+            if len(self._messages) == self._messages.maxlen:
+                self.dropped += 1
+            self._messages.append(m)
+        self._event.set()
+
+    async def get(self, timeout: float) -> List[dict]:
+        """取出所有已收到的消息，无消息时最多等待 timeout 秒"""
+        if not self._messages:
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        msgs = list(self._messages)
+        self._messages.clear()
+        return msgs
+
+
+class DanmakuHub:
+    """
+    弹幕发布订阅
+    弹幕客户端接收到弹幕后发布，WebUI、外部脚本等订阅者可实时获取
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: Set[Subscription] = set()
+        # 正在录制弹幕的直播间
+        self._rooms: Set[str] = set()
+
+    def add_room(self, url: str):
+        with self._lock:
+            self._rooms.add(url)
+
+    def remove_room(self, url: str):
+        with self._lock:
+            self._rooms.discard(url)
+
+    def rooms(self) -> List[str]:
+        with self._lock:
+            return sorted(self._rooms)
+
+    def subscribe(self, url: Optional[str] = None, maxsize: int = 1000) -> Subscription:
+        """
+        订阅弹幕，需在订阅者的事件循环中调用
+        :param url: 直播间地址，为空时订阅所有直播间
+        """
+        subscription = Subscription(url, maxsize, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, url: str, msgs: List[dict]):
+        """发布一批弹幕，可在任意线程调用"""
+        if not msgs or not self._subscriptions:
+            return
+        with self._lock:
+            subscriptions = [s for s in self._subscriptions if s.url is None or s.url == url]
+        if not subscriptions:
+            return
+        now = time.time()
+        payload = [{**m, 'url': url, 'time': now} for m in msgs]
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._push, payload)
+            except RuntimeError:
+                # 订阅者的事件循环已关闭
+                self.unsubscribe(subscription)
+
+
+danmaku_hub = DanmakuHub()
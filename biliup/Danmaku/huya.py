@@ -1,9 +1,22 @@
+from struct import Struct
+from typing import Optional
+
 import aiohttp
 from biliup.plugins import random_user_agent
 
 from .tars import tarscore
 from biliup.plugins import match1
 
+# TARS 字段类型
+TARS_INT8, TARS_INT16, TARS_INT32, TARS_INT64 = 0, 1, 2, 3
+TARS_FLOAT, TARS_DOUBLE = 4, 5
+TARS_STRING1, TARS_STRING4 = 6, 7
+TARS_MAP, TARS_LIST = 8, 9
+TARS_STRUCT_BEGIN, TARS_STRUCT_END = 10, 11
+TARS_ZERO, TARS_BYTES = 12, 13
+_INT32 = Struct('!i')
+_INT_FORMATS = {TARS_INT8: Struct('!b'), TARS_INT16: Struct('!h'), TARS_INT32: _INT32, TARS_INT64: Struct('!q')}
+
 
 class Huya:
     wss_url = 'wss://cdnws.api.huya.com/'
@@ -49,33 +62,157 @@ class Huya:
 
     @staticmethod
     def decode_msg(data):
-        class User(tarscore.struct):
-            @staticmethod
-            def readFrom(ios):
-                return ios.read(tarscore.string, 2, False).decode("utf8")
-
-        class DColor(tarscore.struct):
-            @staticmethod
-            def readFrom(ios):
-                return ios.read(tarscore.int32, 0, False)
-
+        msgs = []
+        # WebSocketCommand: 0 命令类型 1 数据
+        ios = TarsReader(data)
+        if ios.read_int(0) != 7:
+            return msgs
+        body = ios.read_bytes(1)
+        if body is None:
+            return msgs
+        # WSPushMessage: 1 消息类型 2 数据，只处理弹幕消息 1400
+        ios = TarsReader(body)
+        if ios.read_int(1) != 1400:
+            return msgs
+        payload = ios.read_bytes(2)
+        if payload is None:
+            return msgs
+        # MessageNotice: 0 用户 3 内容 6 弹幕格式
+        ios = TarsReader(payload)
         name = ""
-        content = ""
+        if ios.read_struct(0):
+            name = ios.read_string(2)  # username
+            ios.end_struct()
+        content = ios.read_string(3)  # content
         color = 16777215
-        msgs = []
-        ios = tarscore.TarsInputStream(data)
-        if ios.read(tarscore.int32, 0, False) == 7:
-            ios = tarscore.TarsInputStream(ios.read(tarscore.bytes, 1, False))
-            if ios.read(tarscore.int64, 1, False) == 1400:
-                ios = tarscore.TarsInputStream(ios.read(tarscore.bytes, 2, False))
-                name = ios.read(User, 0, False)  # username
-                content = ios.read(tarscore.string, 3, False).decode("utf8")  # content
-                color = ios.read(DColor, 6, False)  # danmaku color
-                if color == -1:
-                    color = 16777215
+        if ios.read_struct(6):
+            color = ios.read_int(0, -1)  # danmaku color
+            ios.end_struct()
+            if color == -1:
+                color = 16777215
         if name != "":
-            msg = {"name": name, "color": f"{color}", "content": content, "msg_type": "danmaku"}
-            # else:
-            #     msg = {"name": "", "content": "", "msg_type": "other"}
-            msgs.append(msg)
+            msgs.append({"name": name, "color": f"{color}", "content": content, "msg_type": "danmaku"})
         return msgs
+
+
+class TarsReader:
+    """
+    只读取需要字段的 TARS 解码器
+    在 memoryview 上按偏移读取，嵌套数据不复制；字段需按 tag 递增顺序读取
+    """
+    __slots__ = ('buf', 'pos', 'end')
+
+    def __init__(self, buf):
+        self.buf = buf if isinstance(buf, memoryview) else memoryview(buf)
+        self.pos = 0
+        self.end = len(self.buf)
+
+    def _head(self):
+        helper = self.buf[self.pos]
+        tag, vtype = helper >> 4, helper & 0x0F
+        if tag == 15:
+            return self.buf[self.pos + 1], vtype, 2
+        return tag, vtype, 1
+
+    def _read_value(self, vtype) -> int:
+        if vtype == TARS_ZERO:
+            return 0
+        fmt = _INT_FORMATS.get(vtype)
+        if fmt is None:
+            raise ValueError(f'TARS 整数类型错误: {vtype}')
+        value, = fmt.unpack_from(self.buf, self.pos)
+        self.pos += fmt.size
+        return value
+
+    def _read_size(self) -> int:
+        _, vtype, length = self._head()
+        self.pos += length
+        return self._read_value(vtype)
+
+    def _skip(self, vtype):
+        if vtype in _INT_FORMATS:
+            self.pos += _INT_FORMATS[vtype].size
+        elif vtype == TARS_FLOAT:
+            self.pos += 4
+        elif vtype == TARS_DOUBLE:
+            self.pos += 8
+        elif vtype == TARS_STRING1:
+            self.pos += self.buf[self.pos] + 1
+        elif vtype == TARS_STRING4:
+            self.pos += _INT32.unpack_from(self.buf, self.pos)[0] + 4
+        elif vtype == TARS_MAP or vtype == TARS_LIST:
+            size = self._read_size()
+            for _ in range(size * 2 if vtype == TARS_MAP else size):
+                _, item_type, length = self._head()
+                self.pos += length
+                self._skip(item_type)
+        elif vtype == TARS_BYTES:
+            self.pos += self._head()[2]
+            self.pos += self._read_size()
+        elif vtype == TARS_STRUCT_BEGIN:
+            self.end_struct()
+        elif vtype not in (TARS_STRUCT_END, TARS_ZERO):
+            raise ValueError(f'TARS 类型错误: {vtype}')
+
+    def _skip_to(self, tag) -> Optional[int]:
+        """跳到指定 tag 并读取字段头，返回字段类型，不存在时返回 None"""
+        while self.pos < self.end:
+            t, vtype, length = self._head()
+            if vtype == TARS_STRUCT_END or t > tag:
+                return None
+            self.pos += length
+            if t == tag:
+                return vtype
+            self._skip(vtype)
+        return None
+
+    def read_int(self, tag, default=None) -> Optional[int]:
+        vtype = self._skip_to(tag)
+        return default if vtype is None else self._read_value(vtype)
+
+    def read_string(self, tag, default="") -> str:
+        vtype = self._skip_to(tag)
+        if vtype is None:
+            return default
+        if vtype == TARS_STRING1:
+            size = self.buf[self.pos]
+            self.pos += 1
+        elif vtype == TARS_STRING4:
+            size, = _INT32.unpack_from(self.buf, self.pos)
+            self.pos += 4
+        else:
+            raise ValueError(f'TARS 字符串类型错误: {vtype}')
+        value = str(self.buf[self.pos:self.pos + size], 'utf-8', 'replace')
+        self.pos += size
+        return value
+
+    def read_bytes(self, tag) -> Optional[memoryview]:
+        vtype = self._skip_to(tag)
+        if vtype is None:
+            return None
+        if vtype != TARS_BYTES:
+            raise ValueError(f'TARS 字节类型错误: {vtype}')
+        # 元素类型头
+        self.pos += self._head()[2]
+        size = self._read_size()
+        value = self.buf[self.pos:self.pos + size]
+        self.pos += size
+        return value
+
+    def read_struct(self, tag) -> bool:
+        """进入结构体，读取完需要的字段后调用 end_struct"""
+        vtype = self._skip_to(tag)
+        if vtype is None:
+            return False
+        if vtype != TARS_STRUCT_BEGIN:
+            raise ValueError(f'TARS 结构体类型错误: {vtype}')
+        return True
+
+    def end_struct(self):
+        """跳过结构体剩余字段"""
+        while True:
+            _, vtype, length = self._head()
+            self.pos += length
+            if vtype == TARS_STRUCT_END:
+                return
+            self._skip(vtype)
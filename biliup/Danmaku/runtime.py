@@ -0,0 +1,51 @@
+import asyncio
+import logging
+import ssl
+import threading
+from concurrent.futures import Future
+from typing import Coroutine, Optional
+
+import aiohttp
+
+logger = logging.getLogger('biliup')
+
+
+class DanmakuRuntime:
+    """
+    所有弹幕客户端共享的运行环境
+    一个事件循环线程、一个连接池与一个 SSL 上下文，避免每个录制各自创建线程、事件循环与连接池
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.set_ciphers('DEFAULT')
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True, name='danmaku').start()
+        return self.loop
+
+    def submit(self, coro: Coroutine) -> Future:
+        """在弹幕事件循环中运行协程，可在任意线程调用"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def call_soon(self, callback, *args):
+        """在弹幕事件循环中执行回调，可在任意线程调用"""
+        self._ensure_loop().call_soon_threadsafe(callback, *args)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """共享的连接池，只能在弹幕事件循环中使用"""
+        if self._session is None or self._session.closed:
+            # websocket 为长连接，同一主机的多个房间各占一个连接，因此不限制单主机连接数
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, limit_per_host=0, ssl=self.ssl_context))
+        return self._session
+
+
+danmaku_runtime = DanmakuRuntime()
@@ -0,0 +1,80 @@
+import logging
+import os
+import re
+import time
+from typing import List
+from xml.sax.saxutils import escape, quoteattr
+
+logger = logging.getLogger('biliup')
+
+XML_HEADER = b"<?xml version='1.0' encoding='UTF-8'?>\n<i>\n"
+XML_TRAILER = b"</i>\n"
+# xml 1.0 不允许的控制字符
+_ILLEGAL_XML_CHARS = re.compile('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f\\ud800-\\udfff\\ufffe\\uffff]')
+
+
+class XmlDanmakuWriter:
+    """
+    追加写入的弹幕 xml 文件
+    弹幕先缓存在内存中，达到条数或间隔后追加到文件末尾；
+    文件始终以结尾标签结束，追加时从结尾标签处覆盖写入，写入量与弹幕数线性相关
+    """
+
+    def __init__(self, file_name: str, flush_count: int = 100, flush_interval: float = 5):
+        self.file_name = file_name
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        # 已写入的弹幕数
+        self.count = 0
+        self._file = None
+        # 结尾标签在文件中的位置
+        self._end = 0
+        self._pending: List[bytes] = []
+        self._last_flush = time.monotonic()
+
+    def append(self, msg_time: str, color, content: str):
+        """添加一条弹幕"""
+        p = f"{msg_time},1,25,{color},0,0,0,0"
+        content = _ILLEGAL_XML_CHARS.sub('', str(content))
+        self._pending.append(f'\t<d p={quoteattr(p)}>{escape(content)}</d>\n'.encode('utf-8'))
+        self.count += 1
+        if len(self._pending) >= self.flush_count:
+            self.flush()
+
+    def add_gap(self, start: str, end: str):
+        """记录弹幕连接中断的时间范围，此范围内的弹幕缺失"""
+        self._pending.append(f'\t<gap start={quoteattr(start)} end={quoteattr(end)}/>\n'.encode('utf-8'))
+        if len(self._pending) >= self.flush_count:
+            self.flush()
+
+    def tick(self):
+        """按时间间隔写入缓存的弹幕"""
+        if self._pending and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        if self._file is None:
+            # 无弹幕时不创建文件
+            self._file = open(self.file_name, 'wb')
+            self._file.write(XML_HEADER)
+            self._end = len(XML_HEADER)
+        data = b''.join(self._pending)
+        self._pending.clear()
+        self._file.seek(self._end)
+        self._file.write(data)
+        self._end += len(data)
+        self._file.write(XML_TRAILER)
+        self._file.truncate()
+        self._file.flush()
+
+    def close(self):
+        """写入剩余弹幕并关闭文件"""
+        try:
+            self.flush()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
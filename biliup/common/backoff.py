@@ -0,0 +1,36 @@
+import random
+
+
+class Backoff:
+    """
+    带随机抖动的指数退避
+    第一次重试立即进行，之后等待时间按倍数增长直到上限，并在一半到全部之间随机取值，
+    避免服务端重启时所有客户端同时重连
+    """
+
+    def __init__(self, base: float = 1, cap: float = 30, factor: float = 2, immediate: bool = True):
+        """
+        :param base: 第一次等待的时间，单位：秒
+        :param cap: 等待时间上限，单位：秒
+        :param factor: 每次等待时间增长的倍数
+        :param immediate: 第一次重试是否立即进行
+        """
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.immediate = immediate
+        # 连续失败次数
+        self.attempts = 0
+
+    def next(self) -> float:
+        """记录一次失败，返回下次重试前需等待的时间，单位：秒"""
+        self.attempts += 1
+        n = self.attempts - 1 if self.immediate else self.attempts
+        if n <= 0:
+            return 0
+        delay = min(self.cap, self.base * self.factor ** (n - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        """重试成功后重置"""
+        self.attempts = 0
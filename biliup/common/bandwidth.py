@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from biliup.config import config
+
+logger = logging.getLogger('biliup')
+
+# 录制占用较多带宽时，上传至少保留总带宽的比例，避免上传完全停止
+MIN_UPLOAD_SHARE = 0.05
+# 重新分配带宽的间隔，单位：秒
+REBALANCE_INTERVAL = 1
+
+
+class BandwidthFlow:
+    """
+    一个主播的令牌桶，同一主播的所有上传任务(分段上传与最终上传)共用
+    令牌可以透支，透支后按速率等待归还，分块较大时平均速率仍准确
+    """
+
+    def __init__(self, scheduler: 'BandwidthScheduler', key: str, weight: float):
+        self.scheduler = scheduler
+        self.key = key
+        self.weight = weight
+        # 分配到的速率，单位：字节/秒，0 为不限速
+        self.rate = 0.0
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        # 已上传的字节数
+        self.bytes = 0
+        # 使用此令牌桶的上传任务数
+        self.uploads = 0
+
+    async def acquire(self, size: int):
+        """上传 size 字节前调用，超出速率时等待"""
+        wait = self.scheduler.reserve(self, size)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def close(self):
+        self.scheduler.close(self)
+
+
+class BandwidthScheduler:
+    """
+    全局上传带宽调度
+    总带宽扣除录制占用（不少于预留值）后，按权重在正在上传的主播之间分配，每个主播一个令牌桶
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flows: Dict[str, BandwidthFlow] = {}
+        self._rebalanced = 0.0
+        # 上传与录制共用的总带宽，单位：Mbps，0 为不限速
+        self.bandwidth = 0.0
+        # 为录制预留的带宽，单位：Mbps
+        self.record_reserve = 0.0
+        # 各主播的带宽权重
+        self.weights: Dict[str, float] = {}
+        # 当前所有上传可用的速率，单位：字节/秒
+        self.upload_rate = 0.0
+        self._loaded = False
+
+    def load_config(self):
+        """从配置文件读取带宽限制，首次使用与保存配置时读取"""
+        self.set_limits(config.get('upload_bandwidth') or 0, config.get('record_bandwidth_reserve') or 0,
+                        config.get('upload_weights') or {})
+
+    def set_limits(self, bandwidth: Optional[float] = None, record_reserve: Optional[float] = None,
+                   weights: Optional[Dict[str, float]] = None):
+        """运行时调整带宽限制，参数为空时保持不变"""
+        with self._lock:
+            self._loaded = True
+            if bandwidth is not None:
+                self.bandwidth = max(float(bandwidth), 0)
+            if record_reserve is not None:
+                self.record_reserve = max(float(record_reserve), 0)
+            if weights is not None:
+                self.weights = {k: float(v) for k, v in weights.items() if float(v) > 0}
+            for flow in self._flows.values():
+                flow.weight = self.weights.get(flow.key, 1)
+            self._rebalance()
+
+    def open(self, key: str) -> BandwidthFlow:
+        """
+        开始一个上传任务，key 为主播名或账号，相同权重的 key 平分带宽
+        同一 key 同时进行的上传任务共用一个令牌桶，不会因任务数多而分到更多带宽
+        """
+        if not self._loaded:
+            self.load_config()
+        with self._lock:
+            flow = self._flows.get(key)
+            if flow is None:
+                flow = self._flows[key] = BandwidthFlow(self, key, self.weights.get(key, 1))
+                self._rebalance()
+            flow.uploads += 1
+        return flow
+
+    def close(self, flow: BandwidthFlow):
+        with self._lock:
+            flow.uploads -= 1
+            if flow.uploads <= 0 and self._flows.get(flow.key) is flow:
+                del self._flows[flow.key]
+                self._rebalance()
+
+    def reserve(self, flow: BandwidthFlow, size: int) -> float:
+        """取出 size 个令牌，返回需等待的时间，单位：秒"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._rebalanced >= REBALANCE_INTERVAL:
+                self._rebalance()
+            flow.bytes += size
+            if not flow.rate:
+                flow.tokens = 0
+                flow.last = now
+                return 0
+            # 最多积累一秒的令牌
+            flow.tokens = min(flow.tokens + (now - flow.last) * flow.rate, flow.rate)
+            flow.last = now
+            flow.tokens -= size
+            return -flow.tokens / flow.rate if flow.tokens < 0 else 0
+
+    def _recording_mbps(self) -> float:
+        from biliup.engine.metrics import recording_metrics
+        return sum(m['bitrate'] for m in recording_metrics.as_list()) / 1000 / 1000
+
+    def _rebalance(self):
+        """按录制占用与权重重新分配速率，需持有锁"""
+        self._rebalanced = time.monotonic()
+        if not self.bandwidth:
+            self.upload_rate = 0
+        else:
+            try:
+                recording = self._recording_mbps()
+            except Exception:
+                recording = 0
+            available = max(self.bandwidth - max(self.record_reserve, recording), self.bandwidth * MIN_UPLOAD_SHARE)
+            self.upload_rate = available * 1000 * 1000 / 8
+        total_weight = sum(flow.weight for flow in self._flows.values())
+        for flow in self._flows.values():
+            flow.rate = self.upload_rate * flow.weight / total_weight if self.upload_rate else 0
+
+    def status(self) -> dict:
+        if not self._loaded:
+            self.load_config()
+        with self._lock:
+            return {
+                'bandwidth': self.bandwidth,
+                'record_reserve': self.record_reserve,
+                'weights': self.weights,
+                'upload_rate': int(self.upload_rate * 8),
+                'flows': [{
+                    'key': flow.key,
+                    'weight': flow.weight,
+                    'rate': int(flow.rate * 8),
+                    'bytes': flow.bytes,
+                    'uploads': flow.uploads,
+                } for flow in self._flows.values()],
+            }
+
+
+bandwidth_scheduler = BandwidthScheduler()
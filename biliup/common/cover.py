@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, Optional
+
+from biliup.common.util import client, loop
+
+logger = logging.getLogger('biliup')
+
+# 封面缓存目录，以源地址的哈希命名
+CACHE_DIR = 'cover/cache'
+# 投稿封面宽高比 16:10
+COVER_RATIO = 1.6
+# 缓存保留时间，单位：秒
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# 图片转码与裁剪在线程池中进行，避免阻塞事件循环
+_executor = ThreadPoolExecutor(2, thread_name_prefix='cover')
+# 同一封面同时只获取一次
+_locks: Dict[str, asyncio.Lock] = {}
+# 持有或等待各锁的调用数，为 0 时才移除锁
+_lock_users: Dict[str, int] = {}
+
+
+def crop_to_ratio(im, ratio=COVER_RATIO):
+    """按宽高比居中裁剪图片"""
+    xsize, ysize = im.size
+    if xsize / ysize > ratio:
+        delta = xsize - ysize * ratio
+        return im.crop((delta / 2, 0, xsize - delta / 2, ysize))
+    delta = ysize - xsize / ratio
+    return im.crop((0, delta / 2, xsize, ysize - delta / 2))
+
+
+def is_prepared(im, ratio=COVER_RATIO) -> bool:
+    """是否已是可直接上传的封面（JPEG 且宽高比符合要求）"""
+    xsize, ysize = im.size
+    return im.format == 'JPEG' and abs(xsize / ysize - ratio) < 0.01
+
+
+def _convert(content: bytes, path: str):
+    """转为 JPEG 并裁剪为投稿封面比例"""
+    from PIL import Image
+
+    with Image.open(BytesIO(content)) as im:
+        region = crop_to_ratio(im.convert('RGB'))
+        tmp = f'{path}.tmp'
+        region.save(tmp, format='JPEG', quality=95)
+    os.replace(tmp, path)
+
+
+def _clean_cache():
+    """清理过期的缓存"""
+    deadline = time.time() - CACHE_TTL
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+async def afetch_cover(url: str, headers: Optional[dict] = None) -> str:
+    """
+    获取封面并转换为投稿封面，返回缓存文件路径
+    相同地址的封面只会下载和转码一次
+    """
+    key = hashlib.sha1(url.encode()).hexdigest()
+    path = os.path.join(CACHE_DIR, f'{key}.jpg')
+    lock = _locks.setdefault(key, asyncio.Lock())
+    _lock_users[key] = _lock_users.get(key, 0) + 1
+    try:
+        async with lock:
+            if os.path.exists(path):
+                # 更新修改时间，避免仍在使用的缓存被清理
+                os.utime(path)
+                return path
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            r = await client.get(url, headers=headers, timeout=30)
+            r.raise_for_status()
+            await loop.run_in_executor(_executor, _convert, r.content, path)
+            await loop.run_in_executor(_executor, _clean_cache)
+        return path
+    finally:
+        # 仍有等待者时保留锁，否则新的调用会创建另一把锁并重复下载
+        _lock_users[key] -= 1
+        if not _lock_users[key]:
+            del _lock_users[key]
+            _locks.pop(key, None)
+
+
+def prefetch_cover(url: str, headers: Optional[dict] = None):
+    """在事件循环中开始获取封面，返回 concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(afetch_cover(url, headers), loop)
+
+
+def link_cover(cache_path: str, path: str):
+    """将缓存的封面链接到目标路径，上传后删除目标文件不影响缓存"""
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(cache_path, path)
+    except OSError:
+        shutil.copyfile(cache_path, path)
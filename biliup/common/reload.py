@@ -77,8 +77,9 @@ class AutoReload(Timer):
 
     @staticmethod
     def _work_free():
-        # 获取当前目录下的所有文件名
-        fname_list = os.listdir('.')
+        from biliup.common.storage import iter_files
+        # 遍历存储目录下的文件名，找到录播文件即返回
+        fname_list = iter_files()
         # 如果存在指定扩展名的文件，则返回False
         if has_extension(fname_list, '.mp4', '.flv', '.3gp', '.webm', '.mkv', '.ts', '.part'):
             return False
@@ -0,0 +1,324 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from biliup.common.timer import Timer
+from biliup.config import config
+
+logger = logging.getLogger('biliup')
+
+# 存储布局
+# flat: 全部存放于运行目录（默认，与旧版本一致）
+# streamer: 按主播分目录 {storage_dir}/{streamer}/
+# date: 按主播及日期分目录 {storage_dir}/{streamer}/%Y-%m-%d/
+STORAGE_LAYOUTS = ('flat', 'streamer', 'date')
+MEDIA_EXTENSIONS = ('.mp4', '.flv', '.3gp', '.webm', '.mkv', '.ts')
+# 已知码率时，为每个录制预留此时长的写入量，单位：秒
+RESERVE_SECONDS = 600
+
+
+def storage_layout() -> str:
+    """获取当前配置的存储布局"""
+    layout = config.get('storage_layout', 'flat')
+    if layout not in STORAGE_LAYOUTS:
+        logger.warning(f'未知的存储布局 {layout}，使用 flat')
+        return 'flat'
+    return layout
+
+
+def storage_dirs() -> List[str]:
+    """获取配置的存储目录（卷）列表，未配置时为运行目录"""
+    dirs = config.get('storage_dirs') or ['.']
+    # 兼容字符串输入
+    if isinstance(dirs, str):
+        dirs = [dirs]
+    return [os.path.normpath(d) for d in dirs]
+
+
+def safe_dirname(name: str) -> str:
+    """将主播名转换为可用的目录名"""
+    s = re.sub(r'[\\/:*?"<>|]', '_', str(name)).strip()
+    if s in {"", ".", ".."}:
+        raise RuntimeError("Could not derive directory name from '%s'" % name)
+    return s
+
+
+def select_volume(name: str) -> str:
+    """
+    为主播选择存储卷
+    多个存储目录时按主播名散列，同一主播固定写入同一个卷，不同主播分散到不同磁盘
+    """
+    dirs = storage_dirs()
+    if len(dirs) == 1:
+        return dirs[0]
+    return dirs[zlib.crc32(name.encode('utf-8')) % len(dirs)]
+
+
+def streamer_dir(name: str, date: Optional[time.struct_time] = None, volume: Optional[str] = None) -> str:
+    """
+    获取主播录播文件的存放目录，不存在则创建
+    :param name: 主播名
+    :param date: 按日期分目录时使用的时间，默认为当前时间
+    :param volume: 指定存储卷，默认自动选择
+    """
+    if volume is None:
+        volume = select_volume(name)
+    layout = storage_layout()
+    if layout == 'flat':
+        path = volume
+    elif layout == 'streamer':
+        path = os.path.join(volume, safe_dirname(name))
+    else:
+        path = os.path.join(volume, safe_dirname(name), time.strftime('%Y-%m-%d', date or time.localtime()))
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    return path
+
+
+def scan_dirs(name: Optional[str] = None) -> List[str]:
+    """
+    需要扫描的目录列表
+    :param name: 主播名，为空时返回所有主播的目录
+    """
+    layout = storage_layout()
+    result = []
+    for volume in storage_dirs():
+        if not os.path.isdir(volume):
+            continue
+        # 存储卷根目录始终扫描，兼容切换布局前遗留的文件
+        result.append(volume)
+        if layout == 'flat':
+            continue
+        names = [name] if name is not None else list(config.get('streamers', {}).keys())
+        for n in names:
+            try:
+                sub = os.path.join(volume, safe_dirname(n))
+            except RuntimeError:
+                continue
+            if not os.path.isdir(sub):
+                continue
+            result.append(sub)
+            if layout == 'date':
+                with os.scandir(sub) as it:
+                    result.extend(sorted(entry.path for entry in it if entry.is_dir()))
+    return result
+
+
+def iter_files(name: Optional[str] = None) -> Iterator[str]:
+    """
+    遍历录播文件路径
+    运行目录下的文件只返回文件名，与旧版本保存的文件名保持一致
+    :param name: 主播名，为空时遍历所有主播
+    """
+    for directory in scan_dirs(name):
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not entry.is_file():
+                        continue
+                    yield entry.name if directory == '.' else entry.path
+        except FileNotFoundError:
+            continue
+
+
+class StorageReservation(NamedTuple):
+    # 存储卷路径
+    volume: str
+    # 预留的空间，单位 Byte
+    size: int
+
+
+class StorageManager:
+    """
+    存储卷管理
+    根据剩余空间与写入负载为每次录制选择存储卷，空间不足时拒绝新的录制，
+    并在后台将已完成的分段迁移到空间充足的其他卷
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 各卷正在进行的录制数
+        self._active: Dict[str, int] = {}
+        # 各卷为正在进行的录制预留的空间，单位 Byte
+        self._reserved: Dict[str, int] = {}
+        # 各卷上次采样的 (时间, 已用空间)
+        self._samples: Dict[str, Tuple[float, int]] = {}
+        # 各卷写入速度，单位 Byte/s
+        self._speed: Dict[str, float] = {}
+        # 后台迁移定时器
+        self._mover: Optional[Timer] = None
+
+    @staticmethod
+    def reserved_space() -> int:
+        """每个卷至少保留的剩余空间，配置单位为 MB"""
+        return int(config.get('storage_reserved_space', 1024)) * 1024 * 1024
+
+    @staticmethod
+    def reserve_size(bitrate: float = 0) -> int:
+        """
+        单个录制需要预留的空间
+        已知码率时按码率预留 RESERVE_SECONDS 的写入量，否则按配置，单位为 MB，且不超过分段大小
+        :param bitrate: 录制的码率，单位 bit/s
+        """
+        if bitrate > 0:
+            size = int(bitrate / 8 * RESERVE_SECONDS)
+        else:
+            size = int(config.get('storage_segment_reserve', 256)) * 1024 * 1024
+        if config.get('file_size'):
+            size = min(size, int(config.get('file_size')))
+        return size
+
+    @staticmethod
+    def _usage(volume: str):
+        if not os.path.isdir(volume):
+            os.makedirs(volume, exist_ok=True)
+        return shutil.disk_usage(volume)
+
+    def _available(self, volume: str) -> int:
+        """扣除保留空间和正在录制的预留空间后的可用空间"""
+        return self._usage(volume).free - self._reserved.get(volume, 0) - self.reserved_space()
+
+    def acquire(self, name: str, bitrate: float = 0) -> Optional[StorageReservation]:
+        """
+        为一次录制选择存储卷并预留空间
+        优先选择正在录制数最少的卷，其次选择可用空间最大的卷
+        :param bitrate: 之前连接观测到的码率，单位 bit/s，未知时为 0
+        :return: 存储卷及预留的空间，所有卷空间不足时返回 None
+        """
+        size = self.reserve_size(bitrate)
+        with self._lock:
+            candidates = []
+            for volume in storage_dirs():
+                try:
+                    available = self._available(volume)
+                except OSError:
+                    logger.warning(f'存储目录不可用: {volume}', exc_info=True)
+                    continue
+                if available < size:
+                    continue
+                candidates.append((self._active.get(volume, 0), -available, volume))
+            if not candidates:
+                return None
+            volume = min(candidates)[2]
+            self._active[volume] = self._active.get(volume, 0) + 1
+            self._reserved[volume] = self._reserved.get(volume, 0) + size
+        logger.debug(f'{name} 录制使用存储目录: {volume}，预留 {size / 1024 / 1024:.0f}MB')
+        self._start_mover()
+        return StorageReservation(volume, size)
+
+    def release(self, reservation: StorageReservation):
+        """录制结束，释放 acquire 时预留的空间"""
+        volume = reservation.volume
+        with self._lock:
+            self._active[volume] = max(self._active.get(volume, 0) - 1, 0)
+            self._reserved[volume] = max(self._reserved.get(volume, 0) - reservation.size, 0)
+
+    def _sample(self):
+        """采样各卷已用空间，计算写入速度"""
+        now = time.time()
+        for volume in storage_dirs():
+            try:
+                used = self._usage(volume).used
+            except OSError:
+                continue
+            last = self._samples.get(volume)
+            if last and now > last[0]:
+                # 删除文件会使已用空间减少，此时视为无写入
+                self._speed[volume] = max(used - last[1], 0) / (now - last[0])
+            self._samples[volume] = (now, used)
+
+    def status(self) -> List[dict]:
+        """各存储卷状态"""
+        self._sample()
+        res = []
+        for volume in storage_dirs():
+            try:
+                usage = self._usage(volume)
+            except OSError:
+                continue
+            res.append({
+                'path': os.path.abspath(volume),
+                'total': usage.total,
+                'free': usage.free,
+                'reserved': self._reserved.get(volume, 0),
+                'recording': self._active.get(volume, 0),
+                'write_speed': int(self._speed.get(volume, 0)),
+            })
+        return res
+
+    def _start_mover(self):
+        if len(storage_dirs()) < 2 or self._mover is not None:
+            return
+        with self._lock:
+            if self._mover is None:
+                self._mover = Timer(func=self._balance, interval=config.get('storage_move_interval', 60))
+                self._mover.start()
+
+    @staticmethod
+    def _volume_files(volume: str) -> List[str]:
+        """卷内可迁移的已完成分段，按修改时间从旧到新排序"""
+        from biliup.app import context
+        from biliup.database.db import SessionLocal, get_upload_session_files
+        from biliup.uploader import segment_uploads
+        uploading = set(context.get('upload_filename', []))
+        # 分块上传记录以文件绝对路径为键，移动后无法续传
+        with SessionLocal() as db:
+            sessions = get_upload_session_files(db)
+        deadline = time.time() - 300
+        files = []
+        for directory in scan_dirs():
+            if directory != volume and not directory.startswith(volume + os.sep):
+                continue
+            with os.scandir(directory) as it:
+                for entry in it:
+                    ext = os.path.splitext(entry.name)[1]
+                    if ext not in (*MEDIA_EXTENSIONS, '.xml', '.dm') or not entry.is_file():
+                        continue
+                    path = entry.name if directory == '.' else entry.path
+                    # 跳过正在上传或有未完成上传的文件
+                    if os.path.splitext(path)[0] in uploading or os.path.abspath(path) in segment_uploads:
+                        continue
+                    if os.path.abspath(path) in sessions:
+                        continue
+                    mtime = entry.stat().st_mtime
+                    # 跳过最近仍在写入的文件
+                    if mtime > deadline:
+                        continue
+                    files.append((mtime, path))
+        return [path for _, path in sorted(files)]
+
+    def _balance(self):
+        """剩余空间不足的卷，将旧的分段迁移到剩余空间最大的卷"""
+        from biliup.database.db import SessionLocal, rename_file_list
+        self._sample()
+        volumes = storage_dirs()
+        low = self.reserved_space() + self.reserve_size() * 2
+        for volume in volumes:
+            try:
+                if self._usage(volume).free >= low:
+                    continue
+                target = max((v for v in volumes if v != volume), key=lambda v: self._usage(v).free)
+                if self._usage(target).free < low:
+                    logger.warning(f'所有存储目录剩余空间不足，无法迁移: {volume}')
+                    continue
+                for path in self._volume_files(volume):
+                    # 与下载时记录的文件名格式一致，运行目录下只保留文件名
+                    dest = os.path.normpath(os.path.join(target, os.path.relpath(path, volume)))
+                    os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+                    shutil.move(path, dest)
+                    # 更新数据库中记录的文件名，上传时才能找到对应的直播信息
+                    with SessionLocal() as db:
+                        rename_file_list(db, path, dest)
+                    logger.info(f'迁移 {path} 到 {dest}')
+                    if self._usage(volume).free >= low:
+                        break
+            except Exception:
+                logger.exception(f'迁移分段失败: {volume}')
+
+
+storage_manager = StorageManager()
@@ -79,6 +79,9 @@ def get_file_create_timestamp(file: str) -> float:
 
 def processor(processors, data):
     for process in processors:
+        if process.get('highlight') is not None:
+            # 根据弹幕密度剪出高能片段
+            highlight_clip(process['highlight'], data)
         if process.get('run'):
             try:
                 # 调用 subprocess.check_output 方法执行 process['run'] 指定的命令
@@ -96,3 +99,20 @@ def processor(processors, data):
                 # 继续处理下一个 process
                 continue
 
+
+def highlight_clip(options, data):
+    from biliup.config import config
+    from biliup.Danmaku.highlight import detect_file, clip
+
+    # 分段处理器输入为视频路径，存在弹幕文件时第二行为弹幕路径
+    files = data.splitlines()
+    if len(files) < 2:
+        return
+    video, danmaku = files[0], files[1]
+    options = {**(config.get('highlight') or {}), **(options or {})}
+    try:
+        intervals = detect_file(danmaku, options)
+        if intervals:
+            clip(video, intervals, options.get('output_dir'))
+    except Exception:
+        logger.exception(f'高能片段剪辑失败: {video}')
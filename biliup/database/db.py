@@ -3,13 +3,13 @@ import os
 import time
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List
+from typing import List, Set
 
 import logging
 
 logger = logging.getLogger('biliup')
 
-from sqlalchemy import select, desc, delete
+from sqlalchemy import select, desc, delete, update
 from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from alembic import command, config
 
@@ -24,6 +24,8 @@ from .models import (
     StreamerInfo,
     # 文件列表模型
     FileList,
+    # 分块上传模型
+    UploadSession,
 )
 
 # 创建一个sessionmaker对象，绑定到数据库引擎engine，并设置autocommit为False
@@ -222,6 +224,13 @@ def update_file_list(db: Session, database_row_id: int, file_name: str) -> int:
     return file_list.id
 
 
+def rename_file_list(db: Session, old: str, new: str) -> int:
+    """文件被移动后更新视频文件列表中的文件名，返回更新的行数"""
+    result = db.execute(update(FileList).where(FileList.file == old).values(file=new))
+    db.commit()
+    return result.rowcount
+
+
 # def delete_file_list(db: Session, database_row_id: int, file_name: str) -> int:
 #     """从视频文件列表中删除指定的文件名，返回删除的行数，若不存在则返回 0"""
 #     # 查询数据库以获取对应的streamer_info
@@ -248,6 +257,60 @@ def get_file_list(db: Session, database_row_id: int) -> List[str]:
 
 
 
+def get_upload_session(db: Session, file: str, fingerprint: str) -> dict:
+    """获取文件未完成的分块上传, 文件已改变或不存在时返回空字典"""
+    upload_session = db.scalar(select(UploadSession).where(UploadSession.file == file))
+    if upload_session is None:
+        return {}
+    if upload_session.fingerprint != fingerprint:
+        # 文件已改变，无法续传
+        db.delete(upload_session)
+        db.commit()
+        return {}
+    return upload_session.as_dict()
+
+
+def get_upload_session_files(db: Session) -> Set[str]:
+    """所有存在分块上传记录的文件路径"""
+    return set(db.scalars(select(UploadSession.file)))
+
+
+def save_upload_session(db: Session, file: str, **kwargs) -> int:
+    """保存新的分块上传, 覆盖文件之前的记录, 返回所添加行的 id"""
+    db.execute(delete(UploadSession).where(UploadSession.file == file))
+    upload_session = UploadSession(file=file, parts=[], updated=datetime.now(), **kwargs)
+    db.add(upload_session)
+    db.commit()
+    return upload_session.id
+
+
+def add_upload_parts(db: Session, upload_session_id: int, parts: List[int]):
+    """记录已上传的分块"""
+    upload_session = db.get(UploadSession, upload_session_id)
+    if upload_session is None:
+        return
+    # JSON 列需整体赋值才会被更新
+    upload_session.parts = sorted(set(upload_session.parts) | set(parts))
+    upload_session.updated = datetime.now()
+    db.commit()
+
+
+def finish_upload_session(db: Session, upload_session_id: int, result: dict):
+    """记录上传完成后返回的视频信息, 投稿后再删除记录"""
+    upload_session = db.get(UploadSession, upload_session_id)
+    if upload_session is None:
+        return
+    upload_session.result = result
+    upload_session.updated = datetime.now()
+    db.commit()
+
+
+def delete_upload_session(db: Session, file: str):
+    """删除分块上传记录"""
+    db.execute(delete(UploadSession).where(UploadSession.file == file))
+    db.commit()
+
+
 def migrate_via_alembic():
     """ 自动迁移，通过 alembic 实现 """
     def process_revision_directives(context, revision, directives):
@@ -209,3 +209,32 @@ class LiveStreamers(BaseModel):
     postprocessor = mapped_column(JSON(), nullable=True)  # 上传完成后触发
     # ffmpeg参数
     opt_args = mapped_column(JSON(), nullable=True)  # ffmpeg参数
+
+
+class UploadSession(BaseModel):
+    """未完成的分块上传，进程重启后续传未上传的分块"""
+    __tablename__ = "uploadsession"
+
+    # 自增主键
+    id: Mapped[int] = mapped_column(primary_key=True)  # 自增主键
+    # 上传的文件路径
+    file: Mapped[str] = mapped_column(nullable=False, unique=True)  # 上传的文件路径
+    # 文件指纹，文件改变时不再续传
+    fingerprint: Mapped[str] = mapped_column(nullable=False)  # 文件指纹，文件改变时不再续传
+    # 上传节点
+    endpoint: Mapped[str] = mapped_column(nullable=False)  # 上传节点
+    # 上传路径
+    upos_uri: Mapped[str] = mapped_column(nullable=False)  # 上传路径
+    # 上传鉴权
+    auth: Mapped[str] = mapped_column(nullable=False)  # 上传鉴权
+    biz_id: Mapped[int] = mapped_column(nullable=False)
+    # 分块上传 id
+    upload_id: Mapped[str] = mapped_column(nullable=False)  # 分块上传 id
+    # 分块大小
+    chunk_size: Mapped[int] = mapped_column(nullable=False)  # 分块大小
+    # 已上传的分块序号
+    parts = mapped_column(JSON(), nullable=False)  # 已上传的分块序号
+    # 上传完成后返回的视频信息，录制中提前上传的分段在投稿时直接使用
+    result = mapped_column(JSON(), nullable=True)  # 上传完成后返回的视频信息
+    # 更新时间
+    updated: Mapped[datetime] = mapped_column(nullable=False)  # 更新时间
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import multiprocessing as mp
 import os
 import re
 import subprocess
@@ -7,18 +8,22 @@ import threading
 import time
 import shutil
 from abc import ABC, abstractmethod
-from typing import AsyncGenerator, List, Callable, Optional
+from concurrent.futures import Future
+from typing import AsyncGenerator, List, Callable, Optional, Tuple
 from urllib.parse import urlparse
 
-import requests
 from requests.utils import DEFAULT_ACCEPT_ENCODING
 from httpx import HTTPStatusError
 
+from biliup.common.cover import prefetch_cover, link_cover
+from biliup.common.storage import streamer_dir, storage_manager, StorageReservation
 from biliup.common.util import client, loop
+from biliup.engine.iopolicy import io_policy
+from biliup.engine.segment import append_segment, merge_danmaku
+from biliup.engine.metrics import RecordingMetrics, recording_metrics
 from biliup.database.db import add_stream_info, SessionLocal, update_cover_path, update_room_title, update_file_list
 from biliup.plugins import random_user_agent
 import stream_gears
-from PIL import Image
 
 from biliup.config import config
 from biliup.Danmaku import IDanmakuClient
@@ -63,6 +68,8 @@ class DownloadBase(ABC):
         self.use_live_cover = config.get('use_live_cover', False)
         self.opt_args = opt_args
         self.live_cover_url = None
+        # 封面获取任务
+        self.live_cover_future = None
         self.fake_headers = {
             'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
             'accept-encoding': DEFAULT_ACCEPT_ENCODING,
@@ -81,9 +88,35 @@ class DownloadBase(ABC):
         # 分段后处理并行
         self.segment_processor_parallel = config.get('segment_processor_parallel', False)
 
+        # 断流重连窗口，单位：秒，窗口内重连时续写断流前的分段
+        self.reconnect_window = config.get('reconnect_window', 0)
+        # 当前分段开始时间
+        self._segment_start = time.time()
+        # 因断流结束、等待续写的分段
+        self._held_segment: Optional[str] = None
+        self._held_duration = 0
+        self._held_deadline = 0
+        # 等待续写的分段尚未完成的弹幕保存
+        self._held_saved: List[Future] = []
+        # 待续写到分段的 (重连后录制的文件, 其弹幕文件, 无法得知起始时间时使用的时间偏移)
+        self._held_appends: List[Tuple[str, str, float]] = []
+
         # 弹幕客户端
         self.danmaku: Optional[IDanmakuClient] = None
 
+        # 本次录制使用的存储卷及预留的空间
+        self.storage_volume: Optional[str] = None
+        self._storage_reservation: Optional[StorageReservation] = None
+
+        # 录制实时指标
+        self.metrics: Optional[RecordingMetrics] = None
+        # 正在运行的ffmpeg进程，卡顿时用于中断重连
+        self._ffmpeg_proc: Optional[subprocess.Popen] = None
+        # 正在运行的 stream-gears 下载进程，卡顿时用于中断重连
+        self._gears_proc: Optional[mp.Process] = None
+        # 下载器是否因卡顿被中断，中断后保存已下载的部分并重连
+        self._stalled = False
+
         self.plugin_msg = f"{self.__class__.__name__} - {url}"
 
     @abstractmethod
@@ -128,13 +161,50 @@ class DownloadBase(ABC):
             # 其他流使用stream-gears按hls保存为ts
             self.suffix = 'ts'
 
-        # 调用stream-gears进行下载
-        stream_gears_download(self.raw_stream_url, self.fake_headers, self.gen_download_filename(),
-                              self.segment_time,
-                             self.file_size,
-                              lambda file_name: self.__download_segment_callback(file_name))
+        # stream-gears 不返回正在写入的文件，按本次录制的文件名模板查找
+        if self.metrics:
+            self.metrics.watch(self.gen_download_filename())
+        # stream-gears 在子进程中下载，卡顿时可终止进程重连，分段文件名经管道传回
+        parent_conn, child_conn = mp.Pipe(duplex=False)
+        proc = mp.get_context('spawn').Process(
+            target=stream_gears_process, daemon=True,
+            args=(child_conn, self.raw_stream_url, self.fake_headers, self.gen_download_filename(),
+                  self.segment_time, self.file_size))
+        self._stalled = False
+        proc.start()
+        child_conn.close()
+        self._gears_proc = proc
+        try:
+            while True:
+                try:
+                    file_name = parent_conn.recv()
+                except EOFError:
+                    # 下载结束或进程被终止
+                    break
+                self.__download_segment_callback(file_name)
+        finally:
+            proc.join()
+            self._gears_proc = None
+            parent_conn.close()
+        if self._stalled:
+            # 保存卡顿前写入的部分，由外层循环重新连接
+            self.__save_stalled_file(self.metrics.current_file if self.metrics else None)
         return True
 
+    def __save_stalled_file(self, file_name: Optional[str]):
+        """保存下载进程被中断时正在写入的文件"""
+        if file_name is None or not os.path.exists(file_name):
+            logger.warning(f'{self.plugin_msg}: 未找到卡顿中断时正在写入的文件')
+            return
+        if not os.path.getsize(file_name):
+            # 卡顿前未写入数据，直接重连
+            os.remove(file_name)
+            return
+        if file_name.endswith('.part'):
+            self.download_file_rename(file_name, file_name[:-len('.part')])
+            file_name = file_name[:-len('.part')]
+        self.__download_segment_callback(file_name)
+
 
     def ffmpeg_segment_download(self):
         # 初始化输入参数列表，添加日志级别和覆盖选项
@@ -179,6 +249,8 @@ class DownloadBase(ABC):
 
         # 复制原始流，不重新编码
         output_args += ['-c', 'copy']
+        # 写入策略
+        output_args += io_policy.ffmpeg_output_args()
         # 添加其他选项到输出参数列表
         output_args += self.opt_args
 
@@ -187,14 +259,23 @@ class DownloadBase(ABC):
 
         # 构造ffmpeg命令行参数列表
         args = ['ffmpeg', *input_args, *output_args, f'{file_name}_%d.{self.suffix}']
+        # ffmpeg 按输出模板依次写入的分段序号
+        output_template, segment_index = file_name, 0
+        if self.metrics:
+            self.metrics.writing(f'{output_template}_{segment_index}.{self.suffix}')
 
+        self._stalled = False
         # 调用subprocess执行ffmpeg命令，并处理输出
         with subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
                               stderr=subprocess.DEVNULL) as proc:
+            self._ffmpeg_proc = proc
             for line in iter(proc.stdout.readline, b''):  # b'\n'-separated lines
                 try:
                     # 读取ffmpeg输出中的文件名，并进行解码
                     ffmpeg_file_name = line.rstrip().decode(errors='ignore')
+                    # 分段列表中只有文件名，补全所在目录
+                    if not os.path.dirname(ffmpeg_file_name):
+                        ffmpeg_file_name = os.path.join(os.path.dirname(file_name), ffmpeg_file_name)
                     # 暂停一段时间，避免过快地重命名文件
                     time.sleep(1)
                     # 文件重命名
@@ -203,12 +284,16 @@ class DownloadBase(ABC):
                     self.__download_segment_callback(f'{file_name}.{self.suffix}')
                     # 生成新的下载文件名
                     file_name = self.gen_download_filename(is_fmt=True)
+                    segment_index += 1
+                    if self.metrics:
+                        self.metrics.writing(f'{output_template}_{segment_index}.{self.suffix}')
                 except:
                     # 记录异常日志
                     logger.error(f'分段事件失败：{self.__class__.__name__} - {self.fname}', exc_info=True)
 
-        # 返回ffmpeg命令的返回值是否为0，表示是否执行成功
-        return proc.returncode == 0
+        self._ffmpeg_proc = None
+        # 返回ffmpeg命令的返回值是否为0，表示是否执行成功，因卡顿中断时重新连接
+        return proc.returncode == 0 or self._stalled
 
 
     def ffmpeg_download(self, use_streamlink=False):
@@ -263,6 +348,8 @@ class DownloadBase(ABC):
                 # 如果设置了文件大小，则添加-fs参数
                 output_args += ['-fs', str(self.file_size)]
 
+            # 写入策略
+            output_args += io_policy.ffmpeg_output_args()
             # 添加其他可选参数
             output_args += self.opt_args
 
@@ -282,8 +369,12 @@ class DownloadBase(ABC):
             # 构造ffmpeg命令参数列表
             args = ['ffmpeg', '-y', *input_args, *output_args, '-c', 'copy',
                     f'{fmt_file_name}.{self.suffix}.part']
+            if self.metrics:
+                self.metrics.writing(f'{fmt_file_name}.{self.suffix}.part')
+            self._stalled = False
             with subprocess.Popen(args, stdin=subprocess.DEVNULL if not streamlink_proc else streamlink_proc.stdout,
                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
+                self._ffmpeg_proc = proc
                 # 以下为注释掉的数据库操作代码
                 # with SessionLocal() as db:
                 #     update_file_list(db, self.database_row_id, fmt_file_name)
@@ -299,12 +390,19 @@ class DownloadBase(ABC):
                     logger.debug(decode_line)
 
             # 检查ffmpeg命令的返回值
-            if proc.returncode == 0:
-                # 如果返回值为0，则执行文件重命名操作
+            if proc.returncode == 0 or self._stalled:
+                # 如果返回值为0或因卡顿被中断，则执行文件重命名操作
+                part_file_name = f'{fmt_file_name}.{self.suffix}.part'
+                if self._stalled and (not os.path.exists(part_file_name) or not os.path.getsize(part_file_name)):
+                    # 卡顿前未写入数据，直接重连
+                    if os.path.exists(part_file_name):
+                        os.remove(part_file_name)
+                    return True
                 # 文件重命名
-                self.download_file_rename(f'{fmt_file_name}.{self.suffix}.part', f'{fmt_file_name}.{self.suffix}')
+                self.download_file_rename(part_file_name, f'{fmt_file_name}.{self.suffix}')
                 # 触发分段事件
                 self.__download_segment_callback(f'{fmt_file_name}.{self.suffix}')
+                # 卡顿中断后返回 True，由外层循环重新连接
                 return True
             else:
                 return False
@@ -316,6 +414,7 @@ class DownloadBase(ABC):
         #             delete_file_list(db, self.database_row_id, None)
 
         finally:
+            self._ffmpeg_proc = None
             try:
                 # 尝试终止streamlink进程
                 if streamlink_proc:
@@ -332,17 +431,109 @@ class DownloadBase(ABC):
         """
         分段后触发返回含后缀的文件名
         """
-        # 提取不含后缀的文件名
-        exclude_ext_file_name = os.path.splitext(file_name)[0]
         # 构造弹幕文件名
         danmaku_file_name = os.path.splitext(file_name)[0] + '.xml'
+        # 下一分段的开始时间
+        boundary = time.time()
 
+        saved = []
+        appends = []
         if self.danmaku:
-            # 保存弹幕文件
-            self.danmaku.save(danmaku_file_name)
+            # 保存弹幕文件，不等待写入完成，避免阻塞下载线程
+            future = self.danmaku.save(danmaku_file_name, boundary)
+            if future is not None:
+                saved.append(future)
+
+        if self.metrics:
+            # 记录分段完成
+            self.metrics.segment_done(file_name)
+
+        # 续写断流前的分段，文件在后处理线程中合并，不阻塞下载线程重连
+        files = [file_name]
+        if self._held_segment is not None:
+            held, self._held_segment = self._held_segment, None
+            held_saved, self._held_saved = self._held_saved, []
+            held_appends, self._held_appends = self._held_appends, []
+            saved = held_saved + saved
+            appends = held_appends + [(file_name, danmaku_file_name, self._held_duration)]
+            files = [held] + [append[0] for append in appends]
+            file_name = held
+
+        # 分段因断流提前结束时暂不处理，等待重连后续写
+        if self.__is_interrupted(files):
+            self._held_segment = file_name
+            self._held_saved = saved
+            self._held_appends = appends
+            self._held_duration = time.time() - self._segment_start
+            self._held_deadline = time.time() + self.reconnect_window
+            logger.info(f'{self.plugin_msg}: 分段 {file_name} 因断流结束，{self.reconnect_window}s 内重连将续写')
+            return
+
+        self._segment_start = boundary
+        self.__process_segment(file_name, saved, appends)
+
+    def __is_interrupted(self, files: List[str]) -> bool:
+        """分段（含待续写的文件）未达到分段时间与大小限制即结束，视为断流"""
+        if not self.reconnect_window or self.is_download:
+            return False
+        if self.segment_time:
+            h, m, s = self.segment_time.split(':')
+            if time.time() - self._segment_start >= int(h) * 3600 + int(m) * 60 + int(s) - 10:
+                return False
+        file_size = self.file_size
+        if not file_size and not self.segment_time:
+            # 与 stream_gears_download 的默认分段大小一致
+            file_size = 8 * 1024 * 1024 * 1024
+        if file_size:
+            try:
+                if sum(os.path.getsize(f) for f in files) >= file_size * 0.95:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def __flush_held_segment(self):
+        """重连窗口结束，处理等待续写的分段"""
+        if self._held_segment is not None:
+            held, self._held_segment = self._held_segment, None
+            self.__process_segment(held, self._held_saved, self._held_appends)
+            self._held_saved, self._held_appends = [], []
+
+    def __process_segment(self, file_name: str, saved: List[Future] = (),
+                          appends: List[Tuple[str, str, float]] = ()):
+        """
+        分段后处理，写入数据库并执行分段处理器
+        :param saved: 分段的弹幕保存，完成后再处理弹幕文件
+        :param appends: 续写时待合并到分段的 (文件, 弹幕文件, 无法得知起始时间时使用的时间偏移)
+        """
+        # 提取不含后缀的文件名
+        exclude_ext_file_name = os.path.splitext(file_name)[0]
+        # 构造弹幕文件名
+        danmaku_file_name = exclude_ext_file_name + '.xml'
 
         def x():
             # 定义函数x，该函数用于执行后续操作
+            # 等待弹幕写入并更名完成
+            for future in saved:
+                try:
+                    future.result(timeout=60)
+                except:
+                    logger.warning(f'等待弹幕保存失败：{self.__class__.__name__} - {self.fname}', exc_info=True)
+            for append_file_name, append_danmaku_file_name, fallback_offset in appends:
+                try:
+                    offset = append_segment(file_name, append_file_name)
+                except:
+                    # 续写失败时分段已恢复原状，重连后录制的文件单独处理
+                    logger.warning(f'续写分段失败：{self.__class__.__name__} - {self.fname}', exc_info=True)
+                    self.__process_segment(append_file_name)
+                    continue
+                try:
+                    merge_danmaku(danmaku_file_name, append_danmaku_file_name,
+                                  fallback_offset if offset is None else offset)
+                except:
+                    logger.warning(f'续写弹幕失败：{self.__class__.__name__} - {self.fname}', exc_info=True)
+            # 分段落盘并释放页缓存
+            io_policy.finish(file_name)
             # 将文件名和直播标题存储到数据库
             with SessionLocal() as db:
                 update_file_list(db, self.database_row_id, file_name)
@@ -370,6 +561,14 @@ class DownloadBase(ABC):
                     # 捕获异常并记录日志
                     logger.warning(f'执行后处理失败：{self.__class__.__name__} - {self.fname}', exc_info=True)
 
+            # 录制中提前上传已完成的分段
+            if config.get('uploading_record', False) and os.path.exists(file_name):
+                try:
+                    from biliup.uploader import upload_segment
+                    upload_segment(self.fname, self.url, file_name)
+                except:
+                    logger.warning(f'录制中上传失败：{self.__class__.__name__} - {self.fname}', exc_info=True)
+
         # 创建守护线程，目标函数为x
         thread = threading.Thread(target=x, daemon=True, name=f"segment_processor_{exclude_ext_file_name}")
 
@@ -386,6 +585,14 @@ class DownloadBase(ABC):
     def download_success_callback(self):
         pass
 
+    def _on_stall(self):
+        """长时间无数据写入时中断下载，由外层循环重新连接"""
+        # 标记卡顿，下载器非正常退出时仍保存已下载的部分并返回重连
+        proc = self._ffmpeg_proc or self._gears_proc
+        if proc is not None:
+            self._stalled = True
+            proc.terminate()
+
     def run(self):
         try:
             # 检查流是否可用
@@ -397,13 +604,37 @@ class DownloadBase(ABC):
                 # 更新房间标题
                 update_room_title(db, self.database_row_id, self.room_title)
 
+            # 选择存储卷，所有卷空间不足时拒绝录制，重连时按之前的码率预留空间
+            self._storage_reservation = storage_manager.acquire(
+                self.fname, self.metrics.avg_bitrate if self.metrics else 0)
+            if self._storage_reservation is None:
+                logger.error(f'{self.plugin_msg}: 存储空间不足，拒绝录制')
+                return False
+            self.storage_volume = self._storage_reservation.volume
+
+            # 提前获取封面
+            self.prefetch_cover()
+
+            # 记录本次连接的CDN，正在写入的文件由下载器打开文件时记录
+            if self.metrics:
+                self.metrics.connected(urlparse(self.raw_stream_url).hostname if self.raw_stream_url else None,
+                                       self._on_stall)
+
             # 初始化弹幕
             self.danmaku_init()
 
+            # 续写时分段从断流前的分段开始计时
+            now = time.time()
+            if self._held_segment is None:
+                self._segment_start = now
+
             # 如果存在弹幕
             if self.danmaku:
-                # 启动弹幕
-                self.danmaku.start()
+                # 弹幕连接中断计入录制指标
+                if self.metrics and hasattr(self.danmaku, 'on_gap'):
+                    self.danmaku.on_gap = self.metrics.danmaku_gap
+                # 启动弹幕，弹幕时间相对本次连接开始计算，续写时合并弹幕再平移
+                self.danmaku.start(now)
 
             # 下载
             retval = self.download()
@@ -416,6 +647,11 @@ class DownloadBase(ABC):
                 self.danmaku.stop()
                 # 清除弹幕对象
                 self.danmaku = None
+            # 释放存储卷预留的空间
+            if self._storage_reservation is not None:
+                storage_manager.release(self._storage_reservation)
+                self._storage_reservation = None
+                self.storage_volume = None
 
 
     def start(self):
@@ -427,26 +663,40 @@ class DownloadBase(ABC):
 
         with SessionLocal() as db:
             self.database_row_id = add_stream_info(db, self.fname, self.url, start_time)  # 返回数据库中此行记录的 id
+        # 注册录制实时指标
+        self.metrics = RecordingMetrics(self.fname, self.url)
+        recording_metrics.register(self.metrics)
+        # 开始定时落盘
+        io_policy.start()
         ret = True
-        while ret:
-            # 下载结果
-            try:
-                ret = self.run()
-            except Exception:
-                logger.warning(f'下载失败: {self.__class__.__name__} - {self.fname}', exc_info=True)
-            finally:
-                self.close()
-
-            # 下载模式跳过下播延迟检测
-            if self.is_download:
-                break
-
-            # 最后一次下载完成时间
-            end_time = time.localtime()
+        try:
+            while ret:
+                # 下载结果
+                try:
+                    ret = self.run()
+                except Exception:
+                    logger.warning(f'下载失败: {self.__class__.__name__} - {self.fname}', exc_info=True)
+                finally:
+                    self.close()
+
+                # 下载模式跳过下播延迟检测
+                if self.is_download:
+                    break
+
+                # 最后一次下载完成时间
+                end_time = time.localtime()
+
+                # 断流后在重连窗口内继续检测，重连后续写断流前的分段
+                if not ret and self._held_segment is not None and time.time() < self._held_deadline:
+                    time.sleep(min(5, self._held_deadline - time.time()))
+                    ret = True
+        finally:
+            recording_metrics.unregister(self.metrics)
+            self.__flush_held_segment()
 
         self.download_cover(
-            time.strftime(self.gen_download_filename().encode("unicode-escape").decode(), end_time if end_time else time.localtime()
-                           ).encode().decode("unicode-escape"))
+            time.strftime(os.path.basename(self.gen_download_filename()).encode("unicode-escape").decode(),
+                          end_time if end_time else time.localtime()).encode().decode("unicode-escape"))
         # 更新数据库中封面存储路径
         with SessionLocal() as db:
             update_cover_path(db, self.database_row_id, self.live_cover_path)
@@ -470,6 +720,11 @@ class DownloadBase(ABC):
         }
         return stream_info
 
+    def prefetch_cover(self):
+        """在事件循环中提前获取封面，录制结束时无需再等待下载与转码"""
+        if self.use_live_cover and self.live_cover_url is not None:
+            self.live_cover_future = prefetch_cover(self.live_cover_url, self.fake_headers)
+
     def download_cover(self, fmtname):
         # 下载封面图片
         # 获取封面
@@ -481,55 +736,26 @@ class DownloadBase(ABC):
                 if not os.path.exists(save_dir):
                     os.makedirs(save_dir)
 
-                # 解析封面图片的URL路径
-                url_path = urlparse(self.live_cover_url).path
-                # 初始化图片后缀
-                suffix = None
-                # 根据URL路径判断图片后缀
-                if '.jpg' in url_path:
-                    suffix = 'jpg'
-                elif '.png' in url_path:
-                    suffix = 'png'
-                elif '.webp' in url_path:
-                    suffix = 'webp'
-
-                # 如果存在后缀
-                if suffix:
-                    # 拼接封面图片的保存路径
-                    live_cover_path = f'{save_dir}{fmtname}.{suffix}'
-                    # 如果封面图片已存在，则直接设置路径
-                    if os.path.exists(live_cover_path):
-                        self.live_cover_path = live_cover_path
-                    else:
-                        # 发送请求获取封面图片
-                        response = requests.get(self.live_cover_url, headers=self.fake_headers, timeout=30)
-                        # 保存封面图片到本地
-                        with open(live_cover_path, 'wb') as f:
-                            f.write(response.content)
-
-                    # 如果封面是webp格式，则转换为jpg格式
-                    if suffix == 'webp':
-                        # 使用PIL库将webp格式转换为jpg格式
-                        with Image.open(live_cover_path) as img:
-                            img = img.convert('RGB')
-                            img.save(f'{save_dir}{fmtname}.jpg', format='JPEG')
-                        # 删除webp格式的封面图片
-                        os.remove(live_cover_path)
-                        # 更新封面图片的保存路径
-                        live_cover_path = f'{save_dir}{fmtname}.jpg'
-
-                    # 设置封面图片的保存路径
-                    self.live_cover_path = live_cover_path
-                    # 记录日志，封面下载成功
-                    logger.info(
-                        f'封面下载成功：{self.__class__.__name__} - {self.fname}：{os.path.abspath(self.live_cover_path)}')
-                else:
-                    # 记录日志，封面下载失败，因为格式不支持
-                    logger.warning(
-                        f'封面下载失败：{self.__class__.__name__} - {self.fname}：封面格式不支持：{self.live_cover_url}')
+                # 封面已转换为 jpg 并裁剪为投稿比例
+                live_cover_path = f'{save_dir}{fmtname}.jpg'
+                # 如果封面图片不存在，则从缓存中获取
+                if not os.path.exists(live_cover_path):
+                    if self.live_cover_future is None:
+                        self.prefetch_cover()
+                    # 等待事件循环中的获取结果，相同封面直接使用缓存
+                    cache_path = self.live_cover_future.result(timeout=60)
+                    link_cover(cache_path, live_cover_path)
+
+                # 设置封面图片的保存路径
+                self.live_cover_path = live_cover_path
+                # 记录日志，封面下载成功
+                logger.info(
+                    f'封面下载成功：{self.__class__.__name__} - {self.fname}：{os.path.abspath(self.live_cover_path)}')
             except:
                 # 记录异常日志，封面下载失败
                 logger.exception(f'封面下载失败：{self.__class__.__name__} - {self.fname}')
+            finally:
+                self.live_cover_future = None
 
     async def acheck_url_healthy(self, url):
         # 内部辅助函数，用于发送 GET 请求并处理响应
@@ -595,6 +821,10 @@ class DownloadBase(ABC):
             filename = f'{self.fname}%Y-%m-%dT%H_%M_%S'
         # 获取有效的文件名
         filename = get_valid_filename(filename)
+        # 按存储布局放入对应目录
+        download_dir = streamer_dir(self.fname, volume=self.storage_volume)
+        if download_dir != '.':
+            filename = os.path.join(download_dir, filename)
 
         if is_fmt:
             # 获取当前时间戳
@@ -633,6 +863,14 @@ class DownloadBase(ABC):
         pass
 
 
+def stream_gears_process(conn, url, headers, file_name, segment_time=None, file_size=None):
+    """在子进程中运行 stream-gears 下载，分段完成的文件名发送到 conn"""
+    try:
+        stream_gears_download(url, headers, file_name, segment_time, file_size, conn.send)
+    finally:
+        conn.close()
+
+
 def stream_gears_download(url, headers, file_name, segment_time=None, file_size=None,
                           file_name_callback: Callable[[str], None] = None):
     class Segment:
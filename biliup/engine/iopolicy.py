@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+from biliup.common.timer import Timer
+from biliup.config import config
+from biliup.engine.metrics import recording_metrics
+
+logger = logging.getLogger('biliup')
+
+# Windows 与 macOS 没有 fdatasync，退化为 fsync
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+class IOPolicy:
+    """
+    录制文件的写入策略
+    录制由 stream-gears 或 ffmpeg 在各自进程内写入，无法替换其写入方式，
+    因此由此处定时对正在写入的文件执行 fdatasync，将脏页分批落盘，
+    避免大量录制同时积累脏页后集中回写造成 I/O 峰值；
+    落盘后可通过 posix_fadvise(DONTNEED) 释放已写入部分的页缓存
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 各文件已落盘的偏移量
+        self._synced: Dict[str, int] = {}
+        self._timer: Optional[Timer] = None
+
+    @staticmethod
+    def sync_interval() -> int:
+        """落盘间隔，单位：秒，0 为不主动落盘"""
+        return int(config.get('io_sync_interval', 0))
+
+    @staticmethod
+    def drop_cache() -> bool:
+        """落盘后是否释放页缓存"""
+        return bool(config.get('io_drop_cache', False)) and hasattr(os, 'posix_fadvise')
+
+    @staticmethod
+    def ffmpeg_output_args() -> List[str]:
+        """
+        ffmpeg 输出参数
+        开启缓冲写入时不再逐个数据包刷新，由 ffmpeg 缓冲区写满后再写入
+        """
+        if config.get('io_buffered_write', False):
+            return ['-flush_packets', '0']
+        return []
+
+    def start(self):
+        """开始定时落盘"""
+        interval = self.sync_interval()
+        if interval <= 0 or self._timer is not None:
+            return
+        with self._lock:
+            if self._timer is None:
+                self._timer = Timer(func=self.sync_all, interval=interval)
+                self._timer.start()
+
+    def _sync(self, path: str, final: bool = False):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            offset = self._synced.get(path, 0)
+            if size > offset:
+                _fdatasync(fd)
+            if self.drop_cache():
+                # 分段结束时释放整个文件，否则只释放已落盘的部分
+                os.posix_fadvise(fd, 0, 0 if final else size, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+        if final:
+            self._synced.pop(path, None)
+        else:
+            self._synced[path] = size
+
+    def sync_all(self):
+        """对所有正在写入的文件执行落盘"""
+        files = recording_metrics.current_files()
+        with self._lock:
+            # 清理已结束写入的文件
+            for path in set(self._synced) - set(files):
+                del self._synced[path]
+            for path in files:
+                try:
+                    self._sync(path)
+                except FileNotFoundError:
+                    # 文件已被更名
+                    self._synced.pop(path, None)
+                except OSError:
+                    logger.debug(f'落盘失败: {path}', exc_info=True)
+
+    def finish(self, path: str):
+        """分段写入完成，落盘并释放页缓存"""
+        if self.sync_interval() <= 0 and not self.drop_cache():
+            return
+        with self._lock:
+            try:
+                self._sync(path, final=True)
+            except OSError:
+                logger.debug(f'落盘失败: {path}', exc_info=True)
+
+
+io_policy = IOPolicy()
@@ -0,0 +1,246 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from biliup.common.timer import Timer
+from biliup.config import config
+
+logger = logging.getLogger('biliup')
+
+MEDIA_EXTENSIONS = ('.mp4', '.flv', '.3gp', '.webm', '.mkv', '.ts', '.part')
+# 格式化结果只含数字的时间格式
+_NUMERIC_DIRECTIVES = set('dHIjmMSUwWyYfGuVs')
+
+
+class RecordingMetrics:
+    """
+    单个录制的实时指标
+    下载器对外是黑盒，这里通过定时查看正在写入的文件大小来计算写入量与码率
+    """
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self._start_monotonic = time.monotonic()
+        # 已完成分段的总大小及文件名
+        self._completed_bytes = 0
+        self._completed_files = set()
+        # 已写入的总字节数
+        self.bytes_written = 0
+        # 瞬时码率与平均码率，单位 bit/s
+        self.bitrate = 0.0
+        self.avg_bitrate = 0.0
+        # 重连次数
+        self.reconnects = 0
+        # 已完成的分段数
+        self.segments = 0
+        # 弹幕连接中断次数及总时长
+        self.danmaku_gaps = 0
+        self.danmaku_gap_seconds = 0.0
+        # 当前 CDN 主机
+        self.host: Optional[str] = None
+        # 当前写入的文件，由下载器打开文件时记录
+        self.current_file: Optional[str] = None
+        # 下载器不返回正在写入的文件时，按文件名模板在下载目录中查找
+        self.directory = '.'
+        self._pattern: Optional[re.Pattern] = None
+        # 上次采样时间及最后一次有数据写入的时间
+        self._last_sample = self._start_monotonic
+        self._last_byte = self._start_monotonic
+        # 卡顿回调，每次连接只触发一次
+        self.on_stall: Optional[Callable[[], None]] = None
+        self._stalled = False
+
+    def connected(self, host: Optional[str], on_stall: Optional[Callable[[], None]] = None):
+        """开始一次连接（首次连接或重连）"""
+        with self._lock:
+            if self.host is not None:
+                self.reconnects += 1
+            self.host = host
+            self.current_file = None
+            self._pattern = None
+            self.on_stall = on_stall
+            self._stalled = False
+            self._last_byte = time.monotonic()
+
+    def writing(self, file_name: str):
+        """下载器开始写入文件"""
+        with self._lock:
+            self.current_file = file_name
+            self._pattern = None
+
+    def watch(self, template: str):
+        """
+        下载器不返回正在写入的文件时，查找按本次录制的文件名模板生成的文件
+        :param template: 含目录、未格式化时间的文件名模板
+        """
+        # 数字的时间格式化部分只匹配数字，其余部分须与模板完全相同
+        name = re.sub(r'%-?([a-zA-Z])', lambda m: r'\d+' if m.group(1) in _NUMERIC_DIRECTIVES else r'[^.]+?',
+                      re.escape(os.path.basename(template)))
+        with self._lock:
+            self.directory = os.path.dirname(template) or '.'
+            self._pattern = re.compile(rf'{name}(_\d+)?\.[^.]+(\.part)?')
+            self.current_file = None
+
+    def segment_done(self, file_name: str):
+        """分段完成"""
+        with self._lock:
+            try:
+                self._completed_bytes += os.path.getsize(file_name)
+            except OSError:
+                pass
+            self._completed_files.add(os.path.basename(file_name))
+            self.segments += 1
+            # 按模板查找时重新查找下一个分段，否则等待下载器记录
+            self.current_file = None
+
+    def danmaku_gap(self, start: float, end: float):
+        """弹幕连接中断结束"""
+        with self._lock:
+            self.danmaku_gaps += 1
+            self.danmaku_gap_seconds += max(end - start, 0)
+
+    def _find_current_file(self) -> Optional[str]:
+        """在下载目录中查找按本次录制的文件名模板生成、正在写入的文件"""
+        if self._pattern is None:
+            return None
+        newest, newest_mtime = None, self.start_time
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(MEDIA_EXTENSIONS) or not self._pattern.fullmatch(entry.name):
+                    continue
+                if entry.name in self._completed_files:
+                    continue
+                mtime = entry.stat().st_mtime
+                if mtime >= newest_mtime:
+                    newest, newest_mtime = entry.path, mtime
+        return newest
+
+    def sample(self):
+        """采样写入量，计算码率并检测卡顿"""
+        stall_timeout = config.get('stall_timeout', 60)
+        on_stall = None
+        with self._lock:
+            now = time.monotonic()
+            size = 0
+            try:
+                if self.current_file is None:
+                    self.current_file = self._find_current_file()
+                if self.current_file is not None:
+                    size = os.path.getsize(self.current_file)
+            except OSError:
+                # 文件已被更名，等待分段回调或重新查找
+                self.current_file = None
+            total = max(self._completed_bytes + size, self.bytes_written)
+            delta = total - self.bytes_written
+            if now > self._last_sample:
+                self.bitrate = delta * 8 / (now - self._last_sample)
+            if now > self._start_monotonic:
+                self.avg_bitrate = total * 8 / (now - self._start_monotonic)
+            if delta > 0:
+                self._last_byte = now
+                self._stalled = False
+            self.bytes_written = total
+            self._last_sample = now
+            if stall_timeout and not self._stalled and now - self._last_byte > stall_timeout:
+                self._stalled = True
+                on_stall = self.on_stall
+        if on_stall is not None:
+            logger.warning(f'{self.name} - {self.url}: {stall_timeout}s 内无数据写入，尝试重连')
+            try:
+                on_stall()
+            except Exception:
+                logger.exception(f'{self.name}: 重连失败')
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'name': self.name,
+                'url': self.url,
+                'start_time': int(self.start_time),
+                'bytes_written': self.bytes_written,
+                'bitrate': int(self.bitrate),
+                'avg_bitrate': int(self.avg_bitrate),
+                'reconnects': self.reconnects,
+                'since_last_byte': round(time.monotonic() - self._last_byte, 1),
+                'segments': self.segments,
+                'danmaku_gaps': self.danmaku_gaps,
+                'danmaku_gap_seconds': round(self.danmaku_gap_seconds, 1),
+                'host': self.host,
+            }
+
+
+def _escape_label(value) -> str:
+    return str(value or '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    """所有正在进行的录制指标，由一个定时线程统一采样"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, RecordingMetrics] = {}
+        self._timer: Optional[Timer] = None
+
+    def register(self, metrics: RecordingMetrics):
+        with self._lock:
+            self._metrics[metrics.url] = metrics
+            if self._timer is None:
+                self._timer = Timer(func=self.sample, interval=config.get('metrics_interval', 5))
+                self._timer.start()
+
+    def unregister(self, metrics: RecordingMetrics):
+        with self._lock:
+            if self._metrics.get(metrics.url) is metrics:
+                del self._metrics[metrics.url]
+
+    def sample(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for m in metrics:
+            try:
+                m.sample()
+            except Exception:
+                logger.exception(f'{m.name}: 录制指标采样失败')
+
+    def current_files(self) -> List[str]:
+        """所有录制正在写入的文件"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [m.current_file for m in metrics if m.current_file]
+
+    def as_list(self) -> List[dict]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [m.as_dict() for m in metrics]
+
+    def prometheus(self) -> str:
+        """以 Prometheus 文本格式输出"""
+        fields = {
+            'bytes_written': ('counter', '已写入字节数'),
+            'bitrate': ('gauge', '瞬时码率 bit/s'),
+            'avg_bitrate': ('gauge', '平均码率 bit/s'),
+            'reconnects': ('counter', '重连次数'),
+            'since_last_byte': ('gauge', '距最后一次写入的秒数'),
+            'segments': ('counter', '已完成分段数'),
+            'danmaku_gaps': ('counter', '弹幕连接中断次数'),
+            'danmaku_gap_seconds': ('counter', '弹幕连接中断总秒数'),
+        }
+        records = self.as_list()
+        lines = []
+        for key, (kind, desc) in fields.items():
+            metric = f'biliup_recording_{key}'
+            lines.append(f'# HELP {metric} {desc}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for r in records:
+                labels = ','.join(f'{k}="{_escape_label(r[k])}"' for k in ('name', 'url', 'host'))
+                lines.append(f'{metric}{{{labels}}} {r[key]}')
+        return '\n'.join(lines) + '\n'
+
+
+recording_metrics = MetricsRegistry()
@@ -0,0 +1,310 @@
+import logging
+import os
+import shutil
+import struct
+import subprocess
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger('biliup')
+
+FLV_HEADER_SIZE = 9
+FLV_TAG_HEADER_SIZE = 11
+FLV_TAG_SCRIPT = 18
+FLV_TAG_TYPES = (8, 9, FLV_TAG_SCRIPT)
+
+
+def _tag_timestamp(header: bytes) -> int:
+    # 低 24 位在前，扩展的高 8 位在后
+    return int.from_bytes(header[4:7], 'big') | (header[7] << 24)
+
+
+def _set_tag_timestamp(header: bytearray, timestamp: int):
+    header[4:7] = (timestamp & 0xFFFFFF).to_bytes(3, 'big')
+    header[7] = (timestamp >> 24) & 0xFF
+
+
+def flv_last_timestamp(path: str) -> int:
+    """通过文件末尾的 PreviousTagSize 读取最后一个 tag 的时间戳，单位：毫秒"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end < FLV_HEADER_SIZE + 4 + FLV_TAG_HEADER_SIZE + 4:
+            raise ValueError(f'{path} 不是完整的 flv 文件')
+        f.seek(end - 4)
+        size, = struct.unpack('>I', f.read(4))
+        if size < FLV_TAG_HEADER_SIZE or size > end - FLV_HEADER_SIZE - 8:
+            raise ValueError(f'{path} 末尾 tag 不完整')
+        f.seek(end - 4 - size)
+        header = f.read(FLV_TAG_HEADER_SIZE)
+        if header[0] & 0x1F not in FLV_TAG_TYPES:
+            raise ValueError(f'{path} 末尾 tag 类型错误')
+        return _tag_timestamp(header)
+
+
+def append_flv(dst: str, src: str) -> float:
+    """
+    将 src 的 tag 追加到 dst 末尾，并将 src 的时间戳平移到 dst 之后
+    跳过 src 的文件头与 onMetaData，其余 tag 原样写入，之后更新 dst 的 onMetaData
+    :return: src 在合并后文件中的起始时间，单位：秒
+    """
+    offset = flv_last_timestamp(dst) + 1
+    base = None
+    with open(src, 'rb') as fin, open(dst, 'ab') as fout:
+        header = fin.read(FLV_HEADER_SIZE)
+        if header[:3] != b'FLV':
+            raise ValueError(f'{src} 不是 flv 文件')
+        fin.seek(int.from_bytes(header[5:9], 'big') + 4)
+        while True:
+            tag_header = bytearray(fin.read(FLV_TAG_HEADER_SIZE))
+            if len(tag_header) < FLV_TAG_HEADER_SIZE:
+                break
+            data_size = int.from_bytes(tag_header[1:4], 'big')
+            data = fin.read(data_size)
+            # 断流时最后一个 tag 可能不完整
+            if len(data) < data_size or len(fin.read(4)) < 4:
+                break
+            if tag_header[0] & 0x1F == FLV_TAG_SCRIPT:
+                continue
+            timestamp = _tag_timestamp(tag_header)
+            if base is None:
+                base = timestamp
+            _set_tag_timestamp(tag_header, offset + max(timestamp - base, 0))
+            fout.write(tag_header)
+            fout.write(data)
+            fout.write(struct.pack('>I', FLV_TAG_HEADER_SIZE + data_size))
+    update_flv_metadata(dst)
+    return offset / 1000
+
+
+def update_flv_metadata(path: str):
+    """按合并后的文件更新 onMetaData 中的 duration 与 filesize，数值原位改写，不改变文件大小"""
+    values = {
+        b'duration': flv_last_timestamp(path) / 1000,
+        b'filesize': float(os.path.getsize(path)),
+    }
+    with open(path, 'r+b') as f:
+        header = f.read(FLV_HEADER_SIZE)
+        tag_start = int.from_bytes(header[5:9], 'big') + 4
+        f.seek(tag_start)
+        tag_header = f.read(FLV_TAG_HEADER_SIZE)
+        if len(tag_header) < FLV_TAG_HEADER_SIZE or tag_header[0] & 0x1F != FLV_TAG_SCRIPT:
+            return
+        data = f.read(int.from_bytes(tag_header[1:4], 'big'))
+        for key, value in values.items():
+            # AMF0 的键为 2 字节长度加字符串，数值类型为 0 后接 8 字节 double
+            pos = data.find(len(key).to_bytes(2, 'big') + key + b'\x00')
+            if pos < 0 or pos + len(key) + 3 + 8 > len(data):
+                continue
+            f.seek(tag_start + FLV_TAG_HEADER_SIZE + pos + len(key) + 3)
+            f.write(struct.pack('>d', value))
+
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+# PTS/DTS/PCR 基准为 33 位 90kHz 时钟
+TS_CLOCK = 90000
+TS_TIMESTAMP_MOD = 1 << 33
+# 读取文件首尾用于确定时间戳范围的数据大小
+TS_SCAN_SIZE = 4 * 1024 * 1024
+# 无法得知帧间隔时使用的间隔，40ms
+TS_DEFAULT_STEP = 3600
+# 没有可选 PES 头（不含时间戳）的流
+TS_NO_PES_HEADER = {0xBC, 0xBE, 0xBF, 0xF0, 0xF1, 0xF2, 0xF8, 0xFF}
+
+
+def _read_ts_timestamp(data, pos: int) -> int:
+    return (((data[pos] >> 1) & 0x07) << 30 | data[pos + 1] << 22 | (data[pos + 2] >> 1) << 15
+            | data[pos + 3] << 7 | data[pos + 4] >> 1)
+
+
+def _write_ts_timestamp(data: bytearray, pos: int, value: int):
+    # 保留前 4 位的 PTS/DTS 标识
+    data[pos] = (data[pos] & 0xF0) | ((value >> 29) & 0x0E) | 0x01
+    data[pos + 1] = (value >> 22) & 0xFF
+    data[pos + 2] = ((value >> 14) & 0xFE) | 0x01
+    data[pos + 3] = (value >> 7) & 0xFF
+    data[pos + 4] = ((value << 1) & 0xFE) | 0x01
+
+
+def _ts_packets(data, start: int = 0):
+    """遍历数据中完整的 TS 包，返回 (包起始位置, pid, 是否有 PCR, PES 时间戳位置列表)"""
+    for pos in range(start, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        if data[pos] != TS_SYNC_BYTE:
+            raise ValueError('TS 包同步字节错误')
+        pid = (data[pos + 1] & 0x1F) << 8 | data[pos + 2]
+        adaptation = data[pos + 3] & 0x20
+        payload = pos + 4
+        has_pcr = False
+        if adaptation:
+            length = data[pos + 4]
+            has_pcr = length >= 7 and data[pos + 5] & 0x10
+            payload += 1 + length
+        timestamps = []
+        # 只在 PES 开头的包中读取时间戳
+        if (data[pos + 1] & 0x40 and data[pos + 3] & 0x10 and payload + 14 <= pos + TS_PACKET_SIZE
+                and data[payload:payload + 3] == b'\x00\x00\x01' and data[payload + 3] not in TS_NO_PES_HEADER):
+            flags = data[payload + 7] >> 6
+            if flags & 0x02:
+                timestamps.append(payload + 9)
+                if flags == 0x03 and payload + 19 <= pos + TS_PACKET_SIZE:
+                    timestamps.append(payload + 14)
+        yield pos, pid, has_pcr, timestamps
+
+
+def _ts_pes_timestamps(data) -> list:
+    """数据中的 PES 时间戳，有 DTS 时为 DTS"""
+    return [_read_ts_timestamp(data, timestamps[-1])
+            for _, _, _, timestamps in _ts_packets(data) if timestamps]
+
+
+def _ts_range(path: str) -> Tuple[int, int, Dict[int, int]]:
+    """
+    读取 TS 文件的时间戳范围
+    :return: (开头的最小时间戳, 末尾的结束时间戳, 每个 pid 最后的连续计数器)
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(TS_SCAN_SIZE)
+        tail_start = max(size - TS_SCAN_SIZE, 0)
+        tail_start -= tail_start % TS_PACKET_SIZE
+        f.seek(tail_start)
+        tail = f.read()
+    head_timestamps = _ts_pes_timestamps(head)
+    tail_timestamps = sorted(set(_ts_pes_timestamps(tail)))
+    if not head_timestamps or not tail_timestamps:
+        raise ValueError(f'{path} 中没有时间戳')
+    # 以末尾最小的时间戳间隔作为最后一帧的时长
+    steps = [b - a for a, b in zip(tail_timestamps, tail_timestamps[1:]) if b > a]
+    end = tail_timestamps[-1] + (min(steps) if steps else TS_DEFAULT_STEP)
+    counters = {}
+    for pos, pid, _, _ in _ts_packets(tail):
+        counters[pid] = tail[pos + 3] & 0x0F
+    return min(head_timestamps), end, counters
+
+
+def append_ts(dst: str, src: str) -> float:
+    """
+    将 src 的 TS 包追加到 dst 末尾，并将 src 的 PTS/DTS/PCR 平移到 dst 之后，
+    各 pid 的连续计数器接续 dst，合并后的文件时间戳连续
+    :return: src 在合并后文件中的起始时间，单位：秒
+    """
+    dst_start, dst_end, counters = _ts_range(dst)
+    with open(src, 'rb') as f:
+        src_start = min(_ts_pes_timestamps(f.read(TS_SCAN_SIZE)) or [0])
+    shift = (dst_end - src_start) % TS_TIMESTAMP_MOD
+    # 各 pid 连续计数器的平移量，由 src 中第一个包确定
+    cc_shift = {}
+    with open(src, 'rb') as fin, open(dst, 'ab') as fout:
+        while True:
+            data = bytearray(fin.read(TS_PACKET_SIZE * 4096))
+            # 断流时最后一个包可能不完整
+            data = data[:len(data) - len(data) % TS_PACKET_SIZE]
+            if not data:
+                break
+            for pos, pid, has_pcr, timestamps in _ts_packets(data):
+                for ts_pos in timestamps:
+                    _write_ts_timestamp(data, ts_pos, (_read_ts_timestamp(data, ts_pos) + shift) % TS_TIMESTAMP_MOD)
+                if has_pcr:
+                    base = (data[pos + 6] << 25 | data[pos + 7] << 17 | data[pos + 8] << 9 | data[pos + 9] << 1
+                            | data[pos + 10] >> 7)
+                    base = (base + shift) % TS_TIMESTAMP_MOD
+                    data[pos + 6:pos + 10] = (base >> 1).to_bytes(4, 'big')
+                    data[pos + 10] = (base & 0x01) << 7 | (data[pos + 10] & 0x7F)
+                if pid not in cc_shift:
+                    cc_shift[pid] = (counters[pid] + 1 - (data[pos + 3] & 0x0F)) % 16 if pid in counters else 0
+                data[pos + 3] = (data[pos + 3] & 0xF0) | ((data[pos + 3] & 0x0F) + cc_shift[pid]) % 16
+            fout.write(data)
+    return ((dst_end - dst_start) % TS_TIMESTAMP_MOD) / TS_CLOCK
+
+
+def concat_ffmpeg(dst: str, src: str):
+    """其他封装格式通过 ffmpeg concat 重新封装"""
+    if not shutil.which('ffmpeg'):
+        raise RuntimeError('未安装 FFMpeg 或不存在于 PATH 内')
+    root, ext = os.path.splitext(dst)
+    list_file = f'{root}.concat.txt'
+    tmp = f'{root}.concat{ext}'
+    with open(list_file, 'w', encoding='utf-8') as f:
+        for path in (dst, src):
+            path = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+    try:
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file,
+                        '-c', 'copy', tmp], stdin=subprocess.DEVNULL, check=True)
+        os.replace(tmp, dst)
+    finally:
+        for path in (list_file, tmp):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def append_segment(dst: str, src: str) -> Optional[float]:
+    """
+    将断流重连后录制的分段续写到上一个分段，成功后删除 src
+    :return: src 在合并后文件中的起始时间，单位：秒，无法得知时为 None
+    """
+    ext = os.path.splitext(dst)[1].lower()
+    offset = None
+    size = os.path.getsize(dst)
+    try:
+        if ext == '.flv':
+            offset = append_flv(dst, src)
+        elif ext == '.ts':
+            offset = append_ts(dst, src)
+        else:
+            # 先写入临时文件，失败时 dst 不变
+            concat_ffmpeg(dst, src)
+    except:
+        if ext in ('.flv', '.ts'):
+            # 追加到一半失败时截断回原来的大小，dst 仍可单独处理
+            with open(dst, 'r+b') as f:
+                f.truncate(size)
+        raise
+    os.remove(src)
+    logger.info(f'续写分段 {src} 到 {dst}')
+    return offset
+
+
+def merge_danmaku(dst: str, src: str, offset: float):
+    """
+    将 src 中的弹幕时间平移 offset 秒后追加到 dst，dst 不存在时平移后写入 dst，成功后删除 src
+    同名的二进制弹幕日志(.dm)同样合并
+    """
+    import lxml.etree as etree
+
+    src_archive = os.path.splitext(src)[0] + '.dm'
+    if os.path.exists(src_archive):
+        from biliup.Danmaku.archive import merge_archive
+        merge_archive(os.path.splitext(dst)[0] + '.dm', src_archive, offset)
+    if not os.path.exists(src):
+        return
+    parser = etree.XMLParser(recover=True)
+    src_tree = etree.parse(src, parser)
+    shifted = []
+    for d in list(src_tree.getroot().iter('d')):
+        p = d.get('p', '').split(',')
+        try:
+            p[0] = f'{float(p[0]) + offset:.3f}'
+        except ValueError:
+            continue
+        d.set('p', ','.join(p))
+        shifted.append(d)
+    # 弹幕连接中断的时间范围
+    for gap in list(src_tree.getroot().iter('gap')):
+        try:
+            for key in ('start', 'end'):
+                gap.set(key, f'{float(gap.get(key)) + offset:.3f}')
+        except (TypeError, ValueError):
+            continue
+        shifted.append(gap)
+    if os.path.exists(dst):
+        tree = etree.parse(dst, parser)
+        root = tree.getroot()
+        for element in shifted:
+            root.append(element)
+    else:
+        tree = src_tree
+        root = tree.getroot()
+    etree.indent(root, '\t')
+    tree.write(dst, encoding='UTF-8', xml_declaration=True, pretty_print=True)
+    os.remove(src)
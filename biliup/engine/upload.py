@@ -7,6 +7,7 @@ from typing import NamedTuple, Optional, List
 
 from sqlalchemy import desc
 
+from biliup.common import storage
 from biliup.common.tools import NamedLock, get_file_create_timestamp
 from biliup.config import config
 from biliup.database import models
@@ -57,14 +58,15 @@ class UploadBase:
             if dbinfo:
                 # 遍历dbinfo的filelist属性中的每个文件对象
                 for dbfile in dbinfo.filelist:
-                    # 将文件名添加到save列表中
-                    save.append(dbfile.file)
+                    # 将文件名（不含目录及后缀）添加到save列表中
+                    save.append(pathlib.Path(dbfile.file).stem)
 
-        # 遍历当前目录下的所有文件和文件夹
-        for file_name in os.listdir('.'):
+        # 遍历存储目录下该主播相关的文件
+        for file_name in storage.iter_files(index):
+            base_name = os.path.basename(file_name)
             # 如果文件名中包含index，或者文件名（去掉后缀）在save列表中，并且该文件确实存在
             # 可能有两层后缀.with_suffix('')去掉一层.stem取文件名
-            if (index in file_name or pathlib.Path(file_name).with_suffix('').stem in save ) and os.path.isfile(file_name):
+            if (index in base_name or pathlib.Path(base_name).with_suffix('').stem in save) and os.path.isfile(file_name):
                 # 将文件名添加到file_list列表中
                 file_list.append(file_name)
 
@@ -153,6 +155,14 @@ class UploadBase:
                     logger.info(f'无视频，过滤删除 - {file}')
                     UploadBase.remove_file(file)
 
+        # 分段处理器剪出的高能片段作为额外分P追加在分段之后
+        if (config.get('highlight') or {}).get('upload', True):
+            from biliup.Danmaku.highlight import find_clips
+            for result in list(results):
+                for clip in find_clips(result.video):
+                    if os.path.splitext(clip)[0] not in upload_filename:
+                        results.append(UploadBase.FileInfo(video=clip, danmaku=None))
+
         return results
 
 
@@ -166,6 +176,13 @@ class UploadBase:
             if f.danmaku is not None:
                 # 删除弹幕文件
                 UploadBase.remove_file(f.danmaku)
+            # 二进制弹幕日志包含 xml 中没有的礼物等消息，上传后保留
+
+    @staticmethod
+    def archive_of(video: str) -> Optional[str]:
+        # 与视频同名的二进制弹幕日志，未开启或没有弹幕时不存在
+        archive = os.path.splitext(video)[0] + '.dm'
+        return archive if os.path.exists(archive) else None
 
     @staticmethod
     def remove_file(file: str):
@@ -190,6 +190,9 @@ def uploaded(name, live_cover_path, data: List):
         file_list.append(i.video)
         if i.danmaku is not None:
             file_list.append(i.danmaku)
+        archive = UploadBase.archive_of(i.video)
+        if archive is not None:
+            file_list.append(archive)
 
     # 遍历处理函数列表
     for post_processor in post_processor:
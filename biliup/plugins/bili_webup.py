@@ -1,13 +1,16 @@
 import asyncio
 import base64
+import functools
 import hashlib
 import json
 import math
 import os
 import re
 import sys
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict, dataclass, field, InitVar
 from json import JSONDecodeError
 from os.path import splitext, basename
@@ -21,7 +24,12 @@ import rsa
 import xml.etree.ElementTree as ET
 from requests.adapters import HTTPAdapter, Retry
 
+from biliup.common.backoff import Backoff
+from biliup.common.bandwidth import bandwidth_scheduler
 from biliup.config import config
+from biliup.database.db import (SessionLocal, get_upload_session, save_upload_session, add_upload_parts,
+                                finish_upload_session, delete_upload_session)
+from biliup.uploader import wait_segment_uploads
 from ..engine import Plugin
 from ..engine.upload import UploadBase, logger
 
@@ -57,8 +65,14 @@ class BiliWeb(UploadBase):
             bili.app_key = self.user.get('app_key')
             bili.appsec = self.user.get('appsec')
             bili.login(self.persistence_path, self.user)
-            for file in file_list:
-                video_part = bili.upload_file(file.video, self.lines, self.threads)  # 上传视频
+            # 等待录制中提前上传的分段，已上传的分段不再重复上传
+            wait_segment_uploads([file.video for file in file_list])
+            # 同时上传多个分P，按原顺序添加
+            video_parts = bili.upload_files([file.video for file in file_list], self.lines, self.threads,
+                                            parallel=config.get('upload_parallel', 1),
+                                            max_connections=config.get('upload_max_connections'),
+                                            key=self.principal)  # 上传视频
+            for video_part in video_parts:
                 video_part['title'] = video_part['title'][:80]
                 video.append(video_part)  # 添加已经上传的视频
             video.title = self.data["format_title"][:80]  # 稿件标题限制80字
@@ -83,8 +97,19 @@ class BiliWeb(UploadBase):
                 video.cover = bili.cover_up(self.cover_path).replace('http:', '')
             ret = bili.submit(self.submit_api)  # 提交视频
         logger.info(f"上传成功: {ret}")
+        with SessionLocal() as db:
+            for file in file_list:
+                delete_upload_session(db, os.path.abspath(file.video))
         return file_list
 
+    def upload_segment(self, filepath: str) -> dict:
+        """录制中上传已完成的分段，投稿时直接使用上传结果"""
+        with BiliBili(Data()) as bili:
+            bili.app_key = self.user.get('app_key')
+            bili.appsec = self.user.get('appsec')
+            bili.login(self.persistence_path, self.user)
+            return bili.upload_files([filepath], self.lines, self.threads, key=self.principal)[0]
+
     def creditsToDesc_v2(self):
             desc_v2 = []
             desc_v2_tmp = self.desc
@@ -114,6 +139,298 @@ class BiliWeb(UploadBase):
             desc_v2[0]["raw_text"] = desc_v2[0]["raw_text"][1:]  # 开头空格会导致识别简介过长
             return desc_v2
 
+class UploadSessionExpired(Exception):
+    """续传的上传已失效"""
+    pass
+
+
+def file_fingerprint(filepath: str, sample_size=1024 * 1024) -> str:
+    """文件指纹，由大小、修改时间及首尾数据的哈希组成，用于判断续传的文件是否改变"""
+    stat = os.stat(filepath)
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        sha1.update(f.read(sample_size))
+        if stat.st_size > sample_size:
+            f.seek(max(stat.st_size - sample_size, sample_size))
+            sha1.update(f.read(sample_size))
+    return f"{stat.st_size}-{stat.st_mtime_ns}-{sha1.hexdigest()}"
+
+
+class ChunkReader:
+    """
+    分块预读
+    在线程池中按顺序读取文件到一组复用的缓冲区，上传任务取走已读取的分块，上传完成后归还缓冲区，
+    读取与上传同时进行，读盘不会阻塞事件循环中的其他上传
+    """
+
+    def __init__(self, file, chunk_size: int, buffers: int, skip=()):
+        """
+        :param buffers: 缓冲区个数，即最多占用 buffers * chunk_size 的内存
+        :param skip: 需跳过的分块序号，从 0 开始
+        """
+        self.file = file
+        self.chunk_size = chunk_size
+        self.skip = skip
+        self._free = asyncio.Queue()
+        for _ in range(buffers):
+            self._free.put_nowait(bytearray(chunk_size))
+        self._ready = asyncio.Queue()
+        self._error = None
+
+    def _read(self, buffer: bytearray, offset: int) -> int:
+        self.file.seek(offset)
+        return self.file.readinto(buffer)
+
+    async def run(self, consumers: int):
+        """读取所有分块，结束后通知 consumers 个上传任务"""
+        loop = asyncio.get_running_loop()
+        index = 0
+        try:
+            while True:
+                if index in self.skip:
+                    index += 1
+                    continue
+                buffer = await self._free.get()
+                size = await loop.run_in_executor(None, self._read, buffer, index * self.chunk_size)
+                if not size:
+                    break
+                self._ready.put_nowait((index, memoryview(buffer)[:size]))
+                if size < self.chunk_size:
+                    break
+                index += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._error = e
+        for _ in range(consumers):
+            self._ready.put_nowait(None)
+
+    async def get(self):
+        """取出一个已读取的分块 (序号, 数据)，读取结束时返回 None"""
+        chunk = await self._ready.get()
+        if chunk is None and self._error is not None:
+            raise self._error
+        return chunk
+
+    def release(self, data: memoryview):
+        """上传完成后归还缓冲区"""
+        self._free.put_nowait(data.obj)
+
+
+# 已上传分块写入数据库的间隔，单位：秒
+UPLOAD_PARTS_SAVE_INTERVAL = 5
+# 线路测速上传的数据大小，用于测量持续吞吐量
+PROBE_SIZE = 1024 * 1024
+# 实际上传速度低于测速结果的此比例时重新测速
+PROBE_DEGRADE_RATIO = 0.5
+
+
+def probe_lines() -> Union[dict, None]:
+    """
+    同时测试所有上传线路的延迟与吞吐量，返回吞吐量最大的线路
+    延迟为空请求的耗时，吞吐量为上传 PROBE_SIZE 数据扣除延迟后的速度，线路只支持 get 测速时按延迟选择
+    """
+    headers = {'user-agent': "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 Chrome/63.0.3239.108"}
+    ret = requests.get('https://member.bilibili.com/preupload?r=probe', headers=headers, timeout=5).json()
+    logger.info(f"线路:{ret['lines']}")
+    method = 'get' if ret['probe'].get('get') else 'post'
+
+    def probe_line(line):
+        url = f"https:{line['probe_url']}"
+        try:
+            with requests.Session() as session:
+                session.headers.update(headers)
+                start = time.perf_counter()
+                if session.request(method, url, timeout=10).status_code != 200:
+                    return None
+                latency = time.perf_counter() - start
+                speed = 0
+                if method == 'post':
+                    start = time.perf_counter()
+                    if session.post(url, data=bytes(PROBE_SIZE), timeout=30).status_code != 200:
+                        return None
+                    speed = PROBE_SIZE / max(time.perf_counter() - start - latency, 0.001)
+        except requests.RequestException as e:
+            logger.debug(f"线路测速失败 {line['query']}: {e}")
+            return None
+        logger.info(f"线路测速 {line['query']}: 延迟 {latency * 1000:.0f}ms, 吞吐量 {speed / 1000 / 1000:.2f}MB/s")
+        return {**line, 'cost': latency, 'speed': speed}
+
+    with ThreadPoolExecutor(max_workers=len(ret['lines']) or 1) as executor:
+        results = [r for r in executor.map(probe_line, ret['lines']) if r is not None]
+    if not results:
+        return None
+    if method == 'post':
+        return max(results, key=lambda r: r['speed'])
+    return min(results, key=lambda r: r['cost'])
+
+
+class UploadRecord:
+    """一个进行中的上传，记录上传期间同时进行的上传数"""
+    __slots__ = ('peak',)
+
+    def __init__(self):
+        self.peak = 0
+
+
+class LineProber:
+    """
+    上传线路测速结果，进程内所有上传共用
+    结果缓存 probe_ttl 秒；选中线路的实际上传总速度明显低于测速结果时在后台重新测速
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 同时只进行一次测速
+        self._probe_lock = threading.Lock()
+        self.line: Union[dict, None] = None
+        self._time = 0
+        self._reprobing = False
+        # 进行中的上传
+        self._uploads: List[UploadRecord] = []
+
+    def get(self) -> Union[dict, None]:
+        """返回缓存的线路，过期时重新测速"""
+        with self._probe_lock:
+            if self.line is not None and time.time() - self._time < config.get('probe_ttl', 3600):
+                return self.line
+            return self._probe()
+
+    def _probe(self):
+        line = probe_lines()
+        if line is None:
+            # 测速失败时继续使用之前的结果
+            return self.line
+        self.line, self._time = line, time.time()
+        return line
+
+    def begin(self) -> UploadRecord:
+        """开始一个上传，上传结束后调用 end"""
+        record = UploadRecord()
+        with self._lock:
+            self._uploads.append(record)
+            for upload in self._uploads:
+                upload.peak = max(upload.peak, len(self._uploads))
+        return record
+
+    def end(self, record: UploadRecord):
+        with self._lock:
+            self._uploads = [upload for upload in self._uploads if upload is not record]
+
+    def report(self, line: dict, speed: float, record: UploadRecord):
+        """
+        上传完成后报告实际速度，单位：字节/秒
+        多个文件同时上传时共享线路带宽，按同时上传数估算线路的总速度再与测速结果比较
+        """
+        speed *= max(record.peak, 1)
+        if line is not self.line or not line.get('speed') or speed >= line['speed'] * PROBE_DEGRADE_RATIO:
+            return
+        with self._lock:
+            if self._reprobing:
+                return
+            self._reprobing = True
+        logger.info(f"线路 {line['query']} 上传总速度 {speed / 1000 / 1000:.2f}MB/s 低于测速结果，重新测速")
+        threading.Thread(target=self._reprobe, daemon=True, name='probe').start()
+
+    def _reprobe(self):
+        try:
+            with self._probe_lock:
+                self._probe()
+        except Exception:
+            logger.exception("线路测速失败")
+        finally:
+            self._reprobing = False
+
+
+line_prober = LineProber()
+
+
+def max_upload_tasks(tasks: int) -> int:
+    """单个文件同时上传的分块数上限，部分线路限制为 8 个连接"""
+    return max(tasks, min(tasks * 2, 8))
+
+
+class ConcurrencyController:
+    """
+    根据分块上传的吞吐量与失败率调整同时上传的分块数
+    每完成与当前并发数相同的分块为一个统计窗口：失败率过高时并发减半；
+    吞吐量随并发增加而提高时继续增加，增加并发后吞吐量下降时回退
+    """
+    # 窗口内失败率超过此值时减少并发
+    ERROR_RATE = 0.2
+    # 吞吐量变化超过此比例才视为提高或下降
+    TOLERANCE = 0.05
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        # 上次调整的方向及上个窗口的吞吐量
+        self._direction = 1
+        self._prev_throughput = None
+        self._reset_window()
+        # 整个上传的统计
+        self.stats = {'chunks': 0, 'bytes': 0, 'retries': 0, 'failed': 0,
+                      'min_limit': initial, 'max_limit': initial}
+
+    def _reset_window(self):
+        self._window_start = time.perf_counter()
+        self._window_bytes = 0
+        self._window_done = 0
+        self._window_errors = 0
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def error(self):
+        """一次分块上传失败"""
+        self._window_errors += 1
+        self.stats['retries'] += 1
+
+    def done(self, size: int):
+        """一个分块上传成功"""
+        self._window_done += 1
+        self._window_bytes += size
+        self.stats['chunks'] += 1
+        self.stats['bytes'] += size
+        if self._window_done >= self.limit:
+            self._adjust()
+
+    def _adjust(self):
+        elapsed = time.perf_counter() - self._window_start
+        throughput = self._window_bytes / elapsed if elapsed > 0 else 0
+        error_rate = self._window_errors / (self._window_done + self._window_errors)
+        limit = self.limit
+        if error_rate > self.ERROR_RATE:
+            limit = max(self.minimum, limit // 2)
+            self._direction = 1
+        elif self._prev_throughput is None or throughput > self._prev_throughput * (1 + self.TOLERANCE):
+            # 吞吐量提高，沿原方向继续调整
+            limit += self._direction
+        elif throughput < self._prev_throughput * (1 - self.TOLERANCE):
+            # 吞吐量下降，撤销上次调整
+            self._direction = -self._direction
+            limit += self._direction
+        limit = min(max(limit, self.minimum), self.maximum)
+        if limit != self.limit:
+            logger.debug(f"上传并发 {self.limit} => {limit}，吞吐量 {throughput / 1000 / 1000:.2f}MB/s，"
+                         f"失败率 {error_rate:.0%}")
+            self.limit = limit
+            self.stats['min_limit'] = min(self.stats['min_limit'], limit)
+            self.stats['max_limit'] = max(self.stats['max_limit'], limit)
+        self._prev_throughput = throughput
+        self._reset_window()
+
+
 class BiliBili:
     def __init__(self, video: 'Data'):
         self.app_key = None
@@ -135,6 +452,8 @@ class BiliBili:
         self.account = None
         self.__bili_jct = None
         self._auto_os = None
+        # 手动指定的 upos 节点
+        self._preferred_upos_cdn = None
         self.persistence_path = 'engine/bili.cookie'
 
     def check_tag(self, tag):
@@ -314,27 +633,8 @@ class BiliBili:
             return r['data']['hash'], rsa.PublicKey.load_pkcs1_openssl_pem(r['data']['key'].encode())
 
     def probe(self):
-        ret = self.__session.get('https://member.bilibili.com/preupload?r=probe', timeout=5).json()
-        logger.info(f"线路:{ret['lines']}")
-        data, auto_os = None, None
-        min_cost = 0
-        if ret['probe'].get('get'):
-            method = 'get'
-        else:
-            method = 'post'
-            data = bytes(int(1024 * 0.1 * 1024))
-        for line in ret['lines']:
-            start = time.perf_counter()
-            test = self.__session.request(method, f"https:{line['probe_url']}", data=data, timeout=30)
-            cost = time.perf_counter() - start
-            print(line['query'], cost)
-            if test.status_code != 200:
-                return
-            if not min_cost or min_cost > cost:
-                auto_os = line
-                min_cost = cost
-        auto_os['cost'] = min_cost
-        return auto_os
+        """测试所有上传线路，返回最快的线路"""
+        return probe_lines()
 
     def upload_file(self, filepath: str, lines='AUTO', tasks=3):
         """上传本地视频文件,返回视频信息dict
@@ -344,38 +644,72 @@ class BiliBili:
         bos: {"os":"bos","query":"bucket=bvcupcdnboshb&probe_version=20221109",
         "probe_url":"??"}
         """
-        preferred_upos_cdn = None
+        return self.upload_files([filepath], lines, tasks)[0]
+
+    def upload_files(self, filepaths: List[str], lines='AUTO', tasks=3, parallel=1, max_connections=None,
+                     key='default') -> List[dict]:
+        """
+        上传多个本地视频文件，所有文件共用一个连接池，按文件顺序返回视频信息
+        :param tasks: 单文件并发上传数
+        :param parallel: 同时上传的文件数
+        :param max_connections: 所有文件共用的上传连接数上限，默认为单文件并发上限 * parallel，
+                                小于此值时按 parallel 平分，限制每个文件的并发
+        :param key: 全局带宽调度中按此分配带宽，一般为主播名
+        """
+        upload = self._select_line(lines)
+        flow = bandwidth_scheduler.open(key)
+        try:
+            return asyncio.run(self._aupload_files(upload, filepaths, tasks, parallel,
+                                                   max_connections or max_upload_tasks(tasks) * parallel, flow))
+        finally:
+            flow.close()
+
+    async def _aupload_files(self, upload, filepaths, tasks, parallel, max_connections, flow):
+        semaphore = asyncio.Semaphore(parallel)
+        # 每个文件的并发不超过平分的连接数，否则超出的分块在连接池中排队，并发调整会误判吞吐量
+        max_tasks = max(max_connections // parallel, 1)
+
+        async def upload_one(filepath):
+            async with semaphore:
+                return await self._aupload_file(upload, filepath, tasks, session, flow, max_tasks)
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_connections)) as session:
+            return await asyncio.gather(*[upload_one(filepath) for filepath in filepaths])
+
+    def _select_line(self, lines):
+        """选择上传线路，返回对应的上传方法"""
         if not self._auto_os:
             if lines == 'bda':
                 self._auto_os = {"os": "upos", "query": "upcdn=bda&probe_version=20221109",
                                  "probe_url": "//upos-cs-upcdnbda.bilivideo.com/OK"}
-                preferred_upos_cdn = 'bda'
+                self._preferred_upos_cdn = 'bda'
             elif lines in {'bda2', 'cs-bda2'}:
                 self._auto_os = {"os": "upos", "query": "upcdn=bda2&probe_version=20221109",
                                  "probe_url": "//upos-cs-upcdnbda2.bilivideo.com/OK"}
-                preferred_upos_cdn = 'bda2'
+                self._preferred_upos_cdn = 'bda2'
             elif lines == 'ws':
                 self._auto_os = {"os": "upos", "query": "upcdn=ws&probe_version=20221109",
                                  "probe_url": "//upos-cs-upcdnws.bilivideo.com/OK"}
-                preferred_upos_cdn = 'ws'
+                self._preferred_upos_cdn = 'ws'
             elif lines in {'qn', 'cs-qn'}:
                 self._auto_os = {"os": "upos", "query": "upcdn=qn&probe_version=20221109",
                                  "probe_url": "//upos-cs-upcdnqn.bilivideo.com/OK"}
-                preferred_upos_cdn = 'qn'
+                self._preferred_upos_cdn = 'qn'
             elif lines == 'bldsa':
                 self._auto_os = {"os": "upos", "query": "upcdn=bldsa&probe_version=20221109",
                                  "probe_url": "//upos-cs-upcdnbldsa.bilivideo.com/OK"}
-                preferred_upos_cdn = 'bldsa'
+                self._preferred_upos_cdn = 'bldsa'
             elif lines == 'tx':
                 self._auto_os = {"os": "upos", "query": "upcdn=tx&probe_version=20221109",
                                  "probe_url": "//upos-cs-upcdntx.bilivideo.com/OK"}
-                preferred_upos_cdn = 'tx'
+                self._preferred_upos_cdn = 'tx'
             elif lines == 'txa':
                 self._auto_os = {"os": "upos", "query": "upcdn=txa&probe_version=20221109",
                                  "probe_url": "//upos-cs-upcdntxa.bilivideo.com/OK"}
-                preferred_upos_cdn = 'txa'
+                self._preferred_upos_cdn = 'txa'
             else:
-                self._auto_os = self.probe()
+                # 使用缓存的测速结果
+                self._auto_os = line_prober.get()
             logger.info(f"线路选择 => {self._auto_os['os']}: {self._auto_os['query']}. time: {self._auto_os.get('cost')}")
         if self._auto_os['os'] == 'upos':
             upload = self.upos
@@ -389,37 +723,66 @@ class BiliBili:
             logger.error(f"NoSearch:{self._auto_os['os']}")
             raise NotImplementedError(self._auto_os['os'])
         logger.info(f"os: {self._auto_os['os']}")
+        return upload
+
+    async def _aupload_file(self, upload, filepath: str, tasks, session, flow, max_tasks=None):
+        loop = asyncio.get_running_loop()
         total_size = os.path.getsize(filepath)
         with open(filepath, 'rb') as f:
-            query = {
-                'r': self._auto_os['os'] if self._auto_os['os'] != 'cos-internal' else 'cos',
-                'profile': 'ugcupos/bup' if 'upos' == self._auto_os['os'] else "ugcupos/bupfetch",
-                'ssl': 0,
-                'version': '2.8.12',
-                'build': 2081200,
-                'name': f.name,
-                'size': total_size,
-            }
-            resp = self.__session.get(
-                f"https://member.bilibili.com/preupload?{self._auto_os['query']}", params=query,
-                timeout=5)
-            ret = resp.json()
-            logger.debug(f"preupload: {ret}")
-            if preferred_upos_cdn:
-                original_endpoint: str = ret['endpoint']
-                if re.match(r'//upos-(sz|cs)-upcdn(bda2|ws|qn)\.bilivideo\.com', original_endpoint):
-                    if re.match(r'bda2|qn|ws', preferred_upos_cdn):
-                        logger.debug(f"Preferred UpOS CDN: {preferred_upos_cdn}")
-                        new_endpoint = re.sub(r'upcdn(bda2|qn|ws)', f'upcdn{preferred_upos_cdn}', original_endpoint)
-                        logger.debug(f"{original_endpoint} => {new_endpoint}")
-                        ret['endpoint'] = new_endpoint
-                    else:
-                        logger.error(f"Unrecognized preferred_upos_cdn: {preferred_upos_cdn}")
+            if upload == self.upos:
+                # 进程重启前未完成的上传，只上传缺少的分块
+                with SessionLocal() as db:
+                    resume = get_upload_session(db, os.path.abspath(filepath), file_fingerprint(filepath))
+                if resume and resume.get('result'):
+                    logger.info(f"{filepath} 已在录制中上传")
+                    return resume['result']
+                if resume:
+                    logger.info(f"续传 {filepath}: 已上传 {len(resume['parts'])} 个分块")
+                    try:
+                        video_part = await self.upos(f, total_size, resume, tasks=tasks, resume=resume,
+                                                     session=session, flow=flow, max_tasks=max_tasks)
+                        if video_part:
+                            return video_part
+                    except UploadSessionExpired as e:
+                        logger.warning(f"续传 {filepath} 失败: {e}，重新上传")
+                    with SessionLocal() as db:
+                        delete_upload_session(db, os.path.abspath(filepath))
+            ret = await loop.run_in_executor(None, self._preupload, f.name, total_size)
+            return await upload(f, total_size, ret, tasks=tasks, session=session, flow=flow, max_tasks=max_tasks)
+
+    def _preupload(self, name, total_size):
+        """申请上传，返回上传地址与鉴权等信息"""
+        query = {
+            'r': self._auto_os['os'] if self._auto_os['os'] != 'cos-internal' else 'cos',
+            'profile': 'ugcupos/bup' if 'upos' == self._auto_os['os'] else "ugcupos/bupfetch",
+            'ssl': 0,
+            'version': '2.8.12',
+            'build': 2081200,
+            'name': name,
+            'size': total_size,
+        }
+        resp = self.__session.get(
+            f"https://member.bilibili.com/preupload?{self._auto_os['query']}", params=query,
+            timeout=5)
+        ret = resp.json()
+        logger.debug(f"preupload: {ret}")
+        preferred_upos_cdn = self._preferred_upos_cdn
+        if preferred_upos_cdn:
+            original_endpoint: str = ret['endpoint']
+            if re.match(r'//upos-(sz|cs)-upcdn(bda2|ws|qn)\.bilivideo\.com', original_endpoint):
+                if re.match(r'bda2|qn|ws', preferred_upos_cdn):
+                    logger.debug(f"Preferred UpOS CDN: {preferred_upos_cdn}")
+                    new_endpoint = re.sub(r'upcdn(bda2|qn|ws)', f'upcdn{preferred_upos_cdn}', original_endpoint)
+                    logger.debug(f"{original_endpoint} => {new_endpoint}")
+                    ret['endpoint'] = new_endpoint
                 else:
-                    logger.warning(f"Assigned UpOS endpoint {original_endpoint} was never seen before, something else might have changed, so will not modify it")
-            return asyncio.run(upload(f, total_size, ret, tasks=tasks))
+                    logger.error(f"Unrecognized preferred_upos_cdn: {preferred_upos_cdn}")
+            else:
+                logger.warning(f"Assigned UpOS endpoint {original_endpoint} was never seen before, something else might have changed, so will not modify it")
+        return ret
 
-    async def cos(self, file, total_size, ret, chunk_size=10485760, tasks=3, internal=False):
+    async def cos(self, file, total_size, ret, chunk_size=10485760, tasks=3, internal=False, session=None,
+                  flow=None):
         filename = file.name
         url = ret["url"]
         if internal:
@@ -452,7 +815,7 @@ class BiliBili:
             'uploadId': upload_id,
             'chunks': chunks,
             'total': total_size
-        }, file, chunk_size, upload_chunk, tasks=tasks)
+        }, file, chunk_size, upload_chunk, tasks=tasks, session=session, flow=flow)
         cost = time.perf_counter() - start
         fetch_headers = {
             "X-Upos-Fetch-Source": ret["fetch_headers"]["X-Upos-Fetch-Source"],
@@ -493,7 +856,7 @@ class BiliBili:
                 logger.info("上传出现问题，尝试重连，次数：" + str(ii))
                 time.sleep(15)
 
-    async def kodo(self, file, total_size, ret, chunk_size=4194304, tasks=3):
+    async def kodo(self, file, total_size, ret, chunk_size=4194304, tasks=3, session=None, flow=None):
         filename = file.name
         bili_filename = ret['bili_filename']
         key = ret['key']
@@ -519,7 +882,7 @@ class BiliBili:
                                  f"=> {params['partNumber'] / chunks:.1%}")
 
         start = time.perf_counter()
-        await self._upload({}, file, chunk_size, upload_chunk, tasks=tasks)
+        await self._upload({}, file, chunk_size, upload_chunk, tasks=tasks, session=session, flow=flow)
         cost = time.perf_counter() - start
 
         logger.info(f'{filename} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s')
@@ -531,8 +894,16 @@ class BiliBili:
             raise Exception(r)
         return {"title": splitext(filename)[0], "filename": bili_filename, "desc": ""}
 
-    async def upos(self, file, total_size, ret, tasks=3):
+    async def upos(self, file, total_size, ret, tasks=3, resume=None, session=None, flow=None, max_tasks=None):
+        """
+        :param resume: 未完成的上传记录，续传时只上传缺少的分块
+        :param session: 共用的连接池，为空时单独创建
+        :param flow: 全局带宽调度的令牌桶，为空时不限速
+        :param max_tasks: 同时上传的分块数上限，为空时不额外限制
+        """
+        loop = asyncio.get_running_loop()
         filename = file.name
+        filepath = os.path.abspath(filename)
         chunk_size = ret['chunk_size']
         auth = ret["auth"]
         endpoint = ret["endpoint"]
@@ -542,28 +913,78 @@ class BiliBili:
         headers = {
             "X-Upos-Auth": auth
         }
-        # 向上传地址申请上传，得到上传id等信息
-        upload_id = self.__session.post(f'{url}?uploads&output=json', timeout=15,
-                                        headers=headers).json()["upload_id"]
+        if resume:
+            upload_id = resume['upload_id']
+            upload_session_id = resume['id']
+            uploaded = set(resume['parts'])
+        else:
+            # 向上传地址申请上传，得到上传id等信息，多个文件同时上传时不阻塞事件循环
+            upload_id = (await loop.run_in_executor(None, functools.partial(
+                self.__session.post, f'{url}?uploads&output=json', timeout=15, headers=headers))).json()["upload_id"]
+            # 记录上传信息，进程重启后可续传
+            with SessionLocal() as db:
+                upload_session_id = save_upload_session(
+                    db, filepath, fingerprint=file_fingerprint(filepath), endpoint=endpoint, upos_uri=upos_uri,
+                    auth=auth, biz_id=biz_id, upload_id=upload_id, chunk_size=chunk_size)
+            uploaded = set()
         # 开始上传
-        parts = []  # 分块信息
         chunks = math.ceil(total_size / chunk_size)  # 获取分块数量
+        # 已上传但未记录的分块，按时间间隔批量写入数据库，不在事件循环中逐块提交
+        pending_parts = []
+        last_save = time.monotonic()
+
+        def save_parts(parts):
+            with SessionLocal() as db:
+                add_upload_parts(db, upload_session_id, parts)
+
+        async def flush_parts():
+            nonlocal last_save
+            last_save = time.monotonic()
+            if not pending_parts:
+                return
+            parts = pending_parts[:]
+            pending_parts.clear()
+            try:
+                await loop.run_in_executor(None, save_parts, parts)
+            except Exception:
+                # 记录失败只影响续传时需重新上传的分块
+                logger.exception("记录已上传的分块失败")
 
         async def upload_chunk(session, chunks_data, params):
-            async with session.put(url, params=params, raise_for_status=True,
-                                   data=chunks_data, headers=headers):
-                end = time.perf_counter() - start
-                parts.append({"partNumber": params['chunk'] + 1, "eTag": "etag"})
-                sys.stdout.write(f"\r{params['end'] / 1000 / 1000 / end:.2f}MB/s "
-                                 f"=> {params['partNumber'] / chunks:.1%}")
+            try:
+                async with session.put(url, params=params, raise_for_status=True,
+                                       data=chunks_data, headers=headers):
+                    pass
+            except aiohttp.ClientResponseError as e:
+                if resume and e.status in (403, 404):
+                    # 上传 id 或鉴权已过期
+                    raise UploadSessionExpired(e.status) from e
+                raise
+            end = time.perf_counter() - start
+            uploaded.add(params['partNumber'])
+            pending_parts.append(params['partNumber'])
+            if time.monotonic() - last_save >= UPLOAD_PARTS_SAVE_INTERVAL:
+                await flush_parts()
+            sys.stdout.write(f"\r{params['end'] / 1000 / 1000 / end:.2f}MB/s "
+                             f"=> {len(uploaded) / chunks:.1%}")
 
         start = time.perf_counter()
-        await self._upload({
-            'uploadId': upload_id,
-            'chunks': chunks,
-            'total': total_size
-        }, file, chunk_size, upload_chunk, tasks=tasks)
+        record = line_prober.begin()
+        try:
+            await self._upload({
+                'uploadId': upload_id,
+                'chunks': chunks,
+                'total': total_size
+            }, file, chunk_size, upload_chunk, tasks=tasks, skip={n - 1 for n in uploaded}, session=session,
+                flow=flow, max_tasks=max_tasks)
+        finally:
+            line_prober.end(record)
+            await flush_parts()
         cost = time.perf_counter() - start
+        if not resume and not bandwidth_scheduler.bandwidth:
+            # 限速时上传速度不代表线路质量
+            line_prober.report(self._auto_os, total_size / max(cost, 0.001), record)
+        parts = [{"partNumber": n, "eTag": "etag"} for n in sorted(uploaded)]  # 分块信息
         p = {
             'name': filename,
             'uploadId': upload_id,
@@ -574,40 +995,96 @@ class BiliBili:
         attempt = 0
         while attempt <= 5:  # 一旦放弃就会丢失前面所有的进度，多试几次吧
             try:
-                r = self.__session.post(url, params=p, json={"parts": parts}, headers=headers, timeout=15).json()
+                r = (await loop.run_in_executor(None, functools.partial(
+                    self.__session.post, url, params=p, json={"parts": parts}, headers=headers, timeout=15))).json()
                 if r.get('OK') == 1:
                     logger.info(f'{filename} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s. {r}')
-                    return {"title": splitext(filename)[0], "filename": splitext(basename(upos_uri))[0], "desc": ""}
+                    video_part = {"title": splitext(filename)[0], "filename": splitext(basename(upos_uri))[0], "desc": ""}
+                    # 保留上传结果直到投稿完成
+                    with SessionLocal() as db:
+                        finish_upload_session(db, upload_session_id, video_part)
+                    return video_part
                 raise IOError(r)
             except IOError:
                 attempt += 1
                 logger.info(f"请求合并分片时出现问题，尝试重连，次数：" + str(attempt))
-                time.sleep(15)
+                await asyncio.sleep(15)
 
     @staticmethod
-    async def _upload(params, file, chunk_size, afunc, tasks=3):
-        params['chunk'] = -1
+    async def _upload(params, file, chunk_size, afunc, tasks=3, skip=(), session=None, flow=None, max_tasks=None):
+        """
+        :param skip: 已上传、需跳过的分块序号，从 0 开始
+        :param session: 共用的连接池，为空时单独创建
+        :param flow: 全局带宽调度的令牌桶，每次发送分块前取出令牌
+        :param max_tasks: 同时上传的分块数上限，一般为共用连接池中分给该文件的连接数
+        """
+        # 分块大小由服务端决定且续传时需保持一致，只调整同时上传的分块数
+        maximum = max_upload_tasks(tasks)
+        if max_tasks is not None:
+            maximum = min(maximum, max_tasks)
+        controller = ConcurrencyController(min(tasks, maximum), maximum)
+        # 每个上传任务一个缓冲区，另预读两个分块
+        reader = ChunkReader(file, chunk_size, controller.maximum + 2, skip)
 
         async def upload_chunk():
             while True:
-                chunks_data = file.read(chunk_size)
-                if not chunks_data:
+                chunk = await reader.get()
+                if chunk is None:
                     return
-                params['chunk'] += 1
-                params['size'] = len(chunks_data)
-                params['partNumber'] = params['chunk'] + 1
-                params['start'] = params['chunk'] * chunk_size
-                params['end'] = params['start'] + params['size']
+                index, chunks_data = chunk
                 clone = params.copy()
-                for i in range(10):
-                    try:
-                        await afunc(session, chunks_data, clone)
-                        break
-                    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-                        logger.error(f"retry chunk{clone['chunk']} >> {i + 1}. {e}")
+                clone['chunk'] = index
+                clone['size'] = len(chunks_data)
+                clone['partNumber'] = index + 1
+                clone['start'] = index * chunk_size
+                clone['end'] = clone['start'] + clone['size']
+                backoff = Backoff(cap=30)
+                await controller.acquire()
+                try:
+                    for i in range(10):
+                        try:
+                            if flow is not None:
+                                await flow.acquire(clone['size'])
+                            await afunc(session, chunks_data, clone)
+                            controller.done(clone['size'])
+                            break
+                        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                            controller.error()
+                            if i == 9:
+                                logger.error(f"chunk{clone['chunk']} failed after {i + 1} tries. {e}")
+                                controller.stats['failed'] += 1
+                                break
+                            delay = backoff.next()
+                            logger.error(f"retry chunk{clone['chunk']} >> {i + 1} in {delay:.1f}s. {e}")
+                            await asyncio.sleep(delay)
+                finally:
+                    await controller.release()
+                    reader.release(chunks_data)
+
+        async def run():
+            start = time.perf_counter()
+            reading = asyncio.create_task(reader.run(controller.maximum))
+            workers = [asyncio.create_task(upload_chunk()) for _ in range(controller.maximum)]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                # 任一上传任务出错时预读随之停止，取消其余任务，避免其一直等待分块
+                for task in (reading, *workers):
+                    task.cancel()
+                await asyncio.gather(reading, *workers, return_exceptions=True)
+                stats = controller.stats
+                cost = time.perf_counter() - start
+                logger.info(f"{os.path.basename(file.name)} 分块上传统计: {stats['chunks']} 个分块, "
+                            f"{stats['bytes'] / 1000 / 1000:.1f}MB, {cost:.1f}s, "
+                            f"{stats['bytes'] / 1000 / 1000 / max(cost, 0.001):.2f}MB/s, 重试 {stats['retries']} 次, "
+                            f"失败 {stats['failed']} 个, 并发 {stats['min_limit']}-{stats['max_limit']} "
+                            f"(最终 {controller.limit})")
 
+        if session is not None:
+            await run()
+            return
         async with aiohttp.ClientSession() as session:
-            await asyncio.gather(*[upload_chunk() for _ in range(tasks)])
+            await run()
 
     def submit(self, submit_api=None):
         if not self.video.title:
@@ -669,18 +1146,23 @@ class BiliBili:
         """
         from PIL import Image
         from io import BytesIO
+        from biliup.common.cover import crop_to_ratio, is_prepared
 
+        buffered = BytesIO()
         with Image.open(img) as im:
-            # 宽和高,需要16：10
-            xsize, ysize = im.size
-            if xsize / ysize > 1.6:
-                delta = xsize - ysize * 1.6
-                region = im.crop((delta / 2, 0, xsize - delta / 2, ysize))
+            prepared = is_prepared(im)
+            if not prepared:
+                # 宽和高,需要16：10
+                region = crop_to_ratio(im)
+                region.save(buffered, format=im.format)
+        if prepared:
+            # 直播封面在录制时已裁剪转码，直接使用原文件
+            if isinstance(img, (str, os.PathLike)):
+                with open(img, 'rb') as f:
+                    buffered.write(f.read())
             else:
-                delta = ysize - xsize * 10 / 16
-                region = im.crop((0, delta / 2, xsize, ysize - delta / 2))
-            buffered = BytesIO()
-            region.save(buffered, format=im.format)
+                img.seek(0)
+                buffered.write(img.read())
         r = self.__session.post(
             url='https://member.bilibili.com/x/vu/web/cover/up',
             data={
@@ -188,6 +188,9 @@ class Youtube(DownloadBase):
 
     def download(self):
         filename = self.gen_download_filename(is_fmt=True)
+        # 下载完成后的存放目录
+        save_dir = os.path.dirname(filename) or '.'
+        filename = os.path.basename(filename)
         # 因此临时存储在其他地方
         # ydl下载的文件在下载失败时不可控
         # 临时存储在其他地方
@@ -237,7 +240,7 @@ class Youtube(DownloadBase):
             # 下载成功后，将文件移动到运行目录
             # 下载成功的情况下移动到运行目录
             for file in os.listdir(download_dir):
-                shutil.move(f'{download_dir}/{file}', '.')
+                shutil.move(f'{download_dir}/{file}', save_dir)
 
         except DownloadError as e:
             # 如果错误信息包含"Requested format is not available"
@@ -1,12 +1,21 @@
 import inspect
 import logging
+import os
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
 
 from biliup.config import config
 from .engine.decorators import Plugin
 
 logger = logging.getLogger('biliup')
 
+# 录制中正在提前上传的分段 {文件绝对路径: Future}
+segment_uploads: Dict[str, Future] = {}
+_segment_uploads_lock = threading.Lock()
+_segment_upload_executor: Optional[ThreadPoolExecutor] = None
+
 
 def upload(data):
     """
@@ -49,6 +58,64 @@ def upload(data):
         logger.exception("Uncaught exception:")
 
 
+def upload_segment(name: str, url: str, file_name: str) -> Optional[Future]:
+    """
+    录制中分段完成后在后台提前上传，投稿时只需上传剩余的分段
+    仅支持提供 upload_segment 方法的上传插件，其他插件仍在下载结束后上传
+    """
+    global _segment_upload_executor
+    context = {**config, **config['streamers'].get(name, {})}
+    platform = context.get("uploader") if context.get("uploader") else "biliup-rs"
+    cls = Plugin.upload_plugins.get(platform)
+    if cls is None or not hasattr(cls, 'upload_segment'):
+        logger.debug(f"{platform} 不支持录制中上传")
+        return None
+    kwargs = {}
+    for k in inspect.signature(cls).parameters:
+        v = context.get(k)
+        if v:
+            kwargs[k] = v
+    uploader = cls(name, {'name': name, 'url': url}, **kwargs)
+    path = os.path.abspath(file_name)
+
+    def job():
+        logger.info(f"录制中上传分段: {file_name}")
+        try:
+            return uploader.upload_segment(file_name)
+        except:
+            # 失败的分段在投稿时重新上传或续传
+            logger.exception(f"录制中上传分段失败: {file_name}")
+            raise
+
+    def done(f: Future):
+        with _segment_uploads_lock:
+            if segment_uploads.get(path) is f:
+                del segment_uploads[path]
+
+    with _segment_uploads_lock:
+        if _segment_upload_executor is None:
+            _segment_upload_executor = ThreadPoolExecutor(max_workers=config.get('pool2_size', 3),
+                                                          thread_name_prefix='segment_upload')
+        future = _segment_upload_executor.submit(job)
+        segment_uploads[path] = future
+    future.add_done_callback(done)
+    return future
+
+
+def wait_segment_uploads(file_list: List[str]):
+    """等待文件的录制中上传结束，无论成功与否"""
+    for file_name in file_list:
+        with _segment_uploads_lock:
+            future = segment_uploads.get(os.path.abspath(file_name))
+        if future is None:
+            continue
+        logger.info(f"等待录制中上传: {file_name}")
+        try:
+            future.result()
+        except:
+            pass
+
+
 def biliup_uploader(filelist, data):
     """
     使用Biliup上传器将文件上传到指定平台。
@@ -16,7 +16,11 @@ from sqlalchemy.exc import NoResultFound, MultipleResultsFound
 from urllib.parse import urlparse, unquote
 
 import biliup.common.reload
+from biliup.common.bandwidth import bandwidth_scheduler
+from biliup.common.storage import iter_files, storage_manager
 from biliup.config import config
+from biliup.Danmaku.hub import danmaku_hub
+from biliup.engine.metrics import recording_metrics
 from biliup.plugins.bili_webup import BiliBili, Data
 from .aiohttp_basicauth_middleware import basic_auth_middleware
 from biliup.database.db import SessionLocal
@@ -267,9 +271,9 @@ async def streamers(request):
     # 获取文件列表
     file_list = []
     i = 1
-    for file_name in os.listdir('.'):
+    for file_name in iter_files():
         # 如果文件名在黑名单中，则跳过
-        if file_name in _blacklist:
+        if os.path.basename(file_name) in _blacklist:
             continue
         # 分割文件名和扩展名
         name, ext = os.path.splitext(file_name)
@@ -513,6 +517,8 @@ async def users(request):
         db.commit()
         # 从数据库中加载配置信息（注：此处代码可能需要根据实际情况调整）
         config.load_from_db(db)
+    # 带宽限制立即生效，无需重启
+    bandwidth_scheduler.load_config()
     return web.json_response(resp)
 
 @routes.post('/v1/uploads')
@@ -564,9 +570,70 @@ async def app_status(request):
             continue
         # 将键值对添加到res字典中
         res[key] = value
+    # 存储卷剩余空间与写入速度
+    res['storage'] = storage_manager.status()
+    # 正在进行的录制实时指标
+    res['recordings'] = recording_metrics.as_list()
+    # 上传带宽分配
+    res['bandwidth'] = bandwidth_scheduler.status()
     # 返回包含应用状态的json响应
     return web.json_response(res)
 
+@routes.get('/v1/metrics')
+async def metrics(request):
+    # 以 Prometheus 文本格式返回录制实时指标
+    return web.Response(text=recording_metrics.prometheus(), content_type='text/plain')
+
+@routes.get('/v1/upload/bandwidth')
+async def get_bandwidth(request):
+    # 上传带宽限制及各上传任务分配到的速率
+    return web.json_response(bandwidth_scheduler.status())
+
+@routes.put('/v1/upload/bandwidth')
+async def put_bandwidth(request):
+    # 运行时调整上传带宽限制，未提供的项保持不变，重启后恢复为配置文件中的值
+    json_data = await request.json()
+    try:
+        bandwidth_scheduler.set_limits(json_data.get('bandwidth'), json_data.get('record_reserve'),
+                                       json_data.get('weights'))
+    except (TypeError, ValueError, AttributeError) as e:
+        return web.json_response({"status": 400, 'error': str(e)}, status=400)
+    return web.json_response(bandwidth_scheduler.status())
+
+@routes.get('/v1/danmaku/rooms')
+async def danmaku_rooms(request):
+    # 正在录制弹幕的直播间
+    return web.json_response(danmaku_hub.rooms())
+
+@routes.get('/v1/danmaku/stream')
+async def danmaku_stream(request):
+    # 以 Server-Sent Events 实时推送弹幕，可通过 url 参数只订阅指定直播间
+    resp = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+    })
+    await resp.prepare(request)
+    subscription = danmaku_hub.subscribe(request.query.get('url'))
+    dropped = 0
+    try:
+        while True:
+            msgs = await subscription.get(timeout=15)
+            if subscription.dropped > dropped:
+                await resp.write(f'event: dropped\ndata: {subscription.dropped - dropped}\n\n'.encode())
+                dropped = subscription.dropped
+            if not msgs:
+                # 心跳，同时用于检测连接断开
+                await resp.write(b': ping\n\n')
+                continue
+            await resp.write(''.join(
+                f'data: {json.dumps(m, ensure_ascii=False, default=str)}\n\n' for m in msgs).encode())
+    except ConnectionResetError:
+        pass
+    finally:
+        # 客户端断开或服务停止时取消订阅，取消异常继续向上抛出
+        danmaku_hub.unsubscribe(subscription)
+    return resp
+
 @routes.get('/bili/archive/pre')
 async def pre_archive(request):
     # 定义一个变量 path，并尝试从数据库中获取 'bilibili-cookies' 的配置信息
@@ -729,6 +796,8 @@ async def service(args):
         # 根路径处理
         web.get('/', root_handler)
     ])
+    # 添加 /v1 接口路由
+    app.add_routes(routes)
     # 如果有设置密码
     if args.password:
         # 添加基本认证中间件
@@ -0,0 +1,31 @@
+from biliup.common.bandwidth import BandwidthScheduler
+
+
+def scheduler(bandwidth=80):
+    s = BandwidthScheduler()
+    s._recording_mbps = lambda: 0
+    s.set_limits(bandwidth, 0, {'b': 3})
+    return s
+
+
+def test_uploads_of_same_key_share_flow():
+    s = scheduler()
+    segment = s.open('a')
+    final = s.open('a')
+    other = s.open('b')
+    assert segment is final
+    # 按主播而非上传任务数分配
+    assert segment.rate * 3 == other.rate
+    segment.close()
+    assert [f['key'] for f in s.status()['flows']] == ['a', 'b']
+    assert s.status()['flows'][0]['uploads'] == 1
+    final.close()
+    assert [f['key'] for f in s.status()['flows']] == ['b']
+    assert other.rate == s.upload_rate
+
+
+def test_reopen_after_close_creates_new_flow():
+    s = scheduler()
+    flow = s.open('a')
+    flow.close()
+    assert s.open('a') is not flow
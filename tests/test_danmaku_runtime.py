@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+from biliup.Danmaku.douyin import Douyin
+from biliup.Danmaku.douyin_util import DouyinDanmakuUtils
+from biliup.Danmaku.runtime import danmaku_runtime
+from biliup.plugins.douyin import DouyinUtils
+
+# 模拟获取 ttwid 与计算 signature 的耗时，单位：秒
+SLOW = 0.5
+
+
+async def max_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """模拟其他房间的弹幕接收，返回事件循环的最大延迟"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+def test_slow_douyin_connect_does_not_block_loop(monkeypatch):
+    def get_ttwid():
+        time.sleep(SLOW)
+        return 'ttwid'
+
+    def get_signature(x_ms_stub):
+        time.sleep(SLOW)
+        return 'signature'
+
+    monkeypatch.setattr(DouyinUtils, 'get_ttwid', staticmethod(get_ttwid))
+    monkeypatch.setattr(DouyinDanmakuUtils, 'get_signature', staticmethod(get_signature))
+    monkeypatch.setitem(Douyin.headers, 'Cookie', '')
+
+    async def connect():
+        stop = asyncio.Event()
+        lag = asyncio.create_task(max_lag(stop))
+        # 等待模拟的房间开始调度
+        await asyncio.sleep(0.05)
+        try:
+            url, _ = await Douyin.get_ws_info('https://live.douyin.com/1', {'room_id': '1'})
+        finally:
+            stop.set()
+        return url, await lag
+
+    url, lag = danmaku_runtime.submit(connect()).result(timeout=10)
+    assert 'signature=signature' in url
+    assert Douyin.headers['Cookie'].startswith('ttwid=ttwid;')
+    # 连接耗时 2 * SLOW，期间事件循环仍能及时调度其他协程
+    assert lag < SLOW / 5
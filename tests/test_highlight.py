@@ -0,0 +1,104 @@
+import random
+
+from biliup.Danmaku.highlight import HighlightDetector, detect_file, find_clips
+
+
+def danmaku_times(duration, rate, spikes, spike_rate=20, seed=0):
+    """按秒生成弹幕时间，spikes 内的秒数使用 spike_rate"""
+    rng = random.Random(seed)
+    times = []
+    for second in range(duration):
+        r = spike_rate if any(s <= second < e for s, e in spikes) else rate
+        times.extend(second + rng.random() for _ in range(rng.randint(max(r - 1, 0), r + 1)))
+    return sorted(times)
+
+
+def write_xml(path, times):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<i>\n')
+        for t in times:
+            f.write(f'\t<d p="{t:.3f},1,25,16777215,0,0,0,0">弹幕</d>\n')
+        f.write('</i>\n')
+
+
+def detect(times, **options):
+    detector = HighlightDetector(**options)
+    for t in times:
+        detector.feed(t)
+    return detector.close()
+
+
+def test_detects_spike():
+    intervals = detect(danmaku_times(900, 2, [(400, 460)]))
+    assert len(intervals) == 1
+    start, end = intervals[0]
+    # 包含向前向后扩展的时间
+    assert start <= 400 - 20 + 5
+    assert 460 <= end <= 460 + 10 + 30
+
+
+def test_steady_rate_has_no_highlight():
+    assert detect(danmaku_times(900, 5, [])) == []
+
+
+def test_ignores_spike_during_warmup():
+    assert detect(danmaku_times(600, 2, [(10, 50)])) == []
+
+
+def test_drops_short_spike():
+    times = danmaku_times(900, 2, [(400, 405)])
+    # 短时速率的衰减会延长高能持续时间，需高于 min_duration 才会保留
+    assert detect(times, min_duration=5) != []
+    assert detect(times, min_duration=60) == []
+
+
+def test_merges_close_spikes():
+    intervals = detect(danmaku_times(900, 2, [(400, 440), (450, 490)]))
+    assert len(intervals) == 1
+
+
+def test_separates_distant_spikes():
+    intervals = detect(danmaku_times(1500, 2, [(400, 440), (1000, 1040)]))
+    assert len(intervals) == 2
+    assert intervals[0][1] < intervals[1][0]
+
+
+def test_feed_count_matches_feed():
+    times = danmaku_times(900, 2, [(400, 460)])
+    detector = HighlightDetector()
+    buckets = {}
+    for t in times:
+        buckets[int(t)] = buckets.get(int(t), 0) + 1
+    for second, count in sorted(buckets.items()):
+        detector.feed(second, count)
+    assert detector.close() == detect(times)
+
+
+def test_from_config_ignores_unknown_options():
+    detector = HighlightDetector.from_config({'threshold': 5, 'upload': False, 'output_dir': 'x'})
+    assert detector.threshold == 5
+
+
+def test_detect_file_unordered(tmp_path):
+    times = danmaku_times(900, 2, [(400, 460)])
+    unordered = list(times)
+    random.Random(1).shuffle(unordered)
+    path = tmp_path / 'a.xml'
+    write_xml(path, unordered)
+    assert detect_file(str(path)) == detect(times)
+
+
+def test_find_clips(tmp_path):
+    video = tmp_path / '主播A2024-01-01T00_00_00.flv'
+    video.touch()
+    directory = tmp_path / 'highlights'
+    directory.mkdir()
+    for name in ('主播A2024-01-01T00_00_00_highlight_10.flv', '主播A2024-01-01T00_00_00_highlight_2.flv',
+                 '主播A2024-01-01T00_00_00_highlight_3.tmp.flv', '主播B2024-01-01T00_00_00_highlight_1.flv'):
+        (directory / name).touch()
+    clips = find_clips(str(video))
+    assert [p.rsplit('_', 1)[-1] for p in clips] == ['2.flv', '10.flv']
+
+
+def test_find_clips_without_directory(tmp_path):
+    assert find_clips(str(tmp_path / 'a.flv')) == []
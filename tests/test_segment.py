@@ -0,0 +1,188 @@
+import struct
+
+import pytest
+
+from biliup.engine.segment import (TS_PACKET_SIZE, _read_ts_timestamp, _ts_packets, append_segment,
+                                   flv_last_timestamp, merge_danmaku)
+
+VIDEO_PID = 0x100
+
+
+def flv_tag(tag_type, timestamp, data):
+    header = bytes([tag_type]) + len(data).to_bytes(3, 'big') + (timestamp & 0xFFFFFF).to_bytes(3, 'big') \
+             + bytes([(timestamp >> 24) & 0xFF]) + b'\x00\x00\x00'
+    return header + data + struct.pack('>I', 11 + len(data))
+
+
+def amf_metadata(duration, filesize):
+    def number(key, value):
+        return len(key).to_bytes(2, 'big') + key + b'\x00' + struct.pack('>d', value)
+
+    return (b'\x02\x00\x0aonMetaData\x08' + (2).to_bytes(4, 'big')
+            + number(b'duration', duration) + number(b'filesize', filesize) + b'\x00\x00\x09')
+
+
+def write_flv(path, start, frames, interval=40):
+    """生成含 onMetaData 与交替音视频 tag 的 flv，时间戳从 start 开始"""
+    body = flv_tag(18, 0, amf_metadata(frames * interval / 1000, 0))
+    for i in range(frames):
+        body += flv_tag(9, start + i * interval, b'\x17\x01' + bytes(16))
+        body += flv_tag(8, start + i * interval, b'\xaf\x01' + bytes(8))
+    with open(path, 'wb') as f:
+        f.write(b'FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00' + body)
+
+
+def read_flv(path):
+    """返回 (tag 类型, 时间戳) 列表与 onMetaData 中的数值"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 13
+    tags, metadata = [], {}
+    while pos + 11 <= len(data):
+        size = int.from_bytes(data[pos + 1:pos + 4], 'big')
+        timestamp = int.from_bytes(data[pos + 4:pos + 7], 'big') | data[pos + 7] << 24
+        if data[pos] == 18:
+            payload = data[pos + 11:pos + 11 + size]
+            for key in (b'duration', b'filesize'):
+                i = payload.index(key) + len(key) + 1
+                metadata[key.decode()] = struct.unpack('>d', payload[i:i + 8])[0]
+        else:
+            tags.append((data[pos], timestamp))
+        pos += 11 + size + 4
+    return tags, metadata
+
+
+def encode_timestamp(prefix, value):
+    return bytes([prefix << 4 | (value >> 29) & 0x0E | 1, (value >> 22) & 0xFF, (value >> 14) & 0xFE | 1,
+                  (value >> 7) & 0xFF, (value << 1) & 0xFE | 1])
+
+
+def ts_packet(pid, cc, pts=None, dts=None, pcr=None):
+    """生成一个 TS 包，带时间戳时为 PES 开头的包"""
+    adaptation = b''
+    if pcr is not None:
+        adaptation = bytes([7, 0x10]) + (pcr >> 1).to_bytes(4, 'big') + bytes([(pcr & 1) << 7 | 0x7E, 0])
+    payload = b''
+    if pts is not None:
+        if dts is None:
+            payload = b'\x00\x00\x01\xe0\x00\x00\x80\x80\x05' + encode_timestamp(2, pts)
+        else:
+            payload = b'\x00\x00\x01\xe0\x00\x00\x80\xc0\x0a' + encode_timestamp(3, pts) + encode_timestamp(1, dts)
+    control = 0x30 if adaptation else 0x10
+    header = bytes([0x47, (0x40 if pts is not None else 0) | pid >> 8, pid & 0xFF, control | cc])
+    packet = header + adaptation + payload
+    return packet + b'\xff' * (TS_PACKET_SIZE - len(packet))
+
+
+def write_ts(path, start, frames, interval=3000, cc=0):
+    """每帧一个带 PCR 的 PES 包与一个续包，PTS 比 DTS 晚一帧"""
+    with open(path, 'wb') as f:
+        for i in range(frames):
+            dts = (start + i * interval) % (1 << 33)
+            pts = (dts + interval) % (1 << 33)
+            f.write(ts_packet(VIDEO_PID, (cc + 2 * i) % 16, pts=pts, dts=dts, pcr=dts))
+            f.write(ts_packet(VIDEO_PID, (cc + 2 * i + 1) % 16))
+
+
+def read_ts(path):
+    """返回 (DTS 列表, PTS 列表, PCR 列表, 连续计数器列表)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    dts, pts, pcr, counters = [], [], [], []
+    for pos, pid, has_pcr, timestamps in _ts_packets(data):
+        counters.append(data[pos + 3] & 0x0F)
+        if timestamps:
+            pts.append(_read_ts_timestamp(data, timestamps[0]))
+            dts.append(_read_ts_timestamp(data, timestamps[-1]))
+        if has_pcr:
+            pcr.append(int.from_bytes(data[pos + 6:pos + 10], 'big') << 1 | data[pos + 10] >> 7)
+    return dts, pts, pcr, counters
+
+
+def test_append_flv_continuous(tmp_path):
+    dst, src = tmp_path / 'a.flv', tmp_path / 'b.flv'
+    write_flv(dst, 0, 50)
+    # 重连后的录制时间戳从任意值开始
+    write_flv(src, 123456, 25)
+    offset = append_segment(str(dst), str(src))
+    assert not src.exists()
+    tags, metadata = read_flv(dst)
+    video = [t for tag_type, t in tags if tag_type == 9]
+    assert len(video) == 75
+    assert video == sorted(video)
+    assert video[50] == 49 * 40 + 1
+    assert offset == pytest.approx(video[50] / 1000)
+    assert all(b - a <= 41 for a, b in zip(video, video[1:]))
+    assert metadata['duration'] == flv_last_timestamp(str(dst)) / 1000
+    assert metadata['filesize'] == dst.stat().st_size
+
+
+def test_append_ts_continuous(tmp_path):
+    dst, src = tmp_path / 'a.ts', tmp_path / 'b.ts'
+    write_ts(dst, 900000, 50)
+    write_ts(src, 5000000, 25, cc=7)
+    # 断流时最后一个包可能不完整
+    with open(src, 'ab') as f:
+        f.write(b'\x47' + bytes(100))
+    offset = append_segment(str(dst), str(src))
+    assert not src.exists()
+    dts, pts, pcr, counters = read_ts(dst)
+    assert len(dts) == 75
+    assert all(b - a == 3000 for a, b in zip(dts, dts[1:]))
+    assert all(p - d == 3000 for p, d in zip(pts, dts))
+    assert pcr == dts
+    assert offset == pytest.approx(50 * 3000 / 90000)
+    assert all(b == (a + 1) % 16 for a, b in zip(counters, counters[1:]))
+
+
+def test_append_ts_timestamp_wrap(tmp_path):
+    dst, src = tmp_path / 'a.ts', tmp_path / 'b.ts'
+    # 合并后的时间戳越过 33 位上限
+    write_ts(dst, (1 << 33) - 3000 * 50, 50)
+    write_ts(src, 0, 10)
+    append_segment(str(dst), str(src))
+    dts, _, _, _ = read_ts(dst)
+    assert all((b - a) % (1 << 33) == 3000 for a, b in zip(dts, dts[1:]))
+
+
+def test_append_failure_keeps_dst(tmp_path):
+    dst, src = tmp_path / 'a.ts', tmp_path / 'b.ts'
+    write_ts(dst, 0, 10)
+    size = dst.stat().st_size
+    src.write_bytes(b'\x00' * TS_PACKET_SIZE * 2)
+    with pytest.raises(ValueError):
+        append_segment(str(dst), str(src))
+    assert dst.stat().st_size == size
+    assert src.exists()
+
+
+def test_merge_danmaku_archive(tmp_path):
+    from biliup.Danmaku.archive import BinaryDanmakuWriter, read_window, start_time_of
+
+    dst, src = tmp_path / 'a.xml', tmp_path / 'b.xml'
+    writer = BinaryDanmakuWriter(str(tmp_path / 'a.dm'), 1000)
+    writer.append(1, {'msg_type': 'danmaku', 'name': 'a', 'content': '1'})
+    writer.close()
+    writer = BinaryDanmakuWriter(str(tmp_path / 'b.dm'), 1200)
+    writer.append(2, {'msg_type': 'gift', 'name': 'b', 'content': '2', 'extra': {'num': 3}})
+    writer.add_gap(3, 4)
+    writer.close()
+    # 只有礼物等消息时没有 xml
+    merge_danmaku(str(dst), str(src), 100)
+    assert not (tmp_path / 'b.dm').exists()
+    records = list(read_window(str(tmp_path / 'a.dm')))
+    assert [(r.time, r.msg_type) for r in records] == [(1, 'danmaku'), (102, 'gift'), (104, 'gap')]
+    assert records[1].extra == {'num': 3}
+    assert records[2].extra == {'start': 103}
+    assert start_time_of(str(tmp_path / 'a.dm')) == 1000
+
+
+def test_merge_danmaku_archive_without_dst(tmp_path):
+    from biliup.Danmaku.archive import BinaryDanmakuWriter, read_window, start_time_of
+
+    writer = BinaryDanmakuWriter(str(tmp_path / 'b.dm'), 1200)
+    writer.append(2, {'msg_type': 'danmaku', 'content': '2'})
+    writer.close()
+    merge_danmaku(str(tmp_path / 'a.xml'), str(tmp_path / 'b.xml'), 100)
+    assert [r.time for r in read_window(str(tmp_path / 'a.dm'))] == [102]
+    assert start_time_of(str(tmp_path / 'a.dm')) == 1100